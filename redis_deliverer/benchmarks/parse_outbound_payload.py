@@ -0,0 +1,55 @@
+"""Measure the per-message cost of reading queued outbound messages.
+
+Run from redis_deliverer with the repository root on the path:
+
+    PYTHONPATH=.. python -m benchmarks.parse_outbound_payload
+"""
+import argparse
+import os
+import timeit
+
+from deliver import OutboundPayload
+from redis_queue.v1_0.envelope import encode_envelope
+
+
+def build_message(size: int, envelope_format: str) -> bytes:
+    return encode_envelope(
+        {
+            "service": {"url": "https://agent.example.com/didcomm"},
+            "headers": {"Content-Type": "application/didcomm-envelope-enc"},
+            "metadata": {},
+        },
+        os.urandom(size),
+        envelope_format,
+    )
+
+
+def parse(message: bytes):
+    msg = OutboundPayload.from_bytes(message)
+    return msg.endpoint_scheme, msg.payload
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=10000)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[256, 4 * 1024, 64 * 1024]
+    )
+    args = parser.parse_args()
+    print(f"{'format':<8}{'size':>8}{'parse':>12}{'parse+payload':>16}")
+    for envelope_format in ("json", "binary"):
+        for size in args.sizes:
+            message = build_message(size, envelope_format)
+            parse_s = timeit.timeit(
+                lambda: OutboundPayload.from_bytes(message), number=args.number
+            )
+            total_s = timeit.timeit(lambda: parse(message), number=args.number)
+            print(
+                f"{envelope_format:<8}{size:>8}"
+                f"{parse_s / args.number * 1e6:>10.2f}us"
+                f"{total_s / args.number * 1e6:>14.2f}us"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,59 +1,154 @@
 import base64
 import json
+import zlib
+from functools import lru_cache
+from typing import List, Optional, Union
 from urllib.parse import urlparse
 
-from pydantic import BaseModel, PrivateAttr, validator
+from redis_queue.v1_0.envelope import is_binary_envelope, unpack_envelope
+from redis_queue.v1_0.utils import decompress_payload
 
 
-class NoneDefaultModel(BaseModel):
-    @validator("*", pre=True)
-    def not_none(cls, v, field):
-        if all(
-            (
-                # Cater for the occasion where field.default in (0, False)
-                getattr(field, "default", None) is not None,
-                v is None,
-            )
-        ):
-            return field.default
-        else:
-            return v
+@lru_cache(maxsize=1024)
+def parse_endpoint_scheme(url: str) -> str:
+    """Return the scheme of an endpoint url, endpoints repeat across messages."""
+    return urlparse(url).scheme
 
 
-class RedisQueuePayload(NoneDefaultModel):
-    class Config:
-        json_encoders = {bytes: lambda v: base64.urlsafe_b64encode(v).decode()}
+class InvalidPayloadError(ValueError):
+    """The payload of an outbound message cannot be decoded."""
 
-    @classmethod
-    def from_bytes(cls, value: bytes):
-        payload = json.loads(value.decode("utf8"))
-        return cls(**payload)
 
-    def to_bytes(self) -> bytes:
-        return str.encode(self.json(), encoding="utf8")
+class Service:
+    __slots__ = ("url",)
+
+    def __init__(self, url: str):
+        if not isinstance(url, str):
+            raise ValueError("Service url must be a string")
+        self.url = url
+
+
+class Target:
+    __slots__ = ("service", "headers")
+
+    def __init__(self, service: dict, headers: Optional[dict] = None):
+        self.service = Service(**service)
+        self.headers = headers or {}
 
 
-class Service(BaseModel):
-    url: str
+class OutboundPayload:
+    """Outbound message read from the queue.
 
+    Envelope fields are used as is, without model validation. The payload is
+    only base64 decoded and decompressed when first accessed.
+    """
 
-class OutboundPayload(RedisQueuePayload):
-    service: Service
-    payload: bytes
-    headers: dict = {}
-    retries: int = 0
-    _endpoint_scheme: str = PrivateAttr()
+    __slots__ = (
+        "service",
+        "headers",
+        "retries",
+        "metadata",
+        "targets",
+        "retry_id",
+        "first_failed_at",
+        "_payload",
+        "_encoded_payload",
+        "_content_encoding",
+    )
 
-    def __init__(self, **data):
-        super().__init__(**data)
-        self._endpoint_scheme = urlparse(self.service.url).scheme
+    # Envelope fields read by the constructor, others are ignored
+    FIELDS = frozenset(
+        (
+            "payload",
+            "service",
+            "headers",
+            "retries",
+            "metadata",
+            "targets",
+            "first_failed_at",
+        )
+    )
+
+    def __init__(
+        self,
+        payload: Union[str, bytes],
+        service: Optional[dict] = None,
+        headers: Optional[dict] = None,
+        retries: Optional[int] = 0,
+        metadata: Optional[dict] = None,
+        targets: Optional[List[dict]] = None,
+        first_failed_at: Optional[float] = None,
+    ):
+        if not (service or targets):
+            raise ValueError("Outbound message has no service or targets")
+        if not isinstance(payload, (str, bytes)):
+            raise ValueError("Outbound message payload must be str or bytes")
+        self.service = Service(**service) if service else None
+        self.headers = headers or {}
+        self.retries = retries or 0
+        self.metadata = dict(metadata or {})
+        self.targets = [Target(**target) for target in targets or ()]
+        self.retry_id = None
+        self.first_failed_at = first_failed_at
+        self._payload = None
+        self._encoded_payload = payload
+        self._content_encoding = self.metadata.pop("content-encoding", None)
 
-    @validator("payload", pre=True)
     @classmethod
-    def decode_payload_to_bytes(cls, v):
-        assert isinstance(v, str)
-        return base64.urlsafe_b64decode(v)
+    def from_bytes(cls, value: bytes) -> "OutboundPayload":
+        """Read a queued message in either envelope format.
+
+        Raises ValueError if value is not a valid outbound message.
+        """
+        try:
+            if is_binary_envelope(value):
+                fields, payload = unpack_envelope(value)
+                fields = {**fields, "payload": payload}
+            else:
+                fields = json.loads(value)
+            return cls(**{k: v for k, v in fields.items() if k in cls.FIELDS})
+        except (KeyError, TypeError, AttributeError) as err:
+            raise ValueError(f"Invalid outbound message: {err}") from err
 
     @property
-    def endpoint_scheme(self):
-        return self._endpoint_scheme
+    def payload(self) -> bytes:
+        """Return the decoded payload, raise InvalidPayloadError if it is not."""
+        if self._payload is None:
+            payload = self._encoded_payload
+            try:
+                if isinstance(payload, str):
+                    payload = base64.urlsafe_b64decode(payload)
+                if self._content_encoding:
+                    payload = decompress_payload(payload, self._content_encoding)
+            except (ValueError, zlib.error) as err:
+                raise InvalidPayloadError(
+                    f"Invalid outbound message payload: {err}"
+                ) from err
+            self._payload = payload
+            self._encoded_payload = None
+        return self._payload
+
+    @property
+    def endpoint_scheme(self) -> Optional[str]:
+        return parse_endpoint_scheme(self.service.url) if self.service else None
+
+    def expand(self) -> List["OutboundPayload"]:
+        """Return one message per target of a fan-out message, or [self]."""
+        if not self.targets:
+            return [self]
+        messages = []
+        for target in self.targets:
+            message = object.__new__(OutboundPayload)
+            message.service = target.service
+            message.headers = {**self.headers, **target.headers}
+            message.retries = self.retries
+            message.metadata = self.metadata
+            message.targets = []
+            message.retry_id = None
+            message.first_failed_at = self.first_failed_at
+            # Decoded once, shared by all targets
+            message._payload = self.payload
+            message._encoded_payload = None
+            message._content_encoding = None
+            messages.append(message)
+        return messages
@@ -1,20 +1,37 @@
 """Redis Outbound Delivery Service."""
 import aiohttp
 import asyncio
-import base64
 import logging
 import signal
-import json
 
 from contextlib import suppress
-from redis.asyncio import RedisCluster
 from redis.exceptions import RedisError, RedisClusterException
 from time import time
 from os import getenv
+from typing import Optional
+from uuid import uuid4
 
+from redis_queue.v1_0.client import (
+    create_redis_client,
+    ping_redis,
+    redis_client_options_from_env,
+)
+from redis_queue.v1_0.envelope import (
+    ENVELOPE_JSON,
+    encode_envelope,
+    is_binary_envelope,
+    pack_envelope,
+    unpack_envelope,
+)
+from redis_queue.v1_0.utils import (
+    recipients_from_packed_message,
+    get_outbound_shard_topic,
+    get_outbound_shard_topics,
+)
 from status_endpoint.status_endpoints import start_status_endpoints_server
 
-from . import OutboundPayload
+from . import InvalidPayloadError, OutboundPayload
+from .retry import DEAD_LETTER, RetryPolicies, parse_retry_after
 
 logging.basicConfig(
     format="%(asctime)s | %(levelname)s: %(message)s",
@@ -22,38 +39,220 @@ logging.basicConfig(
 )
 
 
+class WSConnectionPool:
+    """Persistent outbound WS connections, one per endpoint."""
+
+    def __init__(
+        self,
+        idle_timeout_s: float = 60,
+        heartbeat_s: float = 30,
+        connect_timeout_s: float = 10,
+    ):
+        """Initialize WSConnectionPool."""
+        self.idle_timeout_s = idle_timeout_s
+        self.heartbeat_s = heartbeat_s
+        self.connect_timeout_s = connect_timeout_s
+        self.client_session = None
+        self.connections = {}
+        self.last_used = {}
+        self.readers = {}
+        self.connect_locks = {}
+
+    def get_client_session(self) -> aiohttp.ClientSession:
+        """Return the session shared by all pooled connections."""
+        if not self.client_session or self.client_session.closed:
+            self.client_session = aiohttp.ClientSession(
+                cookie_jar=aiohttp.DummyCookieJar(), trust_env=True
+            )
+        return self.client_session
+
+    async def get_connection(self, endpoint: str, headers: dict):
+        """Return an open connection to endpoint, connecting if needed."""
+        ws = self.connections.get(endpoint)
+        if ws and not ws.closed:
+            return ws
+        # Shard consumers share the pool, only one of them connects an endpoint
+        lock = self.connect_locks.setdefault(endpoint, asyncio.Lock())
+        async with lock:
+            ws = self.connections.get(endpoint)
+            if ws and not ws.closed:
+                return ws
+            ws = await self.get_client_session().ws_connect(
+                endpoint,
+                headers=headers,
+                heartbeat=self.heartbeat_s,
+                timeout=self.connect_timeout_s,
+            )
+            self.connections[endpoint] = ws
+            # Incoming frames must be read for heartbeat pongs and closes to register
+            self.readers[endpoint] = asyncio.ensure_future(self.drain(endpoint, ws))
+            return ws
+
+    async def drain(self, endpoint: str, ws):
+        """Discard frames sent by the endpoint until the connection closes."""
+        try:
+            async for _ in ws:
+                pass
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        finally:
+            if self.connections.get(endpoint) is ws:
+                self.connections.pop(endpoint, None)
+                self.last_used.pop(endpoint, None)
+                self.readers.pop(endpoint, None)
+
+    async def send(self, endpoint: str, payload, headers: dict) -> bool:
+        """Send payload to endpoint over a pooled connection.
+
+        A failed send on a reused connection is retried once on a new one.
+        Returns False if the message could not be sent.
+        """
+        for _ in range(2):
+            ws = self.connections.get(endpoint)
+            reused = bool(ws and not ws.closed)
+            try:
+                ws = await self.get_connection(endpoint, headers)
+                if isinstance(payload, bytes):
+                    await ws.send_bytes(payload)
+                else:
+                    await ws.send_str(payload)
+                self.last_used[endpoint] = time()
+                return True
+            except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as err:
+                logging.warning(f"WS connection to {endpoint} failed: {err!r}")
+                await self.close_connection(endpoint)
+                if not reused:
+                    break
+        return False
+
+    async def close_connection(self, endpoint: str):
+        """Close and forget the connection to endpoint."""
+        ws = self.connections.pop(endpoint, None)
+        self.last_used.pop(endpoint, None)
+        reader = self.readers.pop(endpoint, None)
+        if reader:
+            reader.cancel()
+        if ws and not ws.closed:
+            with suppress(aiohttp.ClientError, asyncio.TimeoutError, ConnectionError):
+                await ws.close()
+
+    async def close_idle(self):
+        """Close connections unused for longer than idle_timeout_s."""
+        cutoff = time() - self.idle_timeout_s
+        for endpoint, last_used in list(self.last_used.items()):
+            if last_used < cutoff:
+                await self.close_connection(endpoint)
+
+    async def close(self):
+        """Close all connections and the shared session."""
+        for endpoint in list(self.connections):
+            await self.close_connection(endpoint)
+        self.connect_locks.clear()
+        if self.client_session and not self.client_session.closed:
+            await self.client_session.close()
+
+
 class Deliverer:
     """Outbound http delivery handler."""
 
     running = False
     ready = False
 
-    def __init__(self, connection_url: str, topic: str, retry_topic: str):
-        """Initialize RedisHandler."""
-        self.retry_interval = 5
-        self.retry_backoff = 0.25
+    def __init__(
+        self,
+        connection_url: str,
+        topic: str,
+        retry_topic: str,
+        ws_session_topic: str = None,
+        envelope_format: str = ENVELOPE_JSON,
+        retry_policies: RetryPolicies = None,
+        dead_letter_topic: str = None,
+        outbound_shards: int = 1,
+        retry_shards: int = None,
+        redis_options: dict = None,
+    ):
+        """Initialize RedisHandler.
+
+        When ws_session_topic is set, messages for recipients with a live WS
+        session held by a relay are pushed to that relay instead. Retried
+        messages are stored once in envelope_format, under a key expiring
+        retry_payload_ttl_s after their next retry is due, and queued for
+        retry as small references. Messages that are not retried any further
+        are pushed to dead_letter_topic, or dropped if it is not set.
+
+        With outbound_shards above 1, each outbound shard topic is consumed
+        on its own, along with topic itself for retries and messages queued
+        before sharding. Retries are likewise spread over retry_shards retry
+        topics by endpoint, as many as outbound shards by default, each
+        scanned on its own. Due retries go back to the outbound shard of the
+        same index if the shard counts match, or to topic otherwise.
+
+        redis_options are passed on to create_redis_client.
+        """
         self.outbound_topic = topic
+        self.outbound_topics = list(
+            dict.fromkeys([topic, *get_outbound_shard_topics(topic, outbound_shards)])
+        )
         self.retry_topic = retry_topic
+        self.retry_shards = outbound_shards if retry_shards is None else retry_shards
+        retry_topics = get_outbound_shard_topics(retry_topic, self.retry_shards)
+        if self.retry_shards == outbound_shards:
+            retry_outbound_topics = get_outbound_shard_topics(topic, outbound_shards)
+        else:
+            retry_outbound_topics = [topic] * len(retry_topics)
+        # Retries queued before sharding
+        self.retry_topic_pairs = dict.fromkeys([(retry_topic, topic)])
+        self.retry_topic_pairs.update(
+            dict.fromkeys(zip(retry_topics, retry_outbound_topics))
+        )
+        self.retry_policies = retry_policies or RetryPolicies()
+        self.dead_letter_topic = dead_letter_topic
+        self.retry_payload_ttl_s = 3600
+        self.ws_session_topic = ws_session_topic
         self.redis = None
         self.retry_timedelay_s = 1
         self.connection_url = connection_url
+        self.redis_options = redis_options or {}
+        self.envelope_format = envelope_format
+        self.ws_pool = WSConnectionPool()
+        self.metrics = {
+            "delivered": 0,
+            "handed_to_ws_session": 0,
+            "failed": 0,
+            "retried": 0,
+            "dead_lettered": 0,
+            "expired": 0,
+        }
+        self.response_statuses = {}
+
+    def get_metrics(self) -> dict:
+        """Return delivery counters and the counts of failed response statuses."""
+        return {**self.metrics, "response_statuses": dict(self.response_statuses)}
 
     async def run(self):
         """Run the service."""
         try:
-            self.redis = RedisCluster.from_url(url=self.connection_url)
+            self.redis = create_redis_client(self.connection_url, **self.redis_options)
             self.ready = True
             self.running = True
-            await asyncio.gather(self.process_delivery(), self.process_retries())
+            await asyncio.gather(
+                *[self.process_delivery(topic) for topic in self.outbound_topics],
+                *[
+                    self.process_retries(retry_topic, outbound_topic)
+                    for retry_topic, outbound_topic in self.retry_topic_pairs
+                ],
+            )
         except (RedisError, RedisClusterException) as err:
             self.ready = False
             self.running = False
             logging.error(f"Unable to connect to Redis, {err}")
+        finally:
+            await self.ws_pool.close()
 
     async def is_running(self) -> bool:
         """Check if delivery service agent is running properly."""
         try:
-            await self.redis.ping(target_nodes=RedisCluster.PRIMARIES)
+            await ping_redis(self.redis)
             if self.running:
                 return True
             else:
@@ -61,106 +260,321 @@ class Deliverer:
         except (RedisError, RedisClusterException):
             return False
 
-    async def process_delivery(self):
-        """Process delivery."""
-        client_session = None
-        try:
-            while self.running:
-                msg_received = False
-                while not msg_received:
-                    try:
-                        msg = await self.redis.blpop(self.outbound_topic, 0.2)
-                        msg_received = True
-                    except (RedisError, RedisClusterException) as err:
-                        await asyncio.sleep(1)
-                        logging.exception(
-                            f"Unexpected redis client exception (blpop): {err}"
-                        )
+    async def process_delivery(self, topic: str = None):
+        """Process delivery of messages queued on topic, the outbound topic by default."""
+        topic = topic or self.outbound_topic
+        while self.running:
+            msg_received = False
+            while not msg_received:
+                try:
+                    msg = await self.redis.blpop(topic, 0.2)
+                    msg_received = True
+                except (RedisError, RedisClusterException) as err:
+                    await asyncio.sleep(1)
+                    logging.exception(
+                        f"Unexpected redis client exception (blpop): {err}"
+                    )
+            await self.ws_pool.close_idle()
+            if not msg:
+                await asyncio.sleep(0.2)
+                continue
+            raw_msg = msg[1]
+            if is_binary_envelope(raw_msg):
+                raw_msg, msg = await self.resolve_retry(raw_msg)
                 if not msg:
-                    await asyncio.sleep(0.2)
                     continue
-                msg = OutboundPayload.from_bytes(msg[1])
-                headers = msg.headers
-                endpoint = msg.service.url
-                payload = msg.payload
-                endpoint_scheme = msg.endpoint_scheme
-                if endpoint_scheme == "http" or endpoint_scheme == "https":
-                    session_args = {
-                        "cookie_jar": aiohttp.DummyCookieJar(),
-                        "connector": aiohttp.TCPConnector(limit=200, limit_per_host=50),
-                        "trust_env": True,
-                    }
-                    client_session = aiohttp.ClientSession(**session_args)
-                    failed = False
-                    try:
-                        response = await client_session.post(
-                            endpoint, data=payload, headers=headers, timeout=10
-                        )
-                        if response.status < 200 or response.status >= 300:
-                            logging.error(
-                                f"Invalid response : {response.status} - "
-                                f"{response.reason}"
-                            )
-                            failed = True
-                    except aiohttp.ClientError:
-                        failed = True
-                    except asyncio.TimeoutError:
-                        failed = True
-                    finally:
-                        await client_session.close()
-                    if failed:
-                        logging.exception(f"Delivery failed for {endpoint}")
-                        retries = msg.retries or 0
-                        if retries < 5:
-                            await self.add_retry(
-                                {
-                                    "service": {"url": endpoint},
-                                    "headers": headers,
-                                    "payload": base64.urlsafe_b64encode(
-                                        payload
-                                    ).decode(),
-                                    "retries": retries + 1,
-                                }
-                            )
-                        else:
-                            logging.error(f"Exceeded max retries for {str(endpoint)}")
-                    else:
-                        logging.info(f"Message dispatched to {endpoint}")
-                elif endpoint_scheme == "ws":
-                    session_args = {
-                        "cookie_jar": aiohttp.DummyCookieJar(),
-                        "trust_env": True,
-                    }
-                    client_session = aiohttp.ClientSession(**session_args)
-                    async with client_session.ws_connect(
-                        endpoint, headers=headers
-                    ) as ws:
-                        if isinstance(payload, bytes):
-                            await ws.send_bytes(payload)
-                        else:
-                            await ws.send_str(payload)
-                        logging.info(f"WS message dispatched to {endpoint}")
-                else:
-                    logging.error(f"Unsupported scheme: {endpoint_scheme}")
-        finally:
-            if client_session and not client_session.closed:
+            else:
+                try:
+                    msg = OutboundPayload.from_bytes(raw_msg)
+                except ValueError as err:
+                    logging.error(f"Dead lettering unreadable message: {err}")
+                    await self.dead_letter_raw(raw_msg, "invalid_message")
+                    continue
+            try:
+                if await self.deliver_via_ws_session(msg, raw_msg):
+                    self.metrics["handed_to_ws_session"] += 1
+                    continue
+                for target_msg in msg.expand():
+                    await self.deliver(target_msg)
+            except InvalidPayloadError as err:
+                # The payload is decoded before anything is sent
+                logging.error(f"Dead lettering unreadable message: {err}")
+                await self.dead_letter_raw(raw_msg, "invalid_message", msg.retry_id)
+
+    async def deliver(self, msg: OutboundPayload):
+        """Deliver msg to its endpoint, scheduling a retry on failure."""
+        headers = msg.headers
+        endpoint = msg.service.url
+        payload = msg.payload
+        endpoint_scheme = msg.endpoint_scheme
+        if endpoint_scheme == "http" or endpoint_scheme == "https":
+            session_args = {
+                "cookie_jar": aiohttp.DummyCookieJar(),
+                "connector": aiohttp.TCPConnector(limit=200, limit_per_host=50),
+                "trust_env": True,
+            }
+            client_session = aiohttp.ClientSession(**session_args)
+            failed = False
+            status = None
+            retry_after = None
+            try:
+                response = await client_session.post(
+                    endpoint, data=payload, headers=headers, timeout=10
+                )
+                if response.status < 200 or response.status >= 300:
+                    logging.error(
+                        f"Invalid response : {response.status} - {response.reason}"
+                    )
+                    failed = True
+                    status = response.status
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            except aiohttp.ClientError:
+                failed = True
+            except asyncio.TimeoutError:
+                failed = True
+            finally:
                 await client_session.close()
+            if failed:
+                logging.exception(f"Delivery failed for {endpoint}")
+                await self.retry_delivery(msg, status, retry_after)
+            else:
+                logging.info(f"Message dispatched to {endpoint}")
+                self.metrics["delivered"] += 1
+        elif endpoint_scheme == "ws":
+            if await self.ws_pool.send(endpoint, payload, headers):
+                logging.info(f"WS message dispatched to {endpoint}")
+                self.metrics["delivered"] += 1
+            else:
+                logging.error(f"WS delivery failed for {endpoint}")
+                await self.retry_delivery(msg)
+        else:
+            logging.error(f"Unsupported scheme: {endpoint_scheme}")
+            await self.dead_letter(msg, "unsupported_scheme")
+
+    def retry_payload_key(self, retry_id: str) -> str:
+        """Return the key holding the message of a retry reference."""
+        return f"{self.retry_topic}_payload_{retry_id}"
+
+    async def resolve_retry(self, raw_msg: bytes):
+        """Return the stored message and OutboundPayload for a queued message.
+
+        raw_msg is either a binary envelope or a retry reference, whose
+        message is read from its payload key. The OutboundPayload is None if
+        that key has expired or the message is unreadable, the reference or
+        message is then dead lettered.
+        """
+        try:
+            header, _ = unpack_envelope(raw_msg)
+            retry_id = header.get("retry_id")
+            if not retry_id:
+                return raw_msg, OutboundPayload.from_bytes(raw_msg)
+        except (ValueError, AttributeError) as err:
+            logging.error(f"Dead lettering unreadable message: {err}")
+            await self.dead_letter_raw(raw_msg, "invalid_message")
+            return raw_msg, None
+        while True:
+            try:
+                stored_msg = await self.redis.get(self.retry_payload_key(retry_id))
+                break
+            except (RedisError, RedisClusterException) as err:
+                await asyncio.sleep(1)
+                logging.exception(f"Unexpected redis client exception (get): {err}")
+        if not stored_msg:
+            logging.error(f"Retry message {retry_id} expired before delivery")
+            self.metrics["expired"] += 1
+            await self.dead_letter_raw(raw_msg, "expired", retry_id)
+            return raw_msg, None
+        try:
+            msg = OutboundPayload.from_bytes(stored_msg)
+        except ValueError as err:
+            logging.error(f"Dead lettering unreadable retry {retry_id}: {err}")
+            await self.dead_letter_raw(stored_msg, "invalid_message", retry_id)
+            return stored_msg, None
+        msg.retries = header.get("retries") or 0
+        msg.retry_id = retry_id
+        return stored_msg, msg
+
+    async def retry_delivery(
+        self,
+        msg: OutboundPayload,
+        status: Optional[int] = None,
+        retry_after: Optional[float] = None,
+    ):
+        """Schedule a failed delivery for retry as per its retry policy.
 
-    async def add_retry(self, message: dict):
-        """Add undelivered message for future retries."""
+        status and retry_after are the response status and Retry-After delay,
+        if the endpoint responded. The message is stored on its first failure,
+        later attempts only queue a new reference to it. It is dead lettered
+        once the policy gives up or if the status is not worth retrying.
+        """
+        endpoint = msg.service.url
+        retries = msg.retries or 0
+        policy = self.retry_policies.for_endpoint(endpoint)
+        now = time()
+        self.metrics["failed"] += 1
+        if status is not None:
+            self.response_statuses[status] = self.response_statuses.get(status, 0) + 1
+            if policy.classify_status(status) == DEAD_LETTER:
+                logging.error(f"Delivery to {endpoint} rejected with {status}")
+                await self.dead_letter(msg, f"http_status_{status}")
+                return
+        if retries >= policy.max_retries:
+            logging.error(f"Exceeded max retries for {str(endpoint)}")
+            await self.dead_letter(msg, "max_retries")
+            return
+        if policy.max_age_s and now - (msg.first_failed_at or now) >= policy.max_age_s:
+            logging.error(f"Exceeded max retry age for {str(endpoint)}")
+            await self.dead_letter(msg, "max_age")
+            return
+        delay_s = policy.delay(retries + 1, retry_after)
+        # The stored message must outlive the retry, a Retry-After delay is
+        # not accounted for by the policy horizon
+        payload_ttl_s = delay_s + self.retry_payload_ttl_s
+        if not msg.retry_id:
+            msg.retry_id = uuid4().hex
+            msg.first_failed_at = now
+            await self.store_retry_payload(
+                msg,
+                max(policy.horizon_s() + self.retry_payload_ttl_s, payload_ttl_s),
+            )
+        else:
+            await self.expire_retry_payload(msg.retry_id, payload_ttl_s)
+        await self.add_retry(
+            msg.retry_id,
+            retries + 1,
+            delay_s,
+            get_outbound_shard_topic(self.retry_topic, endpoint, self.retry_shards),
+        )
+        self.metrics["retried"] += 1
+
+    async def dead_letter(self, msg: OutboundPayload, reason: str):
+        """Push msg to the dead letter list with the reason it was given up on."""
+        await self.push_dead_letter(
+            {
+                "service": {"url": msg.service.url},
+                "headers": msg.headers,
+                "retries": msg.retries,
+                "first_failed_at": msg.first_failed_at,
+                "dead_lettered_at": time(),
+                "reason": reason,
+            },
+            msg.payload,
+        )
+        if msg.retry_id:
+            await self.delete_retry_payload(msg.retry_id)
+
+    async def dead_letter_raw(
+        self, raw_msg: bytes, reason: str, retry_id: Optional[str] = None
+    ):
+        """Push a message that could not be delivered as is to the dead letters.
+
+        raw_msg is kept as the payload of the dead letter, with the retry_id
+        of the retry reference it was read for, if any.
+        """
+        header = {"dead_lettered_at": time(), "reason": reason}
+        if retry_id:
+            header["retry_id"] = retry_id
+        await self.push_dead_letter(header, raw_msg)
+        if retry_id:
+            await self.delete_retry_payload(retry_id)
+
+    async def push_dead_letter(self, header: dict, payload: bytes):
+        """Push a dead letter envelope to the dead letter list."""
+        self.metrics["dead_lettered"] += 1
+        if not self.dead_letter_topic:
+            return
+        dead_msg = encode_envelope(header, payload, self.envelope_format)
+        rpush_sent = False
+        while not rpush_sent:
+            try:
+                await self.redis.rpush(self.dead_letter_topic, dead_msg)
+                rpush_sent = True
+            except (RedisError, RedisClusterException) as err:
+                await asyncio.sleep(1)
+                logging.exception(f"Unexpected redis client exception (rpush): {err}")
+
+    async def delete_retry_payload(self, retry_id: str):
+        """Delete the stored message of a retry reference."""
+        try:
+            await self.redis.delete(self.retry_payload_key(retry_id))
+        except (RedisError, RedisClusterException) as err:
+            # Left to expire
+            logging.exception(f"Unexpected redis client exception (delete): {err}")
+
+    async def deliver_via_ws_session(self, msg: OutboundPayload, raw_msg: bytes):
+        """Hand msg to the relay holding a live WS session for its recipient.
+
+        Returns True if the message was handed over.
+        """
+        if not self.ws_session_topic:
+            return False
+        try:
+            recip_keys = recipients_from_packed_message(msg.payload)
+        except (ValueError, KeyError, TypeError):
+            # Not a packed DIDComm message, e.g. a webhook
+            return False
+        try:
+            for recip_key in recip_keys:
+                session_topic = await self.redis.get(
+                    f"{self.ws_session_topic}_{recip_key}"
+                )
+                if session_topic:
+                    await self.redis.rpush(session_topic.decode(), raw_msg)
+                    logging.info(f"Message handed to WS session for {recip_key}")
+                    return True
+        except (RedisError, RedisClusterException) as err:
+            logging.exception(f"Unexpected redis client exception: {err}")
+        return False
+
+    async def store_retry_payload(self, msg: OutboundPayload, ttl_s: float):
+        """Store msg under the payload key of its retry reference."""
+        stored_msg = encode_envelope(
+            {
+                "service": {"url": msg.service.url},
+                "headers": msg.headers,
+                "first_failed_at": msg.first_failed_at,
+            },
+            msg.payload,
+            self.envelope_format,
+        )
+        set_sent = False
+        while not set_sent:
+            try:
+                await self.redis.set(
+                    self.retry_payload_key(msg.retry_id),
+                    stored_msg,
+                    ex=int(ttl_s),
+                )
+                set_sent = True
+            except (RedisError, RedisClusterException) as err:
+                await asyncio.sleep(1)
+                logging.exception(f"Unexpected redis client exception (set): {err}")
+
+    async def expire_retry_payload(self, retry_id: str, ttl_s: float):
+        """Expire the stored message of a retry reference in ttl_s seconds."""
+        expire_sent = False
+        while not expire_sent:
+            try:
+                await self.redis.expire(self.retry_payload_key(retry_id), int(ttl_s))
+                expire_sent = True
+            except (RedisError, RedisClusterException) as err:
+                await asyncio.sleep(1)
+                logging.exception(f"Unexpected redis client exception (expire): {err}")
+
+    async def add_retry(
+        self, retry_id: str, retries: int, delay_s: float, retry_topic: str = None
+    ):
+        """Add a reference to an undelivered message, due in delay_s seconds."""
+        retry_topic = retry_topic or self.retry_topic
+        retry_time = time() + delay_s
         zadd_sent = False
         while not zadd_sent:
             try:
-                wait_interval = pow(
-                    self.retry_interval,
-                    1 + (self.retry_backoff * (message["retries"] - 1)),
-                )
-                retry_time = int(time() + wait_interval)
-                retry_msg = str.encode(
-                    json.dumps(message),
+                retry_msg = pack_envelope(
+                    {"retry_id": retry_id, "retries": retries}, b""
                 )
                 await self.redis.zadd(
-                    self.retry_topic,
+                    retry_topic,
                     {retry_msg: retry_time},
                 )
                 zadd_sent = True
@@ -168,15 +582,22 @@ class Deliverer:
                 await asyncio.sleep(1)
                 logging.exception(f"Unexpected redis client exception (zadd): {err}")
 
-    async def process_retries(self):
-        """Process retries."""
+    async def process_retries(
+        self, retry_topic: str = None, outbound_topic: str = None
+    ):
+        """Move due retries from retry_topic to outbound_topic.
+
+        The retry and outbound topics are used by default.
+        """
+        retry_topic = retry_topic or self.retry_topic
+        outbound_topic = outbound_topic or self.outbound_topic
         while self.running:
             zrangebyscore_rec = False
             while not zrangebyscore_rec:
-                max_score = int(time())
+                max_score = time()
                 try:
                     rows = await self.redis.zrangebyscore(
-                        name=self.retry_topic,
+                        name=retry_topic,
                         min=0,
                         max=max_score,
                         start=0,
@@ -194,7 +615,7 @@ class Deliverer:
                     while not zrem_rec:
                         try:
                             count = await self.redis.zrem(
-                                self.retry_topic,
+                                retry_topic,
                                 message,
                             )
                             zrem_rec = True
@@ -209,7 +630,7 @@ class Deliverer:
                     msg_sent = False
                     while not msg_sent:
                         try:
-                            await self.redis.rpush(self.outbound_topic, message)
+                            await self.redis.rpush(outbound_topic, message)
                             msg_sent = True
                         except (RedisError, RedisClusterException) as err:
                             await asyncio.sleep(1)
@@ -227,12 +648,32 @@ async def main():
     STATUS_ENDPOINT_HOST = getenv("STATUS_ENDPOINT_HOST")
     STATUS_ENDPOINT_PORT = getenv("STATUS_ENDPOINT_PORT")
     STATUS_ENDPOINT_API_KEY = getenv("STATUS_ENDPOINT_API_KEY")
+    WS_SESSION_DELIVERY = getenv("WS_SESSION_DELIVERY", "false").lower() == "true"
+    ENVELOPE_FORMAT = getenv("ENVELOPE_FORMAT", ENVELOPE_JSON)
+    RETRY_POLICIES = getenv("RETRY_POLICIES")
+    OUTBOUND_SHARDS = int(getenv("OUTBOUND_SHARDS", "1"))
+    RETRY_SHARDS = int(getenv("RETRY_SHARDS", str(OUTBOUND_SHARDS)))
     OUTBOUND_TOPIC = f"{TOPIC_PREFIX}_outbound"
     OUTBOUND_RETRY_TOPIC = f"{TOPIC_PREFIX}_outbound_retry"
+    OUTBOUND_DEAD_LETTER_TOPIC = f"{TOPIC_PREFIX}_outbound_dead_letter"
     tasks = []
     if not REDIS_SERVER_URL:
         raise SystemExit("No Redis host/connection provided.")
-    handler = Deliverer(REDIS_SERVER_URL, OUTBOUND_TOPIC, OUTBOUND_RETRY_TOPIC)
+    WS_SESSION_TOPIC = f"{TOPIC_PREFIX}_ws_session" if WS_SESSION_DELIVERY else None
+    handler = Deliverer(
+        REDIS_SERVER_URL,
+        OUTBOUND_TOPIC,
+        OUTBOUND_RETRY_TOPIC,
+        ws_session_topic=WS_SESSION_TOPIC,
+        envelope_format=ENVELOPE_FORMAT,
+        retry_policies=(
+            RetryPolicies.parse_raw(RETRY_POLICIES) if RETRY_POLICIES else None
+        ),
+        dead_letter_topic=OUTBOUND_DEAD_LETTER_TOPIC,
+        outbound_shards=OUTBOUND_SHARDS,
+        retry_shards=RETRY_SHARDS,
+        redis_options=redis_client_options_from_env(),
+    )
     logging.info(
         "Starting Redis outbound message delivery agent with args: "
         f"{REDIS_SERVER_URL}, {TOPIC_PREFIX}, {OUTBOUND_TOPIC}, {OUTBOUND_RETRY_TOPIC}"
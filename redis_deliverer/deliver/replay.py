@@ -0,0 +1,93 @@
+"""Move dead lettered outbound messages back to the outbound queue.
+
+    python -m redis_deliverer.deliver.replay [--reason REASON] [--limit N]
+"""
+import argparse
+import asyncio
+import logging
+
+from os import getenv
+
+from redis_queue.v1_0.client import (
+    RedisClient,
+    create_redis_client,
+    redis_client_options_from_env,
+)
+from redis_queue.v1_0.envelope import (
+    ENVELOPE_BINARY,
+    ENVELOPE_JSON,
+    decode_envelope,
+    encode_envelope,
+    is_binary_envelope,
+)
+
+
+async def replay_dead_letters(
+    redis: RedisClient,
+    dead_letter_topic: str,
+    outbound_topic: str,
+    reason: str = None,
+    limit: int = 0,
+) -> int:
+    """Queue dead lettered messages for delivery again, oldest first.
+
+    Only messages dead lettered for reason are replayed if it is set, others
+    are moved to the end of the dead letter list. At most limit messages are
+    replayed if it is set. Returns the number of replayed messages.
+
+    The two lists may be on different cluster nodes, so a message is pushed to
+    outbound_topic before it is removed from dead_letter_topic: replay is at
+    least once, a message is queued twice if it stops in between. Only one
+    replay should run at a time.
+    """
+    replayed = 0
+    for _ in range(await redis.llen(dead_letter_topic)):
+        if limit and replayed >= limit:
+            break
+        dead_msg = await redis.lindex(dead_letter_topic, 0)
+        if dead_msg is None:
+            break
+        fields = decode_envelope(dead_msg)
+        # Unreadable messages are dead lettered without a service to send to
+        if (reason and fields.get("reason") != reason) or "service" not in fields:
+            await redis.lmove(dead_letter_topic, dead_letter_topic, "LEFT", "RIGHT")
+            continue
+        message = encode_envelope(
+            {"service": fields["service"], "headers": fields.get("headers", {})},
+            fields["payload"],
+            ENVELOPE_BINARY if is_binary_envelope(dead_msg) else ENVELOPE_JSON,
+        )
+        await redis.rpush(outbound_topic, message)
+        await redis.lrem(dead_letter_topic, 1, dead_msg)
+        replayed += 1
+    return replayed
+
+
+async def main(args=None):
+    """Replay dead lettered messages."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--reason", help="only replay messages dead lettered for this")
+    parser.add_argument("--limit", type=int, default=0, help="replay at most this many")
+    args = parser.parse_args(args)
+    REDIS_SERVER_URL = getenv("REDIS_SERVER_URL")
+    TOPIC_PREFIX = getenv("TOPIC_PREFIX", "acapy")
+    if not REDIS_SERVER_URL:
+        raise SystemExit("No Redis host/connection provided.")
+    redis = create_redis_client(REDIS_SERVER_URL, **redis_client_options_from_env())
+    replayed = await replay_dead_letters(
+        redis,
+        f"{TOPIC_PREFIX}_outbound_dead_letter",
+        f"{TOPIC_PREFIX}_outbound",
+        reason=args.reason,
+        limit=args.limit,
+    )
+    logging.info(f"Replayed {replayed} dead lettered messages")
+    await redis.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s | %(levelname)s: %(message)s",
+        level=logging.INFO,
+    )
+    asyncio.run(main())
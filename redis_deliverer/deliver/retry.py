@@ -0,0 +1,95 @@
+"""Retry policies for failed deliveries."""
+import random
+from email.utils import parsedate_to_datetime
+from time import time
+from typing import List, Mapping, Optional
+
+from pydantic import BaseModel
+
+from . import parse_endpoint_scheme
+
+RETRY = "retry"
+DEAD_LETTER = "dead_letter"
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Return the delay in seconds of a Retry-After header value."""
+    if not isinstance(value, str):
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = parsedate_to_datetime(value).timestamp() - time()
+        except (TypeError, ValueError):
+            return None
+    return max(delay, 0)
+
+
+class RetryPolicy(BaseModel):
+    """How often and for how long a failed delivery is retried.
+
+    The n-th retry is due base_delay_s * multiplier ** (n - 1) seconds after
+    the failure, capped at max_delay_s and spread by +/- jitter of the delay so
+    messages that failed together are not retried together. A message is dead
+    lettered after max_retries retries, or once max_age_s have passed since its
+    first failure if set.
+
+    A delivery answered with a 4xx status is dead lettered right away, unless
+    the status is in retry_statuses. With honor_retry_after, a retry is not
+    due before the delay the endpoint asked for in Retry-After.
+    """
+
+    base_delay_s: float = 5
+    multiplier: float = 1.5
+    max_delay_s: float = 3600
+    jitter: float = 0.2
+    max_retries: int = 5
+    max_age_s: float = 0
+    retry_statuses: List[int] = [408, 425, 429]
+    honor_retry_after: bool = True
+
+    def classify_status(self, status: int) -> str:
+        """Return whether a delivery answered with status is retried."""
+        if 400 <= status < 500 and status not in self.retry_statuses:
+            return DEAD_LETTER
+        return RETRY
+
+    def delay(self, retries: int, retry_after: Optional[float] = None) -> float:
+        """Return the delay in seconds before the retries-th retry."""
+        if self.honor_retry_after and retry_after is not None:
+            return max(min(retry_after, self.max_delay_s), self.delay(retries))
+        delay = min(
+            self.base_delay_s * self.multiplier ** max(retries - 1, 0),
+            self.max_delay_s,
+        )
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(delay, 0)
+
+    def horizon_s(self) -> float:
+        """Return the longest time from a first failure to the last retry."""
+        horizon = sum(
+            min(self.base_delay_s * self.multiplier**retry, self.max_delay_s)
+            for retry in range(self.max_retries)
+        ) * (1 + self.jitter)
+        return min(horizon, self.max_age_s) if self.max_age_s else horizon
+
+
+class RetryPolicies(BaseModel):
+    """Retry policies by endpoint url prefix and by scheme.
+
+    The policy of the longest matching endpoint prefix is used, then the one of
+    the endpoint scheme, then default.
+    """
+
+    default: RetryPolicy = RetryPolicy()
+    schemes: Mapping[str, RetryPolicy] = {}
+    endpoints: Mapping[str, RetryPolicy] = {}
+
+    def for_endpoint(self, url: str) -> RetryPolicy:
+        """Return the retry policy for url."""
+        prefixes = [prefix for prefix in self.endpoints if url.startswith(prefix)]
+        if prefixes:
+            return self.endpoints[max(prefixes, key=len)]
+        return self.schemes.get(parse_endpoint_scheme(url), self.default)
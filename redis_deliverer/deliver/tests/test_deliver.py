@@ -6,14 +6,19 @@ import os
 import string
 import uvicorn
 import json
+import zlib
 
+from email.utils import formatdate
 from asynctest import TestCase as AsyncTestCase, mock as async_mock, PropertyMock
 from aiohttp import web
 from pathlib import Path
 from time import time
 
 from .. import deliver as test_module
+from .. import replay as test_replay
 from ..deliver import Deliverer, main
+from ..retry import RetryPolicies, RetryPolicy, parse_retry_after
+from redis_queue.v1_0.envelope import decode_envelope, pack_envelope, unpack_envelope
 
 PAYLOAD_B64 = """
     eyJwcm90ZWN0ZWQiOiAiZXlKbGJtTWlPaUFpZUdOb1lXTm9ZVEl3Y0c5c2VURXpNRFZmYVdWM
@@ -262,10 +267,13 @@ class TestRedisHandler(AsyncTestCase):
             Deliverer, "process_delivery", async_mock.CoroutineMock()
         ), async_mock.patch.object(
             Deliverer, "process_retries", async_mock.CoroutineMock()
-        ):
+        ), async_mock.patch.object(
+            test_module.WSConnectionPool, "close", async_mock.CoroutineMock()
+        ) as mock_close:
             Deliverer.running = False
             service = Deliverer("test", "test_topic", "test_retry_topic")
             await service.run()
+            mock_close.assert_called_once()
 
         with async_mock.patch.object(
             redis.asyncio.RedisCluster,
@@ -280,6 +288,57 @@ class TestRedisHandler(AsyncTestCase):
             service = Deliverer("test", "test_topic", "test_retry_topic")
             await service.run()
 
+    async def test_run_shards(self):
+        with async_mock.patch.object(
+            redis.asyncio.RedisCluster,
+            "from_url",
+            async_mock.MagicMock(),
+        ), async_mock.patch.object(
+            Deliverer, "process_delivery", async_mock.CoroutineMock()
+        ) as mock_process_delivery, async_mock.patch.object(
+            Deliverer, "process_retries", async_mock.CoroutineMock()
+        ) as mock_process_retries:
+            service = Deliverer(
+                "test", "test_topic", "test_retry_topic", outbound_shards=3
+            )
+            await service.run()
+            assert [call[0][0] for call in mock_process_delivery.call_args_list] == [
+                "test_topic",
+                "test_topic_{0}",
+                "test_topic_{1}",
+                "test_topic_{2}",
+            ]
+            assert [call[0] for call in mock_process_retries.call_args_list] == [
+                ("test_retry_topic", "test_topic"),
+                ("test_retry_topic_{0}", "test_topic_{0}"),
+                ("test_retry_topic_{1}", "test_topic_{1}"),
+                ("test_retry_topic_{2}", "test_topic_{2}"),
+            ]
+            mock_process_retries.reset_mock()
+            service = Deliverer(
+                "test",
+                "test_topic",
+                "test_retry_topic",
+                outbound_shards=3,
+                retry_shards=2,
+            )
+            await service.run()
+            assert [call[0] for call in mock_process_retries.call_args_list] == [
+                ("test_retry_topic", "test_topic"),
+                ("test_retry_topic_{0}", "test_topic"),
+                ("test_retry_topic_{1}", "test_topic"),
+            ]
+        service.redis = async_mock.MagicMock(
+            set=async_mock.CoroutineMock(), zadd=async_mock.CoroutineMock()
+        )
+        for endpoint in ("http://localhost:9000", "http://localhost:9001"):
+            await service.retry_delivery(
+                test_module.OutboundPayload(service={"url": endpoint}, payload=b"test")
+            )
+            assert service.redis.zadd.call_args[0][0] == (
+                test_module.get_outbound_shard_topic("test_retry_topic", endpoint, 2)
+            )
+
     async def test_process_delivery_http(self):
         with async_mock.patch.object(
             test_module.aiohttp,
@@ -307,6 +366,7 @@ class TestRedisHandler(AsyncTestCase):
                 ]
             )
             mock_redis.rpush = async_mock.CoroutineMock()
+            mock_redis.set = async_mock.CoroutineMock()
             mock_redis.zadd = async_mock.CoroutineMock()
             service = Deliverer("test", "test_topic", "test_retry_topic")
             service.redis = mock_redis
@@ -335,6 +395,7 @@ class TestRedisHandler(AsyncTestCase):
                 ]
             )
             mock_redis.rpush = async_mock.CoroutineMock()
+            mock_redis.set = async_mock.CoroutineMock()
             mock_redis.zadd = async_mock.CoroutineMock()
             service = Deliverer("test", "test_topic", "test_retry_topic")
             service.redis = mock_redis
@@ -371,6 +432,7 @@ class TestRedisHandler(AsyncTestCase):
             )
             mock_redis.ping = async_mock.CoroutineMock()
             mock_redis.rpush = async_mock.CoroutineMock()
+            mock_redis.set = async_mock.CoroutineMock()
             mock_redis.zadd = async_mock.CoroutineMock(
                 side_effect=[test_module.RedisError, None, None]
             )
@@ -378,6 +440,363 @@ class TestRedisHandler(AsyncTestCase):
             service.redis = mock_redis
             await service.process_delivery()
 
+    async def test_process_delivery_ws(self):
+        with async_mock.patch.object(
+            test_module.WSConnectionPool,
+            "send",
+            async_mock.CoroutineMock(side_effect=[True, False]),
+        ) as mock_send, async_mock.patch.object(
+            test_module.WSConnectionPool, "close", async_mock.CoroutineMock()
+        ) as mock_close, async_mock.patch.object(
+            redis.asyncio.RedisCluster,
+            "from_url",
+            async_mock.MagicMock(),
+        ) as mock_redis:
+            Deliverer.running = PropertyMock(side_effect=[True, True, False])
+            mock_redis.blpop = async_mock.CoroutineMock(
+                side_effect=[test_msg_b, test_msg_b]
+            )
+            mock_redis.set = async_mock.CoroutineMock()
+            mock_redis.zadd = async_mock.CoroutineMock()
+            service = Deliverer("test", "test_topic", "test_retry_topic")
+            service.redis = mock_redis
+            await service.process_delivery()
+            assert mock_send.call_count == 2
+            mock_send.assert_called_with(
+                "ws://localhost:9001",
+                (string.digits + string.ascii_letters).encode(),
+                {"content-type": "test1"},
+            )
+            retry_msg = mock_redis.zadd.call_args[0][1].popitem()[0]
+            header, _ = unpack_envelope(retry_msg)
+            assert header["retries"] == 1
+            payload_key, stored_msg = mock_redis.set.call_args[0]
+            assert payload_key == f"test_retry_topic_payload_{header['retry_id']}"
+            assert mock_redis.set.call_args[1]["ex"] > service.retry_payload_ttl_s
+            stored_msg = test_module.OutboundPayload.from_bytes(stored_msg)
+            assert stored_msg.service.url == "ws://localhost:9001"
+            assert stored_msg.payload == (string.digits + string.ascii_letters).encode()
+            # The pool is shared by the consumers, run closes it
+            mock_close.assert_not_called()
+
+    async def test_process_delivery_retry_ref(self):
+        stored_msg = pack_envelope(
+            {"service": {"url": "ws://localhost:9001"}, "headers": {}}, b"test"
+        )
+        retry_ref = pack_envelope({"retry_id": "test_id", "retries": 2}, b"")
+        with async_mock.patch.object(
+            test_module.WSConnectionPool,
+            "send",
+            async_mock.CoroutineMock(return_value=False),
+        ) as mock_send, async_mock.patch.object(
+            test_module.WSConnectionPool, "close", async_mock.CoroutineMock()
+        ), async_mock.patch.object(
+            test_module.asyncio, "sleep", async_mock.CoroutineMock()
+        ):
+            Deliverer.running = PropertyMock(side_effect=[True, True, False])
+            mock_redis = async_mock.MagicMock(
+                blpop=async_mock.CoroutineMock(
+                    side_effect=[(None, retry_ref), (None, retry_ref)]
+                ),
+                get=async_mock.CoroutineMock(
+                    side_effect=[test_module.RedisError, stored_msg, None]
+                ),
+                set=async_mock.CoroutineMock(),
+                expire=async_mock.CoroutineMock(),
+                zadd=async_mock.CoroutineMock(),
+                rpush=async_mock.CoroutineMock(),
+                delete=async_mock.CoroutineMock(),
+            )
+            service = Deliverer(
+                "test",
+                "test_topic",
+                "test_retry_topic",
+                dead_letter_topic="test_dead_letter_topic",
+            )
+            service.redis = mock_redis
+            await service.process_delivery()
+            mock_send.assert_called_once_with("ws://localhost:9001", b"test", {})
+            mock_redis.get.assert_called_with("test_retry_topic_payload_test_id")
+            # The stored message is reused, only a new reference is queued
+            mock_redis.set.assert_not_called()
+            header, _ = unpack_envelope(mock_redis.zadd.call_args[0][1].popitem()[0])
+            assert header == {"retry_id": "test_id", "retries": 3}
+            mock_redis.expire.assert_called_once()
+            # The expired reference is dead lettered, not dropped
+            topic, dead_msg = mock_redis.rpush.call_args[0]
+            assert topic == "test_dead_letter_topic"
+            dead_msg = decode_envelope(dead_msg)
+            assert dead_msg["reason"] == "expired"
+            assert dead_msg["retry_id"] == "test_id"
+            assert service.metrics["expired"] == 1
+
+    async def test_process_delivery_invalid(self):
+        retry_ref = pack_envelope({"retry_id": "test_id", "retries": 1}, b"")
+        with async_mock.patch.object(
+            Deliverer, "deliver", async_mock.CoroutineMock()
+        ) as mock_deliver:
+            Deliverer.running = PropertyMock(side_effect=[True, True, True, False])
+            mock_redis = async_mock.MagicMock(
+                blpop=async_mock.CoroutineMock(
+                    side_effect=[
+                        (None, b"[1]"),
+                        (None, pack_envelope([1], b"")),
+                        (None, retry_ref),
+                    ]
+                ),
+                get=async_mock.CoroutineMock(return_value=b'{"payload": "test"}'),
+                rpush=async_mock.CoroutineMock(),
+                delete=async_mock.CoroutineMock(),
+            )
+            service = Deliverer(
+                "test",
+                "test_topic",
+                "test_retry_topic",
+                dead_letter_topic="test_dead_letter_topic",
+            )
+            service.redis = mock_redis
+            await service.process_delivery()
+            mock_deliver.assert_not_called()
+            dead_msgs = [
+                decode_envelope(call[0][1]) for call in mock_redis.rpush.call_args_list
+            ]
+            assert [dead_msg["reason"] for dead_msg in dead_msgs] == [
+                "invalid_message"
+            ] * 3
+            assert dead_msgs[0]["payload"] == b"[1]"
+            assert dead_msgs[2]["retry_id"] == "test_id"
+            assert dead_msgs[2]["payload"] == b'{"payload": "test"}'
+            mock_redis.delete.assert_called_once_with(
+                "test_retry_topic_payload_test_id"
+            )
+            assert service.metrics["dead_lettered"] == 3
+
+        # Unreadable messages are left in the dead letter list by replay
+        mock_redis = async_mock.MagicMock(
+            llen=async_mock.CoroutineMock(return_value=1),
+            lindex=async_mock.CoroutineMock(
+                side_effect=[mock_redis.rpush.call_args_list[0][0][1]]
+            ),
+            lmove=async_mock.CoroutineMock(),
+            rpush=async_mock.CoroutineMock(),
+            lrem=async_mock.CoroutineMock(),
+        )
+        assert not await test_replay.replay_dead_letters(
+            mock_redis, "dead_letter", "outbound"
+        )
+        mock_redis.lmove.assert_called_once_with(
+            "dead_letter", "dead_letter", "LEFT", "RIGHT"
+        )
+        mock_redis.rpush.assert_not_called()
+        mock_redis.lrem.assert_not_called()
+
+    async def test_process_delivery_invalid_payload(self):
+        service_url = {"url": "http://localhost:9000"}
+        invalid_msgs = [
+            # Bad base64
+            {"service": service_url, "payload": "a"},
+            # Corrupt zlib body
+            {
+                "service": service_url,
+                "payload": base64.urlsafe_b64encode(b"not zlib").decode(),
+                "metadata": {"content-encoding": "zlib"},
+            },
+            # Unknown codec
+            {
+                "service": service_url,
+                "payload": base64.urlsafe_b64encode(zlib.compress(b"test")).decode(),
+                "metadata": {"content-encoding": "test"},
+            },
+        ]
+        Deliverer.running = PropertyMock(side_effect=[True, True, True, False])
+        mock_redis = async_mock.MagicMock(
+            blpop=async_mock.CoroutineMock(
+                side_effect=[
+                    (None, str.encode(json.dumps(invalid_msg)))
+                    for invalid_msg in invalid_msgs
+                ]
+            ),
+            rpush=async_mock.CoroutineMock(),
+        )
+        service = Deliverer(
+            "test",
+            "test_topic",
+            "test_retry_topic",
+            dead_letter_topic="test_dead_letter_topic",
+        )
+        service.redis = mock_redis
+        await service.process_delivery()
+        dead_msgs = [
+            decode_envelope(call[0][1]) for call in mock_redis.rpush.call_args_list
+        ]
+        assert [dead_msg["reason"] for dead_msg in dead_msgs] == ["invalid_message"] * 3
+        assert [json.loads(dead_msg["payload"]) for dead_msg in dead_msgs] == (
+            invalid_msgs
+        )
+        assert service.metrics["failed"] == 0
+
+    async def test_ws_connection_pool_send(self):
+        mock_ws = async_mock.MagicMock(
+            closed=False,
+            send_bytes=async_mock.CoroutineMock(),
+            send_str=async_mock.CoroutineMock(),
+            close=async_mock.CoroutineMock(),
+        )
+        mock_ws.__aiter__.return_value = []
+        mock_session = async_mock.MagicMock(
+            closed=False,
+            ws_connect=async_mock.CoroutineMock(return_value=mock_ws),
+            close=async_mock.CoroutineMock(),
+        )
+        pool = test_module.WSConnectionPool(heartbeat_s=5)
+        pool.client_session = mock_session
+        pool.drain = async_mock.CoroutineMock()
+        assert await pool.send("ws://localhost:9001", b"test", {"a": "b"})
+        assert await pool.send("ws://localhost:9001", "test", {"a": "b"})
+        mock_session.ws_connect.assert_called_once_with(
+            "ws://localhost:9001", headers={"a": "b"}, heartbeat=5, timeout=10
+        )
+        mock_ws.send_bytes.assert_called_once_with(b"test")
+        mock_ws.send_str.assert_called_once_with("test")
+
+        # stale pooled connection is replaced once
+        mock_ws.send_bytes.side_effect = [ConnectionResetError, None]
+        assert await pool.send("ws://localhost:9001", b"test", {})
+        assert mock_session.ws_connect.call_count == 2
+        mock_ws.close.assert_called_once()
+
+        mock_session.ws_connect.side_effect = aiohttp.ClientError
+        await pool.close_connection("ws://localhost:9001")
+        assert not await pool.send("ws://localhost:9001", b"test", {})
+        assert mock_session.ws_connect.call_count == 3
+        assert not pool.connections
+
+        await pool.close()
+        mock_session.close.assert_called_once()
+
+    async def test_ws_connection_pool_concurrent_connect(self):
+        mock_ws = async_mock.MagicMock(closed=False)
+        mock_ws.__aiter__.return_value = []
+
+        async def ws_connect(*args, **kwargs):
+            await asyncio.sleep(0)
+            return mock_ws
+
+        mock_session = async_mock.MagicMock(
+            closed=False, ws_connect=async_mock.CoroutineMock(side_effect=ws_connect)
+        )
+        pool = test_module.WSConnectionPool()
+        pool.client_session = mock_session
+        pool.drain = async_mock.CoroutineMock()
+        connections = await asyncio.gather(
+            pool.get_connection("ws://localhost:9001", {}),
+            pool.get_connection("ws://localhost:9001", {}),
+        )
+        assert connections == [mock_ws, mock_ws]
+        mock_session.ws_connect.assert_called_once()
+
+    async def test_ws_connection_pool_idle(self):
+        mock_ws = async_mock.MagicMock(closed=False, close=async_mock.CoroutineMock())
+        pool = test_module.WSConnectionPool(idle_timeout_s=10)
+        pool.connections = {"ws://a": mock_ws, "ws://b": mock_ws}
+        pool.last_used = {"ws://a": time() - 20, "ws://b": time()}
+        await pool.close_idle()
+        assert list(pool.connections) == ["ws://b"]
+        mock_ws.close.assert_called_once()
+
+    async def test_ws_connection_pool_drain(self):
+        mock_ws = async_mock.MagicMock()
+        mock_ws.__aiter__.return_value = [async_mock.MagicMock()]
+        pool = test_module.WSConnectionPool()
+        pool.connections = {"ws://a": mock_ws}
+        pool.last_used = {"ws://a": time()}
+        await pool.drain("ws://a", mock_ws)
+        assert not pool.connections
+        assert not pool.last_used
+
+    async def test_process_delivery_fanout(self):
+        with async_mock.patch.object(
+            Deliverer, "deliver", async_mock.CoroutineMock()
+        ) as mock_deliver, async_mock.patch.object(
+            redis.asyncio.RedisCluster,
+            "from_url",
+            async_mock.MagicMock(),
+        ) as mock_redis:
+            Deliverer.running = PropertyMock(side_effect=[True, False])
+            mock_redis.blpop = async_mock.CoroutineMock(
+                return_value=(
+                    None,
+                    str.encode(
+                        json.dumps(
+                            {
+                                "targets": [
+                                    {"service": {"url": "http://localhost:9000"}},
+                                    {"service": {"url": "http://localhost:9001"}},
+                                ],
+                                "payload": PAYLOAD_B64,
+                            }
+                        )
+                    ),
+                )
+            )
+            service = Deliverer("test", "test_topic", "test_retry_topic")
+            service.redis = mock_redis
+            await service.process_delivery()
+            assert [call[0][0].service.url for call in mock_deliver.call_args_list] == [
+                "http://localhost:9000",
+                "http://localhost:9001",
+            ]
+
+    async def test_deliver_via_ws_session(self):
+        packed_msg = str.encode(
+            json.dumps(
+                {
+                    "protected": base64.urlsafe_b64encode(
+                        json.dumps(
+                            {"recipients": [{"header": {"kid": "test_recip_key"}}]}
+                        ).encode()
+                    ).decode(),
+                    "ciphertext": "...",
+                }
+            )
+        )
+        raw_msg = str.encode(
+            json.dumps(
+                {
+                    "service": {"url": "ws://localhost:9001"},
+                    "payload": base64.urlsafe_b64encode(packed_msg).decode(),
+                }
+            )
+        )
+        msg = test_module.OutboundPayload.from_bytes(raw_msg)
+        mock_redis = async_mock.MagicMock(
+            get=async_mock.CoroutineMock(
+                side_effect=[b"acapy_ws_session_relay_1", None, test_module.RedisError]
+            ),
+            rpush=async_mock.CoroutineMock(),
+        )
+        service = Deliverer("test", "test_topic", "test_retry_topic")
+        service.redis = mock_redis
+        assert not await service.deliver_via_ws_session(msg, raw_msg)
+        mock_redis.get.assert_not_called()
+
+        service = Deliverer(
+            "test",
+            "test_topic",
+            "test_retry_topic",
+            ws_session_topic="acapy_ws_session",
+        )
+        service.redis = mock_redis
+        assert await service.deliver_via_ws_session(msg, raw_msg)
+        mock_redis.get.assert_called_once_with("acapy_ws_session_test_recip_key")
+        mock_redis.rpush.assert_called_once_with("acapy_ws_session_relay_1", raw_msg)
+        assert not await service.deliver_via_ws_session(msg, raw_msg)
+        assert not await service.deliver_via_ws_session(msg, raw_msg)
+        assert not await service.deliver_via_ws_session(
+            test_module.OutboundPayload.from_bytes(test_msg_a[1]), test_msg_a[1]
+        )
+        assert mock_redis.rpush.call_count == 1
+
     async def test_process_retries_a(self):
         with async_mock.patch.object(
             redis.asyncio.RedisCluster,
@@ -489,3 +908,292 @@ class TestRedisHandler(AsyncTestCase):
         }
         test_fail_message = str.encode(json.dumps(test_fail_message))
         assert test_module.OutboundPayload.from_bytes(test_fail_message)
+
+    def test_outbound_payload_compressed(self):
+        payload = (string.digits + string.ascii_letters).encode() * 10
+        msg = test_module.OutboundPayload.from_bytes(
+            str.encode(
+                json.dumps(
+                    {
+                        "service": {"url": "http://localhost:9000"},
+                        "payload": base64.urlsafe_b64encode(
+                            zlib.compress(payload)
+                        ).decode(),
+                        "metadata": {"content-encoding": "zlib"},
+                    }
+                )
+            )
+        )
+        assert msg.payload == payload
+        assert msg.metadata == {}
+
+    def test_outbound_payload_binary(self):
+        payload = base64.urlsafe_b64decode(PAYLOAD_B64)
+        msg = test_module.OutboundPayload.from_bytes(
+            pack_envelope(
+                {"service": {"url": "http://localhost:9000"}, "retries": 1},
+                payload,
+            )
+        )
+        assert msg.payload == payload
+        assert msg.endpoint_scheme == "http"
+        assert msg.retries == 1
+
+    def test_outbound_payload_lazy(self):
+        msg = test_module.OutboundPayload.from_bytes(
+            str.encode(
+                json.dumps(
+                    {"service": {"url": "http://localhost:9000"}, "payload": "a"}
+                )
+            )
+        )
+        assert msg.endpoint_scheme == "http"
+        with self.assertRaises(ValueError):
+            msg.payload
+        for invalid in (
+            {"service": {"uri": "http://localhost:9000"}, "payload": PAYLOAD_B64},
+            {"service": {"url": "http://localhost:9000"}, "payload": None},
+            {"service": {"url": "http://localhost:9000"}},
+            [PAYLOAD_B64],
+        ):
+            with self.assertRaises(ValueError):
+                test_module.OutboundPayload.from_bytes(str.encode(json.dumps(invalid)))
+        # Fields added by newer producers are ignored
+        msg = test_module.OutboundPayload.from_bytes(
+            str.encode(
+                json.dumps(
+                    {
+                        "service": {"url": "http://localhost:9000"},
+                        "payload": PAYLOAD_B64,
+                        "priority": 1,
+                    }
+                )
+            )
+        )
+        assert msg.service.url == "http://localhost:9000"
+
+    def test_outbound_payload_fanout(self):
+        msg = test_module.OutboundPayload.from_bytes(
+            str.encode(
+                json.dumps(
+                    {
+                        "targets": [
+                            {
+                                "service": {"url": "http://localhost:9000"},
+                                "headers": {"x-api-key": "test"},
+                            },
+                            {"service": {"url": "ws://localhost:9001"}},
+                        ],
+                        "headers": {"content-type": "test"},
+                        "payload": PAYLOAD_B64,
+                    }
+                )
+            )
+        )
+        msg_a, msg_b = msg.expand()
+        assert msg_a.service.url == "http://localhost:9000"
+        assert msg_a.endpoint_scheme == "http"
+        assert msg_a.headers == {"content-type": "test", "x-api-key": "test"}
+        assert msg_b.service.url == "ws://localhost:9001"
+        assert msg_b.endpoint_scheme == "ws"
+        assert msg_b.headers == {"content-type": "test"}
+        assert msg_a.payload == msg_b.payload == msg.payload
+        assert not msg_a.targets
+        assert msg_a.expand() == [msg_a]
+        with self.assertRaises(ValueError):
+            test_module.OutboundPayload.from_bytes(
+                str.encode(json.dumps({"payload": PAYLOAD_B64}))
+            )
+
+    def test_retry_policy(self):
+        policy = RetryPolicy(base_delay_s=2, multiplier=3, max_delay_s=10, jitter=0)
+        assert [policy.delay(retries) for retries in (1, 2, 3)] == [2, 6, 10]
+        assert policy.horizon_s() == 2 + 6 + 10 + 10 + 10
+        assert RetryPolicy(max_age_s=30).horizon_s() == 30
+        policy = RetryPolicy(base_delay_s=10, jitter=0.5)
+        delays = {policy.delay(1) for _ in range(20)}
+        assert len(delays) > 1
+        assert all(5 <= delay <= 15 for delay in delays)
+        policies = RetryPolicies.parse_raw(
+            json.dumps(
+                {
+                    "schemes": {"ws": {"max_retries": 1}},
+                    "endpoints": {
+                        "http://localhost": {"max_retries": 2},
+                        "http://localhost:9000/slow": {"max_retries": 3},
+                    },
+                }
+            )
+        )
+        assert policies.for_endpoint("ws://localhost:9001").max_retries == 1
+        assert policies.for_endpoint("http://localhost:9000").max_retries == 2
+        assert policies.for_endpoint("http://localhost:9000/slow/a").max_retries == 3
+        assert policies.for_endpoint("https://localhost").max_retries == 5
+
+    async def test_retry_delivery_dead_letter(self):
+        service = Deliverer(
+            "test",
+            "test_topic",
+            "test_retry_topic",
+            retry_policies=RetryPolicies(default=RetryPolicy(max_age_s=60)),
+            dead_letter_topic="test_dead_letter_topic",
+        )
+        service.redis = async_mock.MagicMock(
+            rpush=async_mock.CoroutineMock(
+                side_effect=[test_module.RedisError, None, None]
+            ),
+            delete=async_mock.CoroutineMock(side_effect=test_module.RedisError),
+            expire=async_mock.CoroutineMock(),
+            zadd=async_mock.CoroutineMock(),
+        )
+        msg = test_module.OutboundPayload(
+            service={"url": "http://localhost:9000"},
+            payload=b"test",
+            retries=5,
+        )
+        msg.retry_id = "test_id"
+        with async_mock.patch.object(
+            test_module.asyncio, "sleep", async_mock.CoroutineMock()
+        ):
+            await service.retry_delivery(msg)
+        topic, dead_msg = service.redis.rpush.call_args[0]
+        assert topic == "test_dead_letter_topic"
+        dead_msg = decode_envelope(dead_msg)
+        assert dead_msg["reason"] == "max_retries"
+        assert dead_msg["retries"] == 5
+        assert dead_msg["payload"] == b"test"
+        service.redis.delete.assert_called_once_with("test_retry_topic_payload_test_id")
+        msg.retries = 1
+        msg.first_failed_at = time() - 120
+        await service.retry_delivery(msg)
+        assert decode_envelope(service.redis.rpush.call_args[0][1])["reason"] == (
+            "max_age"
+        )
+        service.redis.zadd.assert_not_called()
+        msg.first_failed_at = time()
+        await service.retry_delivery(msg)
+        retry_msg, retry_time = service.redis.zadd.call_args[0][1].popitem()
+        assert unpack_envelope(retry_msg)[0] == {"retry_id": "test_id", "retries": 2}
+        assert time() < retry_time < time() + 10
+        # The stored message outlives a Retry-After delay beyond the policy
+        await service.retry_delivery(msg, status=429, retry_after=3600)
+        service.redis.expire.assert_called_with(
+            "test_retry_topic_payload_test_id", 3600 + service.retry_payload_ttl_s
+        )
+
+    async def test_deliver_response_status(self):
+        service = Deliverer(
+            "test",
+            "test_topic",
+            "test_retry_topic",
+            dead_letter_topic="test_dead_letter_topic",
+        )
+        service.redis = async_mock.MagicMock(
+            rpush=async_mock.CoroutineMock(),
+            set=async_mock.CoroutineMock(),
+            zadd=async_mock.CoroutineMock(),
+        )
+        with async_mock.patch.object(
+            aiohttp.ClientSession,
+            "post",
+            async_mock.CoroutineMock(
+                side_effect=[
+                    async_mock.MagicMock(status=404, headers={}),
+                    async_mock.MagicMock(status=503, headers={"Retry-After": "120"}),
+                    async_mock.MagicMock(status=429, headers={}),
+                    async_mock.MagicMock(status=200),
+                ]
+            ),
+        ):
+            for _ in range(4):
+                await service.deliver(
+                    test_module.OutboundPayload(
+                        service={"url": "http://localhost:9000"}, payload=b"test"
+                    )
+                )
+        dead_msg = decode_envelope(service.redis.rpush.call_args[0][1])
+        assert dead_msg["reason"] == "http_status_404"
+        (_, retry_503), (_, retry_429) = [
+            call[0][1].popitem() for call in service.redis.zadd.call_args_list
+        ]
+        assert retry_503 >= time() + 119
+        assert retry_429 < time() + 10
+        assert service.get_metrics() == {
+            "delivered": 1,
+            "handed_to_ws_session": 0,
+            "failed": 3,
+            "retried": 2,
+            "dead_lettered": 1,
+            "expired": 0,
+            "response_statuses": {404: 1, 503: 1, 429: 1},
+        }
+
+    def test_parse_retry_after(self):
+        assert parse_retry_after("120") == 120
+        assert parse_retry_after("-1") == 0
+        assert 50 < parse_retry_after(formatdate(time() + 60, usegmt=True)) <= 60
+        assert parse_retry_after("soon") is None
+        assert parse_retry_after(None) is None
+        policy = RetryPolicy(jitter=0, max_delay_s=100)
+        assert policy.delay(1, 60) == 60
+        assert policy.delay(1, 1) == 5
+        assert policy.delay(1, 1000) == 100
+        assert RetryPolicy(jitter=0, honor_retry_after=False).delay(1, 60) == 5
+        assert policy.classify_status(400) == "dead_letter"
+        assert policy.classify_status(429) == "retry"
+        assert policy.classify_status(502) == "retry"
+
+    async def test_replay_dead_letters(self):
+        dead_letters = [
+            pack_envelope(
+                {
+                    "service": {"url": "http://localhost:9000"},
+                    "headers": {},
+                    "reason": "max_retries",
+                },
+                b"test_a",
+            ),
+            str.encode(
+                json.dumps(
+                    {
+                        "service": {"url": "ws://localhost:9001"},
+                        "payload": base64.urlsafe_b64encode(b"test_b").decode(),
+                        "reason": "unsupported_scheme",
+                    }
+                )
+            ),
+        ]
+        mock_redis = async_mock.MagicMock(
+            llen=async_mock.CoroutineMock(return_value=2),
+            lindex=async_mock.CoroutineMock(side_effect=dead_letters),
+            lmove=async_mock.CoroutineMock(),
+            rpush=async_mock.CoroutineMock(),
+            lrem=async_mock.CoroutineMock(),
+        )
+        replayed = await test_replay.replay_dead_letters(
+            mock_redis, "dead_letter", "outbound", reason="max_retries"
+        )
+        assert replayed == 1
+        mock_redis.lindex.assert_called_with("dead_letter", 0)
+        # Pushed to outbound before it is removed from the dead letter list
+        mock_redis.rpush.assert_called_once_with(
+            "outbound",
+            pack_envelope(
+                {"service": {"url": "http://localhost:9000"}, "headers": {}},
+                b"test_a",
+            ),
+        )
+        mock_redis.lrem.assert_called_once_with("dead_letter", 1, dead_letters[0])
+        mock_redis.lmove.assert_called_once_with(
+            "dead_letter", "dead_letter", "LEFT", "RIGHT"
+        )
+        mock_redis.lindex = async_mock.CoroutineMock(side_effect=dead_letters[1:])
+        assert (
+            await test_replay.replay_dead_letters(
+                mock_redis, "dead_letter", "outbound", limit=1
+            )
+            == 1
+        )
+        msg = test_module.OutboundPayload.from_bytes(mock_redis.rpush.call_args[0][1])
+        assert msg.service.url == "ws://localhost:9001"
+        assert msg.payload == b"test_b"
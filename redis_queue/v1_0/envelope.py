@@ -0,0 +1,84 @@
+"""Queue message envelopes.
+
+A message queued in Redis is a set of header fields plus a payload, in one of
+two formats:
+
+- json: a JSON object with the payload base64url encoded in its payload field.
+- binary: MAGIC, a version byte, a header codec byte and the big-endian
+  4-byte length of the header, followed by the header and the raw payload.
+
+Readers accept both formats, writers use the configured one.
+"""
+
+import base64
+import json
+import struct
+from typing import Tuple, Union
+
+from .utils import b64_to_bytes, json_dumps_bytes
+
+ENVELOPE_JSON = "json"
+ENVELOPE_BINARY = "binary"
+
+# A JSON document never starts with a NUL byte
+MAGIC = b"\x00RQ"
+VERSION = 1
+HEADER_CODEC_JSON = 0
+
+_PREFIX = struct.Struct(">3sBBI")
+
+
+def is_binary_envelope(data: Union[bytes, bytearray]) -> bool:
+    """Check if data is a binary envelope."""
+    return data[: len(MAGIC)] == MAGIC
+
+
+def pack_envelope(header: dict, payload: Union[bytes, bytearray]) -> bytes:
+    """Build a binary envelope."""
+    header_bytes = json_dumps_bytes(header)
+    return b"".join(
+        (
+            _PREFIX.pack(MAGIC, VERSION, HEADER_CODEC_JSON, len(header_bytes)),
+            header_bytes,
+            payload,
+        )
+    )
+
+
+def unpack_envelope(data: bytes) -> Tuple[dict, bytes]:
+    """Return the header and payload of a binary envelope."""
+    if len(data) < _PREFIX.size or not is_binary_envelope(data):
+        raise ValueError("Not a binary envelope")
+    _, version, header_codec, header_length = _PREFIX.unpack_from(data)
+    if version != VERSION:
+        raise ValueError(f"Unsupported envelope version: {version}")
+    if header_codec != HEADER_CODEC_JSON:
+        raise ValueError(f"Unsupported envelope header codec: {header_codec}")
+    header_start = _PREFIX.size
+    payload_start = header_start + header_length
+    if len(data) < payload_start:
+        raise ValueError("Truncated envelope header")
+    return json.loads(data[header_start:payload_start]), data[payload_start:]
+
+
+def encode_envelope(
+    header: dict,
+    payload: Union[bytes, bytearray],
+    envelope_format: str = ENVELOPE_JSON,
+) -> bytes:
+    """Build an envelope in envelope_format."""
+    if envelope_format == ENVELOPE_BINARY:
+        return pack_envelope(header, payload)
+    return json_dumps_bytes(
+        {**header, "payload": base64.urlsafe_b64encode(payload).decode()}
+    )
+
+
+def decode_envelope(data: bytes) -> dict:
+    """Return the fields of an envelope in either format, payload as bytes."""
+    if is_binary_envelope(data):
+        header, payload = unpack_envelope(data)
+        return {**header, "payload": payload}
+    fields = json.loads(data)
+    fields["payload"] = b64_to_bytes(fields["payload"])
+    return fields
@@ -4,6 +4,7 @@ import json
 import logging
 import base64
 import re
+from functools import lru_cache
 from string import Template
 from typing import Any, Optional, cast
 
@@ -12,17 +13,26 @@ from aries_cloudagent.core.profile import Profile
 from aries_cloudagent.core.util import SHUTDOWN_EVENT_PATTERN, STARTUP_EVENT_PATTERN
 from aries_cloudagent.config.injection_context import InjectionContext
 from aries_cloudagent.transport.error import TransportError
-from redis.asyncio import RedisCluster
 from redis.exceptions import RedisError, RedisClusterException
 
+from ..client import REDIS_CLIENTS, RedisClient, ping_redis
 from ..config import OutboundConfig, get_config, EventConfig
+from ..envelope import ENVELOPE_BINARY, pack_envelope
+from ..utils import compress_payload, get_outbound_shard_topic, json_dumps_bytes
+from .filters import apply_event_filter
+from .matcher import EventTopicMatcher
+from .publisher import EventPublisher
 
 LOGGER = logging.getLogger(__name__)
 
+# id(EventConfig) -> (EventConfig, EventTopicMatcher)
+_TOPIC_MATCHERS = {}
+_TOPIC_MATCHERS_SIZE = 128
+
 
 async def setup(context: InjectionContext):
     """Setup the plugin."""
-    config = get_config(context.settings).event or EventConfig.default()
+    config = get_config(context.settings).event or _default_event_config()
 
     bus = context.inject(EventBus)
     if not bus:
@@ -30,34 +40,99 @@ async def setup(context: InjectionContext):
 
     for event in config.event_topic_maps.keys():
         LOGGER.info(f"subscribing to event: {event}")
-        bus.subscribe(re.compile(event), handle_event)
+    bus.subscribe(get_topic_matcher(config).pattern, handle_event)
 
     bus.subscribe(STARTUP_EVENT_PATTERN, on_startup)
     bus.subscribe(SHUTDOWN_EVENT_PATTERN, on_shutdown)
 
 
+@lru_cache(maxsize=1)
+def _default_event_config() -> EventConfig:
+    return EventConfig.default()
+
+
+def get_topic_matcher(config_events: EventConfig) -> EventTopicMatcher:
+    """Return the topic matcher for config_events, built once per config."""
+    cached = _TOPIC_MATCHERS.get(id(config_events))
+    if cached and cached[0] is config_events:
+        return cached[1]
+    matcher = EventTopicMatcher(
+        config_events.event_topic_maps,
+        config_events.event_topic_match,
+        config_events.event_filters,
+    )
+    if len(_TOPIC_MATCHERS) >= _TOPIC_MATCHERS_SIZE:
+        _TOPIC_MATCHERS.clear()
+    # The config is kept referenced so its id is not reused
+    _TOPIC_MATCHERS[id(config_events)] = (config_events, matcher)
+    return matcher
+
+
 RECORD_RE = re.compile(r"acapy::record::([^:]*)(?:::(.*))?")
 WEBHOOK_RE = re.compile(r"acapy::webhook::{.*}")
 
 
-async def redis_setup(profile: Profile, event: Event) -> RedisCluster:
+async def redis_setup(profile: Profile, event: Event) -> RedisClient:
     """Connect, setup and return the Redis instance."""
-    connection_url = (get_config(profile.settings).connection).connection_url
+    connection_config = get_config(profile.settings).connection
     try:
-        redis = RedisCluster.from_url(url=connection_url)
-        await redis.ping(target_nodes=RedisCluster.PRIMARIES)
-        profile.context.injector.bind_instance(RedisCluster, redis)
+        redis = REDIS_CLIENTS.get(
+            connection_config.connection_url, **connection_config.client_options()
+        )
+        await ping_redis(redis)
+        profile.context.injector.bind_instance(RedisClient, redis)
     except (RedisError, RedisClusterException) as err:
         raise TransportError(f"No Redis instance setup, {err}")
     return redis
 
 
+def setup_publisher(profile: Profile, redis: RedisClient) -> EventPublisher:
+    """Create, start and bind the event publisher to profile."""
+    config_events = get_config(profile.settings).event or _default_event_config()
+    publisher = EventPublisher(
+        redis,
+        batch_size=config_events.publish_batch_size,
+        linger_ms=config_events.publish_linger_ms,
+        max_buffer=config_events.publish_max_buffer,
+        overflow_policy=config_events.publish_overflow_policy,
+        spill_path=config_events.publish_spill_path,
+        stream_maxlen=config_events.stream_maxlen,
+        stream_max_age_ms=config_events.stream_max_age_ms,
+    )
+    profile.context.injector.bind_instance(EventPublisher, publisher)
+    publisher.start()
+    return publisher
+
+
+async def get_publisher(profile: Profile, event: Event) -> EventPublisher:
+    """Return the event publisher bound to profile.
+
+    The publisher is bound to the root profile on startup, sub-wallet profiles
+    inherit it. It is only created here for events emitted before startup.
+    """
+    publisher = profile.inject_or(EventPublisher)
+    if not publisher:
+        redis = profile.inject_or(RedisClient)
+        if not redis:
+            redis = await redis_setup(profile, event)
+            # Another event may have set the publisher up in the meantime
+            publisher = profile.inject_or(EventPublisher)
+            if publisher:
+                return publisher
+        publisher = setup_publisher(profile, redis)
+    return publisher
+
+
 async def on_startup(profile: Profile, event: Event):
-    await redis_setup(profile, event)
+    redis = await redis_setup(profile, event)
+    if not profile.inject_or(EventPublisher):
+        setup_publisher(profile, redis)
 
 
 async def on_shutdown(profile: Profile, event: Event):
-    pass
+    publisher = profile.inject_or(EventPublisher)
+    if publisher:
+        await publisher.close()
 
 
 def _derive_category(topic: str):
@@ -68,6 +143,11 @@ def _derive_category(topic: str):
         return "webhook"
 
 
+@lru_cache(maxsize=256)
+def _topic_template(template: str) -> Template:
+    return Template(template)
+
+
 def process_event_payload(event_payload: Any):
     processed_event_payload = None
     if isinstance(event_payload, dict):
@@ -79,9 +159,7 @@ def process_event_payload(event_payload: Any):
 
 async def handle_event(profile: Profile, event: EventWithMetadata):
     """Push events from aca-py events."""
-    redis = profile.inject_or(RedisCluster)
-    if not redis:
-        redis = await redis_setup(profile, event)
+    publisher = await get_publisher(profile, event)
 
     LOGGER.info("Handling event: %s", event)
     wallet_id = cast(Optional[str], profile.settings.get("wallet.id"))
@@ -104,27 +182,64 @@ async def handle_event(profile: Profile, event: EventWithMetadata):
     }
     webhook_urls = profile.settings.get("admin.webhook_urls")
     try:
-        config_events = get_config(profile.settings).event or EventConfig.default()
-        template = config_events.event_topic_maps[event.metadata.pattern.pattern]
-        redis_topic = Template(template).substitute(**payload)
-        LOGGER.info(f"Sending message {payload} with topic {redis_topic}")
-        outbound = str.encode(
-            json.dumps(
-                {
-                    "payload": payload,
-                    "metadata": {"x-wallet-id": wallet_id} if wallet_id else {},
-                }
-            ),
-        )
-        await redis.rpush(
-            redis_topic,
-            outbound,
+        config = get_config(profile.settings)
+        config_events = config.event or _default_event_config()
+        matcher = get_topic_matcher(config_events)
+        templates = matcher.templates_for(event.topic)
+        if not templates:
+            return
+        event_filter = matcher.filter_for(event.topic)
+        if event_filter:
+            payload = apply_event_filter(event_filter, payload)
+            if not payload:
+                return
+        # The payload is serialized once and spliced into every message
+        payload_json = json_dumps_bytes(payload)
+        metadata = {"x-wallet-id": wallet_id} if wallet_id else {}
+        event_payload_json = payload_json
+        if (
+            config_events.compression
+            and len(payload_json) >= config_events.compression_threshold
+        ):
+            # Compressed payloads are sent as a base64 string
+            event_payload_json = b'"%s"' % base64.urlsafe_b64encode(
+                compress_payload(payload_json, config_events.compression)
+            )
+            metadata["content-encoding"] = config_events.compression
+        outbound = b"".join(
+            (
+                b'{"payload": ',
+                event_payload_json,
+                b', "metadata": ',
+                json_dumps_bytes(metadata),
+                b"}",
+            )
         )
+        redis_topics = []
+        for template in templates:
+            redis_topic = _topic_template(template).substitute(**payload)
+            # Templates may resolve to the same topic, it gets the event once
+            if redis_topic in redis_topics:
+                continue
+            redis_topics.append(redis_topic)
+            LOGGER.info(f"Sending message {payload} with topic {redis_topic}")
+            await publisher.publish(
+                redis_topic, outbound, stream=config_events.stream_mode
+            )
         # Deliver/dispatch events to webhook_urls directly
         if config_events.deliver_webhook and webhook_urls:
-            config_outbound = (
-                get_config(profile.settings).outbound or OutboundConfig.default()
-            )
+            config_outbound = config.outbound or OutboundConfig.default()
+            webhook_payload = payload_json
+            webhook_metadata = {}
+            if (
+                config_outbound.compression
+                and len(payload_json) >= config_outbound.compression_threshold
+            ):
+                webhook_payload = compress_payload(
+                    payload_json, config_outbound.compression
+                )
+                webhook_metadata["content-encoding"] = config_outbound.compression
+            targets = []
             for endpoint in webhook_urls:
                 api_key = None
                 if len(endpoint.split("#")) > 1:
@@ -136,20 +251,34 @@ async def handle_event(profile: Profile, event: EventWithMetadata):
                 headers = {"x-wallet-id": wallet_id} if wallet_id else {}
                 if not api_key:
                     headers["x-api-key"] = api_key
-                outbound = str.encode(
-                    json.dumps(
-                        {
-                            "service": {"url": endpoint},
-                            "payload": base64.urlsafe_b64encode(
-                                str.encode(json.dumps(payload))
-                            ).decode(),
-                            "headers": headers,
-                        }
-                    ),
-                )
-                await redis.rpush(
+                targets.append({"service": {"url": endpoint}, "headers": headers})
+            if config_events.webhook_fanout:
+                # One message for all webhook urls, expanded by the deliverer
+                envelopes = [{"targets": targets, "metadata": webhook_metadata}]
+            else:
+                envelopes = [
+                    {**target, "metadata": webhook_metadata} for target in targets
+                ]
+            if config_outbound.envelope_format != ENVELOPE_BINARY:
+                payload_b64 = base64.urlsafe_b64encode(webhook_payload)
+            for envelope in envelopes:
+                # A fan-out message is sharded by its first webhook url
+                outbound_topic = get_outbound_shard_topic(
                     config_outbound.acapy_outbound_topic,
-                    outbound,
+                    (envelope.get("service") or targets[0]["service"])["url"],
+                    config_outbound.outbound_shards,
                 )
+                if config_outbound.envelope_format == ENVELOPE_BINARY:
+                    outbound = pack_envelope(envelope, webhook_payload)
+                else:
+                    outbound = b"".join(
+                        (
+                            json_dumps_bytes(envelope)[:-1],
+                            b', "payload": "',
+                            payload_b64,
+                            b'"}',
+                        )
+                    )
+                await publisher.publish(outbound_topic, outbound)
     except (RedisError, RedisClusterException, ValueError) as err:
         LOGGER.exception(f"Failed to process and send webhook, {err}")
@@ -0,0 +1,76 @@
+"""Filter and project events before they are published."""
+
+import random
+from typing import List, Optional
+
+from ..config import EventFilter
+
+
+def _exclude_field(value: dict, path: List[str]) -> dict:
+    key = path[0]
+    if key not in value:
+        return value
+    # Copy along the path, the event payload may be shared with other handlers
+    result = dict(value)
+    if len(path) == 1:
+        del result[key]
+    elif isinstance(result[key], dict):
+        result[key] = _exclude_field(result[key], path[1:])
+    return result
+
+
+def _include_fields(value: dict, paths: List[List[str]]) -> dict:
+    result = {}
+    for path in paths:
+        source = value
+        target = result
+        for key in path[:-1]:
+            source = source.get(key)
+            if not isinstance(source, dict):
+                break
+            target = target.setdefault(key, {})
+        else:
+            if path[-1] in source:
+                target[path[-1]] = source[path[-1]]
+    return result
+
+
+def project_fields(
+    value: dict,
+    include_fields: Optional[List[str]] = None,
+    exclude_fields: Optional[List[str]] = None,
+) -> dict:
+    """Keep only include_fields and drop exclude_fields, given as dotted paths."""
+    if include_fields:
+        value = _include_fields(value, [field.split(".") for field in include_fields])
+    for field in exclude_fields or ():
+        value = _exclude_field(value, field.split("."))
+    return value
+
+
+def apply_event_filter(event_filter: EventFilter, payload: dict) -> Optional[dict]:
+    """Return payload with the event payload projected, or None to drop it."""
+    if event_filter.states is not None and payload["state"] not in event_filter.states:
+        return None
+    if (
+        event_filter.categories is not None
+        and payload["category"] not in event_filter.categories
+    ):
+        return None
+    if (
+        event_filter.wallet_ids is not None
+        and payload["wallet_id"] not in event_filter.wallet_ids
+    ):
+        return None
+    if event_filter.sample_rate < 1 and random.random() >= event_filter.sample_rate:
+        return None
+    if event_filter.include_fields or event_filter.exclude_fields:
+        payload = {
+            **payload,
+            "payload": project_fields(
+                payload["payload"],
+                event_filter.include_fields,
+                event_filter.exclude_fields,
+            ),
+        }
+    return payload
@@ -0,0 +1,58 @@
+"""Match event topics against the configured event topic maps."""
+
+import re
+from functools import lru_cache
+from typing import Any, Mapping, Optional, Tuple
+
+MATCH_FIRST = "first"
+MATCH_ALL = "all"
+
+
+class EventTopicMatcher:
+    """Resolve the Redis topic templates for an event topic.
+
+    All topic map patterns are combined into a single pattern for the event bus
+    subscription. With match_mode all, the default, the templates of every
+    matching pattern are used, each template once; with first, only the
+    template of the first matching pattern, in configuration order, is.
+
+    The event filter for a topic is the one of the first matching pattern in
+    event_filters.
+    """
+
+    def __init__(
+        self,
+        topic_maps: Mapping[str, str],
+        match_mode: str = MATCH_ALL,
+        event_filters: Mapping[str, Any] = None,
+        cache_size: int = 1024,
+    ):
+        """Initialize EventTopicMatcher."""
+        if match_mode not in (MATCH_FIRST, MATCH_ALL):
+            raise ValueError(f"Unknown match mode: {match_mode}")
+        self.match_mode = match_mode
+        self.topic_maps = [
+            (re.compile(pattern), template) for pattern, template in topic_maps.items()
+        ]
+        self.pattern = re.compile("|".join(f"(?:{pattern})" for pattern in topic_maps))
+        self.event_filters = [
+            (re.compile(pattern), event_filter)
+            for pattern, event_filter in (event_filters or {}).items()
+        ]
+        self.templates_for = lru_cache(maxsize=cache_size)(self._templates_for)
+        self.filter_for = lru_cache(maxsize=cache_size)(self._filter_for)
+
+    def _templates_for(self, topic: str) -> Tuple[str, ...]:
+        templates = []
+        for pattern, template in self.topic_maps:
+            if pattern.match(topic) and template not in templates:
+                templates.append(template)
+                if self.match_mode == MATCH_FIRST:
+                    break
+        return tuple(templates)
+
+    def _filter_for(self, topic: str) -> Optional[Any]:
+        for pattern, event_filter in self.event_filters:
+            if pattern.match(topic):
+                return event_filter
+        return None
@@ -0,0 +1,273 @@
+"""Buffered, pipelined publishing of events to Redis."""
+
+import asyncio
+import base64
+import json
+import logging
+import os
+from collections import deque
+from time import time
+from typing import List, Optional, TextIO, Tuple
+
+from redis.exceptions import RedisError, RedisClusterException
+
+from ..client import RedisClient
+
+LOGGER = logging.getLogger(__name__)
+
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_SPILL = "spill"
+
+
+class EventPublisher:
+    """Buffer messages and push them to Redis lists from a background task.
+
+    Messages are pushed in pipelined batches once batch_size messages are
+    buffered or linger_ms after the first buffered message. When max_buffer
+    messages are pending, overflow_policy decides what happens to a new one:
+    block waits for room, drop_oldest discards the oldest buffered message and
+    spill appends it to spill_path, to be replayed once the buffer drains
+    after a successful send.
+
+    Messages published with stream=True are added to a Redis stream instead,
+    trimmed to about stream_maxlen entries or, if stream_max_age_ms is set, to
+    entries younger than that.
+    """
+
+    def __init__(
+        self,
+        redis: RedisClient,
+        batch_size: int = 100,
+        linger_ms: float = 5,
+        max_buffer: int = 10000,
+        overflow_policy: str = OVERFLOW_BLOCK,
+        spill_path: Optional[str] = None,
+        stream_maxlen: int = 10000,
+        stream_max_age_ms: int = 0,
+    ):
+        """Initialize EventPublisher."""
+        if overflow_policy not in (
+            OVERFLOW_BLOCK,
+            OVERFLOW_DROP_OLDEST,
+            OVERFLOW_SPILL,
+        ):
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        if overflow_policy == OVERFLOW_SPILL and not spill_path:
+            raise ValueError("A spill path is required to spill events")
+        self.redis = redis
+        self.batch_size = max(batch_size, 1)
+        self.linger_s = max(linger_ms, 0) / 1000
+        self.max_buffer = max(max_buffer, self.batch_size)
+        self.overflow_policy = overflow_policy
+        self.spill_path = spill_path
+        self.stream_maxlen = stream_maxlen
+        self.stream_max_age_ms = stream_max_age_ms
+        self.buffer = deque()
+        self.not_empty = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+        self.flush_lock = asyncio.Lock()
+        self.spill_lock = asyncio.Lock()
+        self.task = None
+        self.send_ok = True
+        self.metrics = {
+            "published": 0,
+            "failed": 0,
+            "dropped": 0,
+            "spilled": 0,
+            "replayed": 0,
+            "batches": 0,
+        }
+
+    def get_metrics(self) -> dict:
+        """Return publishing counters and the current buffer size."""
+        return {**self.metrics, "buffered": len(self.buffer)}
+
+    def start(self):
+        """Start the background publishing task if it is not running."""
+        if not self.task or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def publish(self, topic: str, message: bytes, stream: bool = False):
+        """Buffer message to be pushed to the topic list or stream."""
+        self.start()
+        if len(self.buffer) >= self.max_buffer:
+            if self.overflow_policy == OVERFLOW_DROP_OLDEST:
+                self.buffer.popleft()
+                self.metrics["dropped"] += 1
+            elif self.overflow_policy == OVERFLOW_SPILL:
+                await self.spill([(topic, message, stream)])
+                return
+            else:
+                while len(self.buffer) >= self.max_buffer:
+                    self.not_full.clear()
+                    await self.not_full.wait()
+        self.buffer.append((topic, message, stream))
+        self.not_empty.set()
+
+    async def run(self):
+        """Push buffered messages until cancelled."""
+        await self.replay_spill()
+        while True:
+            await self.not_empty.wait()
+            if len(self.buffer) < self.batch_size:
+                await asyncio.sleep(self.linger_s)
+            await self.flush()
+            if not self.buffer:
+                self.not_empty.clear()
+                # Replaying while Redis is down would only spill the events again
+                if self.send_ok:
+                    await self.replay_spill()
+
+    async def flush(self):
+        """Push all buffered messages."""
+        async with self.flush_lock:
+            while self.buffer:
+                batch = [
+                    self.buffer.popleft()
+                    for _ in range(min(self.batch_size, len(self.buffer)))
+                ]
+                self.not_full.set()
+                # A batch taken off the buffer is sent even if the caller is cancelled
+                await asyncio.shield(self.send_batch(batch))
+
+    def stream_trim_args(self) -> dict:
+        """Return the XADD trimming arguments."""
+        if self.stream_max_age_ms:
+            return {"minid": int(time() * 1000) - self.stream_max_age_ms}
+        if self.stream_maxlen:
+            return {"maxlen": self.stream_maxlen}
+        return {}
+
+    async def send_batch(self, batch: List[Tuple[str, bytes, bool]]) -> bool:
+        """Push a batch of messages in a single pipeline.
+
+        List messages are pushed with one RPUSH per topic, stream messages are
+        added with auto-generated IDs. A batch that fails is spilled if the
+        overflow policy is spill, it is discarded otherwise. Returns False if
+        the batch failed.
+        """
+        topics = {}
+        pipe = self.redis.pipeline(transaction=False)
+        trim_args = self.stream_trim_args()
+        for topic, message, stream in batch:
+            if stream:
+                pipe.xadd(topic, {"event": message}, approximate=True, **trim_args)
+            else:
+                topics.setdefault(topic, []).append(message)
+        for topic, messages in topics.items():
+            pipe.rpush(topic, *messages)
+        self.metrics["batches"] += 1
+        try:
+            await pipe.execute()
+        except (RedisError, RedisClusterException) as err:
+            self.send_ok = False
+            if self.overflow_policy == OVERFLOW_SPILL:
+                LOGGER.warning(f"Failed to publish {len(batch)} events, {err}")
+                await self.spill(batch)
+                return False
+            self.metrics["failed"] += len(batch)
+            LOGGER.exception(f"Failed to publish {len(batch)} events, {err}")
+            return False
+        self.send_ok = True
+        self.metrics["published"] += len(batch)
+        return True
+
+    async def spill(self, batch: List[Tuple[str, bytes, bool]]):
+        """Append messages to the spill file."""
+        lines = "".join(
+            json.dumps(
+                {
+                    "topic": topic,
+                    "message": base64.b64encode(message).decode(),
+                    "stream": stream,
+                }
+            )
+            + "\n"
+            for topic, message, stream in batch
+        )
+        # Appends are serialized so concurrent spills do not interleave
+        async with self.spill_lock:
+            await asyncio.get_event_loop().run_in_executor(
+                None, self.write_spill, lines
+            )
+        self.metrics["spilled"] += len(batch)
+
+    def write_spill(self, lines: str):
+        """Append lines to the spill file, run in an executor."""
+        with open(self.spill_path, "a") as spill_file:
+            spill_file.write(lines)
+
+    async def replay_spill(self):
+        """Publish spilled messages, oldest first.
+
+        The spill file is read in batches in an executor. If a batch fails, it
+        is spilled again along with the messages not replayed yet, so they are
+        only counted as replayed once they are published.
+        """
+        if not self.spill_path:
+            return
+        loop = asyncio.get_event_loop()
+        async with self.spill_lock:
+            replay_file = await loop.run_in_executor(None, self.open_replay)
+        if not replay_file:
+            return
+        try:
+            while True:
+                batch = await loop.run_in_executor(
+                    None, self.read_replay_batch, replay_file
+                )
+                if not batch:
+                    break
+                if not await self.send_batch(batch):
+                    async with self.spill_lock:
+                        await loop.run_in_executor(
+                            None, self.write_spill, replay_file.read()
+                        )
+                    break
+                self.metrics["replayed"] += len(batch)
+        finally:
+            await loop.run_in_executor(None, replay_file.close)
+        await loop.run_in_executor(None, os.remove, replay_file.name)
+
+    def open_replay(self) -> Optional[TextIO]:
+        """Move the spill file aside and open it, run in an executor."""
+        replay_path = f"{self.spill_path}.replay"
+        # A replay file is left behind if a previous replay was interrupted
+        if not os.path.exists(replay_path):
+            if not os.path.exists(self.spill_path):
+                return None
+            os.replace(self.spill_path, replay_path)
+        return open(replay_path)
+
+    def read_replay_batch(self, replay_file: TextIO) -> List[Tuple[str, bytes, bool]]:
+        """Read up to batch_size spilled messages, run in an executor."""
+        batch = []
+        while len(batch) < self.batch_size:
+            line = replay_file.readline()
+            if not line:
+                break
+            try:
+                record = json.loads(line)
+                batch.append(
+                    (
+                        record["topic"],
+                        base64.b64decode(record["message"]),
+                        record.get("stream", False),
+                    )
+                )
+            except (ValueError, KeyError, TypeError) as err:
+                LOGGER.error(f"Skipping malformed spilled event: {err}")
+        return batch
+
+    async def close(self):
+        """Stop the background task and push pending messages."""
+        if self.task and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        LOGGER.info("Event publisher metrics: %s", self.get_metrics())
@@ -1,7 +1,6 @@
 import asyncio
 import base64
 import json
-from json import JSONDecodeError
 import logging
 from typing import cast
 from uuid import uuid4
@@ -16,15 +15,17 @@ from aries_cloudagent.transport.wire_format import (
     DIDCOMM_V0_MIME_TYPE,
     DIDCOMM_V1_MIME_TYPE,
 )
-from redis.asyncio import RedisCluster
 from redis.exceptions import RedisError, RedisClusterException
 
 from .utils import (
-    curr_datetime_to_str,
+    MediatorKeys,
     b64_to_bytes,
+    record_inbound_msg_received,
 )
 
+from .client import REDIS_CLIENTS, RedisClient, ping_redis
 from .config import get_config, InboundConfig, ConnectionConfig
+from .envelope import decode_envelope
 
 LOGGER = logging.getLogger(__name__)
 
@@ -51,29 +52,35 @@ class RedisInboundTransport(BaseInboundTransport):
             get_config(self.root_profile.context.settings).inbound
             or InboundConfig.default()
         )
-        self.redis = self.root_profile.inject_or(RedisCluster)
+        self.redis = self.root_profile.inject_or(RedisClient)
         self.inbound_topic = self.inbound_config.acapy_inbound_topic
         self.direct_response_topic = self.inbound_config.acapy_direct_resp_topic
+        connection_config = (
+            get_config(self.root_profile.context.settings).connection
+            or ConnectionConfig.default()
+        )
+        self.mediator_keys = MediatorKeys(connection_config.mediator_key_prefix)
         if not self.redis:
-            self.connection_url = (
-                get_config(self.root_profile.context.settings).connection
-                or ConnectionConfig.default()
-            ).connection_url
-            self.redis = RedisCluster.from_url(url=self.connection_url)
+            self.connection_url = connection_config.connection_url
+            self.redis = REDIS_CLIENTS.get(
+                self.connection_url, **connection_config.client_options()
+            )
 
     async def start(self):
-        await self.redis.ping(target_nodes=RedisCluster.PRIMARIES)
+        await ping_redis(self.redis)
         plugin_uid = str(uuid4()).encode("utf-8")
         new_recip_keys_set = base64.urlsafe_b64encode(
             json.dumps([]).encode("utf-8")
         ).decode()
-        await self.redis.hset("uid_recip_keys_map", plugin_uid, new_recip_keys_set)
+        await self.redis.hset(
+            self.mediator_keys.uid_recip_keys_map, plugin_uid, new_recip_keys_set
+        )
         retry_counter = 0
         LOGGER.info(f"New plugin instance {plugin_uid.decode()} setup")
         while self.running:
             try:
                 recip_keys_encoded = await self.redis.hget(
-                    "uid_recip_keys_map", plugin_uid
+                    self.mediator_keys.uid_recip_keys_map, plugin_uid
                 )
                 if not recip_keys_encoded:
                     await asyncio.sleep(0.2)
@@ -110,29 +117,14 @@ class RedisInboundTransport(BaseInboundTransport):
                     continue
                 msg_bytes = msg[1]
                 try:
-                    inbound = json.loads(msg_bytes)
-                    payload = base64.urlsafe_b64decode(inbound["payload"])
-                except (JSONDecodeError, KeyError):
+                    inbound = decode_envelope(msg_bytes)
+                    payload = inbound["payload"]
+                except (ValueError, KeyError, TypeError):
                     LOGGER.exception("Received invalid inbound message record")
                     continue
-                await self.redis.hset(
-                    "uid_last_access_map",
-                    plugin_uid,
-                    curr_datetime_to_str().encode("utf-8"),
+                await record_inbound_msg_received(
+                    self.redis, plugin_uid, recip_key, self.mediator_keys
                 )
-                uid_recip_key = f"{plugin_uid.decode()}_{recip_key}".encode("utf-8")
-                enc_uid_recip_key_count = await self.redis.hget(
-                    "uid_recip_key_pending_msg_count", uid_recip_key
-                )
-                if (
-                    enc_uid_recip_key_count
-                    and int(enc_uid_recip_key_count.decode()) >= 1
-                ):
-                    await self.redis.hset(
-                        "uid_recip_key_pending_msg_count",
-                        uid_recip_key,
-                        (int(enc_uid_recip_key_count.decode()) - 1),
-                    )
                 try:
                     direct_reponse_requested = True if "txn_id" in inbound else False
                     session = await self.create_session(
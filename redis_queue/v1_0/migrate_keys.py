@@ -0,0 +1,81 @@
+"""Copy the mediator metadata from the legacy keys to prefixed ones.
+
+    REDIS_SERVER_URL=... python -m redis_queue.v1_0.migrate_keys --prefix PREFIX
+
+Run it while the plugin and relays are stopped, then start them with
+connection.mediator_key_prefix and MEDIATOR_KEY_PREFIX set to PREFIX.
+"""
+import argparse
+import asyncio
+import logging
+
+from os import getenv
+
+from .client import RedisClient, create_redis_client, redis_client_options_from_env
+from .utils import LEGACY_MEDIATOR_KEYS, MediatorKeys
+
+HASH_NAMES = (
+    "uid_recip_keys_map",
+    "recip_key_uid_map",
+    "uid_last_access_map",
+    "uid_recip_key_pending_msg_count",
+)
+
+
+async def migrate_mediator_keys(
+    redis: RedisClient, keys: MediatorKeys, delete_legacy: bool = False
+) -> int:
+    """Copy the legacy mediator metadata keys to keys.
+
+    Returns the number of copied keys. Existing fields of keys are
+    overwritten. The legacy keys are deleted once copied if delete_legacy.
+    """
+    if not keys.co_located:
+        raise ValueError("Mediator keys to migrate to must have a prefix")
+    migrated = 0
+    for name in HASH_NAMES:
+        legacy_key = getattr(LEGACY_MEDIATOR_KEYS, name)
+        mapping = await redis.hgetall(legacy_key)
+        if not mapping:
+            continue
+        await redis.hset(getattr(keys, name), mapping=mapping)
+        migrated += 1
+    round_robin_iterator = await redis.get(LEGACY_MEDIATOR_KEYS.round_robin_iterator)
+    if round_robin_iterator is not None:
+        await redis.set(keys.round_robin_iterator, round_robin_iterator)
+        migrated += 1
+    if delete_legacy:
+        for name in MediatorKeys.NAMES:
+            await redis.delete(getattr(LEGACY_MEDIATOR_KEYS, name))
+    return migrated
+
+
+async def main(args=None):
+    """Migrate the mediator metadata keys."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--prefix", required=True, help="mediator key prefix")
+    parser.add_argument(
+        "--url", default=getenv("REDIS_SERVER_URL"), help="redis connection url"
+    )
+    parser.add_argument(
+        "--delete-legacy",
+        action="store_true",
+        help="delete the legacy keys once copied",
+    )
+    args = parser.parse_args(args)
+    if not args.url:
+        raise SystemExit("No Redis host/connection provided.")
+    redis = create_redis_client(args.url, **redis_client_options_from_env())
+    migrated = await migrate_mediator_keys(
+        redis, MediatorKeys(args.prefix), delete_legacy=args.delete_legacy
+    )
+    logging.info(f"Migrated {migrated} mediator metadata keys")
+    await redis.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s | %(levelname)s: %(message)s",
+        level=logging.INFO,
+    )
+    asyncio.run(main())
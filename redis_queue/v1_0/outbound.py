@@ -1,7 +1,4 @@
 """Basic in memory queue."""
-import base64
-import json
-
 import logging
 
 from aries_cloudagent.transport.wire_format import BaseWireFormat
@@ -16,11 +13,15 @@ from aries_cloudagent.transport.wire_format import (
     DIDCOMM_V1_MIME_TYPE,
 )
 
-from redis.asyncio import RedisCluster
 from redis.exceptions import RedisError, RedisClusterException
 
+from .client import REDIS_CLIENTS, RedisClient, ping_redis
 from .config import OutboundConfig, ConnectionConfig, get_config
+from .envelope import encode_envelope
 from .utils import (
+    MediatorKeys,
+    compress_payload,
+    get_outbound_shard_topic,
     process_payload_recip_key,
 )
 
@@ -49,19 +50,23 @@ class RedisOutboundQueue(BaseOutboundTransport):
             "Setting up redis outbound queue with configuration: %s",
             self.outbound_config,
         )
-        self.redis = root_profile.inject_or(RedisCluster)
+        self.redis = root_profile.inject_or(RedisClient)
         self.is_mediator = self.outbound_config.mediator_mode
         self.outbound_topic = self.outbound_config.acapy_outbound_topic
+        connection_config = (
+            get_config(root_profile.context.settings).connection
+            or ConnectionConfig.default()
+        )
+        self.mediator_keys = MediatorKeys(connection_config.mediator_key_prefix)
         if not self.redis:
-            self.connection_url = (
-                get_config(root_profile.context.settings).connection
-                or ConnectionConfig.default()
-            ).connection_url
-            self.redis = RedisCluster.from_url(url=self.connection_url)
+            self.connection_url = connection_config.connection_url
+            self.redis = REDIS_CLIENTS.get(
+                self.connection_url, **connection_config.client_options()
+            )
 
     async def start(self):
         """Start the queue."""
-        await self.redis.ping(target_nodes=RedisCluster.PRIMARIES)
+        await ping_redis(self.redis)
 
     async def stop(self):
         """Stop the queue."""
@@ -90,17 +95,34 @@ class RedisOutboundQueue(BaseOutboundTransport):
             headers["Content-Type"] = "application/json"
             payload = payload.encode("utf-8")
         topic = self.outbound_topic
-        message = str.encode(
-            json.dumps(
+        envelope_format = self.outbound_config.envelope_format
+        if self.is_mediator:
+            topic = await process_payload_recip_key(
+                self.redis, payload, topic, self.mediator_keys
+            )
+            message = encode_envelope({}, payload, envelope_format)
+        else:
+            topic = get_outbound_shard_topic(
+                topic, endpoint, self.outbound_config.outbound_shards
+            )
+            compression = self.outbound_config.compression
+            envelope_payload = payload
+            envelope_metadata = {}
+            if (
+                compression
+                and len(payload) >= self.outbound_config.compression_threshold
+            ):
+                envelope_payload = compress_payload(payload, compression)
+                envelope_metadata["content-encoding"] = compression
+            message = encode_envelope(
                 {
                     "service": {"url": endpoint},
-                    "payload": base64.urlsafe_b64encode(payload).decode(),
                     "headers": headers,
-                }
-            ),
-        )
-        if self.is_mediator:
-            topic, message = await process_payload_recip_key(self.redis, payload, topic)
+                    "metadata": envelope_metadata,
+                },
+                envelope_payload,
+                envelope_format,
+            )
         try:
             LOGGER.info(
                 "  - Adding outbound message to Redis: (%s): %s",
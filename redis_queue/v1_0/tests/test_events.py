@@ -1,5 +1,10 @@
+import asyncio
+import base64
+import os
 import redis
 import json
+import tempfile
+import zlib
 
 from aries_cloudagent.core.in_memory import InMemoryProfile
 from aries_cloudagent.core.event_bus import EventWithMetadata, Event, MockEventBus
@@ -9,7 +14,7 @@ from aries_cloudagent.transport.error import TransportError
 from aiohttp.test_utils import unused_port
 from asynctest import TestCase as AsyncTestCase, mock as async_mock, PropertyMock
 from copy import deepcopy
-from redis.asyncio import RedisCluster
+from pydantic import ValidationError
 from redis.exceptions import RedisError
 
 from ..events import (
@@ -20,6 +25,11 @@ from ..events import (
     redis_setup,
     process_event_payload,
 )
+from ..client import REDIS_CLIENTS, RedisClient
+from ..config import EventConfig, EventFilter, OutboundConfig
+from ..events.filters import apply_event_filter, project_fields
+from ..events.matcher import EventTopicMatcher
+from ..events.publisher import EventPublisher
 from .. import events as test_module
 
 SETTINGS = {
@@ -79,15 +89,23 @@ TEST_PAYLOAD_BYTES = (json.dumps(TEST_PAYLOAD_DICT)).encode()
 
 class TestRedisEvents(AsyncTestCase):
     def setUp(self):
+        REDIS_CLIENTS.clear()
         self.port = unused_port()
         self.session = None
         self.profile = InMemoryProfile.test_profile()
 
     async def test_setup(self):
+        bus = MockEventBus()
         context = async_mock.MagicMock(
-            settings=SETTINGS, inject=async_mock.MagicMock(return_value=MockEventBus())
+            settings=SETTINGS, inject=async_mock.MagicMock(return_value=bus)
         )
         await setup(context)
+        # one combined subscription for all event topic maps
+        assert len(bus.topic_patterns_to_subscribers) == 3
+        handle_event_pattern = next(iter(bus.topic_patterns_to_subscribers))
+        assert handle_event_pattern.match("acapy::record::connections::active")
+        assert handle_event_pattern.match("acapy::ping::received")
+        assert not handle_event_pattern.match("acapy::test")
 
     async def test_setup_x(self):
         context = async_mock.MagicMock(
@@ -107,6 +125,17 @@ class TestRedisEvents(AsyncTestCase):
             ),
         ):
             await on_startup(self.profile, test_event)
+        publisher = self.profile.inject_or(EventPublisher)
+        assert publisher
+        # Profiles derived from the root one share its publisher
+        sub_profile = InMemoryProfile(context=self.profile.context.copy())
+        assert sub_profile.inject(EventPublisher) is publisher
+        with async_mock.patch.object(
+            publisher, "close", async_mock.CoroutineMock()
+        ) as mock_close:
+            await on_shutdown(self.profile, test_event)
+            mock_close.assert_called_once()
+        publisher.task.cancel()
 
     async def test_on_startup_x(self):
         self.profile.settings["plugin_config"] = SETTINGS["plugin_config"]
@@ -119,18 +148,46 @@ class TestRedisEvents(AsyncTestCase):
             with self.assertRaises(TransportError):
                 await on_startup(self.profile, test_event)
 
+    async def test_get_publisher_concurrent(self):
+        self.profile.settings["plugin_config"] = SETTINGS["plugin_config"]
+        test_event = Event("test_topic", {})
+        mock_redis = async_mock.MagicMock(ping=async_mock.CoroutineMock())
+
+        async def mock_redis_setup(profile, event):
+            await asyncio.sleep(0.01)
+            return mock_redis
+
+        with async_mock.patch.object(test_module, "redis_setup", mock_redis_setup):
+            publishers = await asyncio.gather(
+                test_module.get_publisher(self.profile, test_event),
+                test_module.get_publisher(self.profile, test_event),
+            )
+        assert publishers[0] is publishers[1]
+        await publishers[0].close()
+
     async def test_on_shutddown(self):
         self.profile.settings["plugin_config"] = SETTINGS["plugin_config"]
         test_event = Event("test_topic", {"rev_reg_id": "mock", "crids": ["mock"]})
         await on_shutdown(self.profile, test_event)
 
+    async def test_config_compression_zstd(self):
+        with async_mock.patch("redis_queue.v1_0.utils.zstandard", None):
+            with self.assertRaises(ValidationError):
+                EventConfig(compression="zstd")
+            with self.assertRaises(ValidationError):
+                OutboundConfig(compression="zstd")
+            assert EventConfig(compression="zlib").compression == "zlib"
+        with async_mock.patch("redis_queue.v1_0.utils.zstandard", object()):
+            assert EventConfig(compression="zstd").compression == "zstd"
+
     async def test_handle_event(self):
         self.profile.settings["emit_new_didcomm_mime_type"] = True
         self.profile.settings["wallet.id"] = "test_wallet_id"
+        mock_pipe = async_mock.MagicMock(execute=async_mock.CoroutineMock())
         self.profile.context.injector.bind_instance(
-            RedisCluster,
+            RedisClient,
             async_mock.MagicMock(
-                rpush=async_mock.CoroutineMock(),
+                pipeline=async_mock.MagicMock(return_value=mock_pipe),
             ),
         )
         test_event_with_metadata = async_mock.MagicMock(
@@ -216,11 +273,20 @@ class TestRedisEvents(AsyncTestCase):
             ),
         )
         await handle_event(self.profile, real_event_with_metadata)
+        await on_shutdown(self.profile, None)
+        mock_pipe.execute.assert_called_once()
+        assert mock_pipe.rpush.call_args_list[0][0][0] == "acapy-basicmessage-received"
+        assert len(mock_pipe.rpush.call_args_list[0][0]) == 2
+        assert mock_pipe.rpush.call_args_list[1][0][0] == (
+            "acapy-outbound-message-queued-for-delivery"
+        )
+        assert len(mock_pipe.rpush.call_args_list[1][0]) == 3
 
     async def test_handle_event_deliver_webhook(self):
         test_settings = deepcopy(SETTINGS)
         test_settings["plugin_config"]["redis_queue"]["event"] = {
-            "deliver_webhook": True
+            "deliver_webhook": True,
+            "webhook_fanout": True,
         }
         self.profile.settings["plugin_config"] = test_settings["plugin_config"]
         self.profile.settings["emit_new_didcomm_mime_type"] = True
@@ -229,10 +295,11 @@ class TestRedisEvents(AsyncTestCase):
             "http://0.0.0.0:9000#test_api_key_a",
             "ws://0.0.0.0:9001",
         ]
+        mock_pipe = async_mock.MagicMock(execute=async_mock.CoroutineMock())
         self.profile.context.injector.bind_instance(
-            RedisCluster,
+            RedisClient,
             async_mock.MagicMock(
-                rpush=async_mock.CoroutineMock(),
+                pipeline=async_mock.MagicMock(return_value=mock_pipe),
             ),
         )
         test_event_with_metadata = async_mock.MagicMock(
@@ -246,6 +313,78 @@ class TestRedisEvents(AsyncTestCase):
             ),
         )
         await handle_event(self.profile, test_event_with_metadata)
+        await on_shutdown(self.profile, None)
+        assert mock_pipe.rpush.call_args_list[0][0][0] == "acapy-basicmessage-received"
+        outbound_topic, webhook = mock_pipe.rpush.call_args_list[1][0]
+        assert outbound_topic == "acapy_outbound"
+        webhook = json.loads(webhook)
+        assert [target["service"]["url"] for target in webhook["targets"]] == [
+            "http://0.0.0.0:9000/topic/basicmessages/",
+            "ws://0.0.0.0:9001/topic/basicmessages/",
+        ]
+        event = json.loads(mock_pipe.rpush.call_args_list[0][0][1])
+        assert event["metadata"] == {"x-wallet-id": "test_wallet_id"}
+        assert (
+            json.loads(base64.urlsafe_b64decode(webhook["payload"])) == event["payload"]
+        )
+
+        # one message per webhook url without fan-out, the default
+        del test_settings["plugin_config"]["redis_queue"]["event"]["webhook_fanout"]
+        self.profile.settings["plugin_config"] = test_settings["plugin_config"]
+        mock_pipe.rpush.reset_mock()
+        await handle_event(self.profile, test_event_with_metadata)
+        await self.profile.inject(EventPublisher).flush()
+        outbound_topic, *webhooks = mock_pipe.rpush.call_args_list[1][0]
+        assert outbound_topic == "acapy_outbound"
+        assert [json.loads(webhook)["service"]["url"] for webhook in webhooks] == [
+            "http://0.0.0.0:9000/topic/basicmessages/",
+            "ws://0.0.0.0:9001/topic/basicmessages/",
+        ]
+        for webhook in webhooks:
+            assert (
+                json.loads(base64.urlsafe_b64decode(json.loads(webhook)["payload"]))
+                == event["payload"]
+            )
+
+    async def test_handle_event_compressed(self):
+        test_settings = deepcopy(SETTINGS)
+        test_settings["plugin_config"]["redis_queue"]["event"] = {
+            "compression": "zlib",
+            "compression_threshold": 10,
+        }
+        test_settings["plugin_config"]["redis_queue"]["outbound"][
+            "compression"
+        ] = "zlib"
+        self.profile.settings["plugin_config"] = test_settings["plugin_config"]
+        self.profile.settings["wallet.id"] = "test_wallet_id"
+        self.profile.settings["admin.webhook_urls"] = ["http://0.0.0.0:9000"]
+        mock_pipe = async_mock.MagicMock(execute=async_mock.CoroutineMock())
+        self.profile.context.injector.bind_instance(
+            RedisClient,
+            async_mock.MagicMock(
+                pipeline=async_mock.MagicMock(return_value=mock_pipe),
+            ),
+        )
+        test_event_with_metadata = async_mock.MagicMock(
+            payload={"state": "test_state"},
+            topic="acapy::basicmessage::received",
+        )
+        await handle_event(self.profile, test_event_with_metadata)
+        await on_shutdown(self.profile, None)
+        event = json.loads(mock_pipe.rpush.call_args_list[0][0][1])
+        assert event["metadata"] == {
+            "x-wallet-id": "test_wallet_id",
+            "content-encoding": "zlib",
+        }
+        assert json.loads(zlib.decompress(base64.urlsafe_b64decode(event["payload"])))[
+            "payload"
+        ] == {"state": "test_state"}
+        # below the default outbound threshold
+        webhook = json.loads(mock_pipe.rpush.call_args_list[1][0][1])
+        assert webhook["metadata"] == {}
+        assert json.loads(base64.urlsafe_b64decode(webhook["payload"]))["payload"] == {
+            "state": "test_state"
+        }
 
     async def test_handle_event_x(self):
         self.profile.settings["emit_new_didcomm_mime_type"] = False
@@ -254,8 +393,12 @@ class TestRedisEvents(AsyncTestCase):
             "redis_setup",
             async_mock.CoroutineMock(
                 return_value=async_mock.MagicMock(
-                    rpush=async_mock.CoroutineMock(
-                        side_effect=redis.exceptions.RedisError
+                    pipeline=async_mock.MagicMock(
+                        return_value=async_mock.MagicMock(
+                            execute=async_mock.CoroutineMock(
+                                side_effect=redis.exceptions.RedisError
+                            )
+                        )
                     ),
                 )
             ),
@@ -273,6 +416,430 @@ class TestRedisEvents(AsyncTestCase):
                 ),
             )
             await handle_event(self.profile, test_event_with_metadata)
+            await on_shutdown(self.profile, None)
+
+    async def test_event_publisher_batch(self):
+        mock_pipe = async_mock.MagicMock(execute=async_mock.CoroutineMock())
+        mock_redis = async_mock.MagicMock(
+            pipeline=async_mock.MagicMock(return_value=mock_pipe)
+        )
+        publisher = EventPublisher(mock_redis, batch_size=2, linger_ms=1000)
+        await publisher.publish("topic_a", b"1")
+        await publisher.publish("topic_b", b"2")
+        await publisher.publish("topic_a", b"3")
+        # publishing never waits on Redis
+        mock_pipe.execute.assert_not_called()
+        await asyncio.sleep(0.1)
+        assert mock_pipe.execute.call_count == 2
+        mock_pipe.rpush.assert_has_calls(
+            [
+                async_mock.call("topic_a", b"1"),
+                async_mock.call("topic_b", b"2"),
+                async_mock.call("topic_a", b"3"),
+            ]
+        )
+        await publisher.publish("topic_a", b"4")
+        await publisher.close()
+        mock_pipe.rpush.assert_called_with("topic_a", b"4")
+        assert publisher.get_metrics() == {
+            "published": 4,
+            "failed": 0,
+            "dropped": 0,
+            "spilled": 0,
+            "replayed": 0,
+            "batches": 3,
+            "buffered": 0,
+        }
+
+    async def test_event_publisher_linger(self):
+        mock_pipe = async_mock.MagicMock(execute=async_mock.CoroutineMock())
+        mock_redis = async_mock.MagicMock(
+            pipeline=async_mock.MagicMock(return_value=mock_pipe)
+        )
+        publisher = EventPublisher(mock_redis, batch_size=100, linger_ms=1)
+        await publisher.publish("topic_a", b"1")
+        await publisher.publish("topic_a", b"2")
+        await asyncio.sleep(0.05)
+        mock_pipe.execute.assert_called_once()
+        mock_pipe.rpush.assert_called_once_with("topic_a", b"1", b"2")
+        await publisher.close()
+
+    async def test_event_publisher_overflow(self):
+        mock_pipe = async_mock.MagicMock(
+            execute=async_mock.CoroutineMock(side_effect=RedisError)
+        )
+        mock_redis = async_mock.MagicMock(
+            pipeline=async_mock.MagicMock(return_value=mock_pipe)
+        )
+        with self.assertRaises(ValueError):
+            EventPublisher(mock_redis, overflow_policy="test")
+        with self.assertRaises(ValueError):
+            EventPublisher(mock_redis, overflow_policy="spill")
+
+        publisher = EventPublisher(
+            mock_redis, batch_size=2, max_buffer=2, overflow_policy="drop_oldest"
+        )
+        publisher.start = async_mock.MagicMock()
+        for message in (b"1", b"2", b"3"):
+            await publisher.publish("topic_a", message)
+        assert list(publisher.buffer) == [
+            ("topic_a", b"2", False),
+            ("topic_a", b"3", False),
+        ]
+        await publisher.close()
+        assert publisher.get_metrics()["dropped"] == 1
+        assert publisher.get_metrics()["failed"] == 2
+
+        mock_pipe.execute.side_effect = None
+        publisher = EventPublisher(mock_redis, batch_size=1, max_buffer=1)
+        publisher.start = async_mock.MagicMock()
+        await publisher.publish("topic_a", b"1")
+        blocked = asyncio.ensure_future(publisher.publish("topic_a", b"2"))
+        await asyncio.sleep(0)
+        assert not blocked.done()
+        await publisher.flush()
+        await blocked
+        mock_pipe.rpush.assert_called_with("topic_a", b"2")
+
+    async def test_event_publisher_spill(self):
+        mock_pipe = async_mock.MagicMock(execute=async_mock.CoroutineMock())
+        mock_redis = async_mock.MagicMock(
+            pipeline=async_mock.MagicMock(return_value=mock_pipe)
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            spill_path = os.path.join(tmp_dir, "spill")
+            publisher = EventPublisher(
+                mock_redis,
+                batch_size=1,
+                max_buffer=1,
+                overflow_policy="spill",
+                spill_path=spill_path,
+            )
+            publisher.start = async_mock.MagicMock()
+            for message in (b"1", b"2"):
+                await publisher.publish("topic_a", message)
+            await publisher.publish("topic_b", b"3", stream=True)
+            assert list(publisher.buffer) == [("topic_a", b"1", False)]
+            assert publisher.get_metrics()["spilled"] == 2
+            await publisher.flush()
+            await publisher.replay_spill()
+            mock_pipe.rpush.assert_has_calls(
+                [
+                    async_mock.call("topic_a", b"1"),
+                    async_mock.call("topic_a", b"2"),
+                ]
+            )
+            mock_pipe.xadd.assert_called_once_with(
+                "topic_b", {"event": b"3"}, approximate=True, maxlen=10000
+            )
+            assert publisher.get_metrics()["replayed"] == 2
+            assert not os.listdir(tmp_dir)
+
+            # A batch that fails to publish is spilled, not discarded
+            mock_pipe.execute.side_effect = RedisError
+            await publisher.publish("topic_a", b"4")
+            await publisher.flush()
+            assert publisher.get_metrics()["spilled"] == 3
+            assert publisher.get_metrics()["failed"] == 0
+            mock_pipe.execute.side_effect = None
+            await publisher.replay_spill()
+            mock_pipe.rpush.assert_called_with("topic_a", b"4")
+            assert not os.listdir(tmp_dir)
+
+    async def test_event_publisher_replay_spill_x(self):
+        mock_pipe = async_mock.MagicMock(
+            execute=async_mock.CoroutineMock(side_effect=RedisError)
+        )
+        mock_redis = async_mock.MagicMock(
+            pipeline=async_mock.MagicMock(return_value=mock_pipe)
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            spill_path = os.path.join(tmp_dir, "spill")
+            publisher = EventPublisher(
+                mock_redis,
+                batch_size=1,
+                overflow_policy="spill",
+                spill_path=spill_path,
+            )
+            await publisher.spill([("topic_a", b"1", False), ("topic_a", b"2", False)])
+            with open(spill_path, "a") as spill_file:
+                spill_file.write("invalid\n")
+            await publisher.spill([("topic_a", b"3", False)])
+            spilled = publisher.get_metrics()["spilled"]
+            # The failed batch and the events after it are spilled again
+            await publisher.replay_spill()
+            assert mock_pipe.execute.call_count == 1
+            assert publisher.get_metrics()["replayed"] == 0
+            assert os.listdir(tmp_dir) == ["spill"]
+            mock_pipe.execute.side_effect = None
+            await publisher.replay_spill()
+            mock_pipe.rpush.assert_has_calls(
+                [
+                    async_mock.call("topic_a", b"1"),
+                    async_mock.call("topic_a", b"2"),
+                    async_mock.call("topic_a", b"3"),
+                ]
+            )
+            metrics = publisher.get_metrics()
+            assert metrics["replayed"] == 3
+            assert metrics["spilled"] == spilled + 1
+            assert not os.listdir(tmp_dir)
+
+    async def test_event_publisher_replay_after_send(self):
+        mock_pipe = async_mock.MagicMock(
+            execute=async_mock.CoroutineMock(side_effect=RedisError)
+        )
+        mock_redis = async_mock.MagicMock(
+            pipeline=async_mock.MagicMock(return_value=mock_pipe)
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            publisher = EventPublisher(
+                mock_redis,
+                linger_ms=0,
+                overflow_policy="spill",
+                spill_path=os.path.join(tmp_dir, "spill"),
+            )
+            with async_mock.patch.object(
+                publisher, "replay_spill", async_mock.CoroutineMock()
+            ) as mock_replay_spill:
+                await publisher.publish("topic_a", b"1")
+                await asyncio.sleep(0.05)
+                # Only the replay on start, the send failed
+                mock_replay_spill.assert_called_once()
+                mock_pipe.execute.side_effect = None
+                await publisher.publish("topic_a", b"2")
+                await asyncio.sleep(0.05)
+                assert mock_replay_spill.call_count == 2
+                await publisher.close()
+
+    async def test_event_publisher_stream(self):
+        mock_pipe = async_mock.MagicMock(execute=async_mock.CoroutineMock())
+        mock_redis = async_mock.MagicMock(
+            pipeline=async_mock.MagicMock(return_value=mock_pipe)
+        )
+        publisher = EventPublisher(mock_redis, stream_maxlen=100)
+        publisher.start = async_mock.MagicMock()
+        await publisher.publish("topic_a", b"1", stream=True)
+        await publisher.publish("topic_a", b"2", stream=True)
+        await publisher.publish("topic_b", b"3")
+        await publisher.flush()
+        mock_pipe.xadd.assert_has_calls(
+            [
+                async_mock.call(
+                    "topic_a", {"event": b"1"}, approximate=True, maxlen=100
+                ),
+                async_mock.call(
+                    "topic_a", {"event": b"2"}, approximate=True, maxlen=100
+                ),
+            ]
+        )
+        mock_pipe.rpush.assert_called_once_with("topic_b", b"3")
+
+        publisher.stream_max_age_ms = 60000
+        with async_mock.patch.object(
+            test_module.publisher, "time", async_mock.MagicMock(return_value=100)
+        ):
+            await publisher.publish("topic_a", b"4", stream=True)
+            await publisher.flush()
+        mock_pipe.xadd.assert_called_with(
+            "topic_a", {"event": b"4"}, approximate=True, minid=40000
+        )
+
+        publisher.stream_max_age_ms = 0
+        publisher.stream_maxlen = 0
+        await publisher.publish("topic_a", b"5", stream=True)
+        await publisher.flush()
+        mock_pipe.xadd.assert_called_with("topic_a", {"event": b"5"}, approximate=True)
+
+    async def test_handle_event_stream_mode(self):
+        test_settings = deepcopy(SETTINGS)
+        test_settings["plugin_config"]["redis_queue"]["event"] = {
+            "stream_mode": True,
+            "stream_maxlen": 500,
+        }
+        self.profile.settings["plugin_config"] = test_settings["plugin_config"]
+        self.profile.settings["wallet.id"] = "test_wallet_id"
+        mock_pipe = async_mock.MagicMock(execute=async_mock.CoroutineMock())
+        self.profile.context.injector.bind_instance(
+            RedisClient,
+            async_mock.MagicMock(
+                pipeline=async_mock.MagicMock(return_value=mock_pipe),
+            ),
+        )
+        test_event_with_metadata = async_mock.MagicMock(
+            payload={"state": "test_state"},
+            topic="acapy::record::connections::active",
+            metadata=async_mock.MagicMock(
+                pattern=async_mock.MagicMock(
+                    pattern="^acapy::record::([^:]*)::([^:]*)$"
+                )
+            ),
+        )
+        await handle_event(self.profile, test_event_with_metadata)
+        await on_shutdown(self.profile, None)
+        assert [call[0][0] for call in mock_pipe.xadd.call_args_list] == [
+            "acapy-record-with-state-test_wallet_id",
+            "acapy-record-test_wallet_id",
+        ]
+        fields = mock_pipe.xadd.call_args[0][1]
+        assert json.loads(fields["event"])["payload"]["state"] == "test_state"
+        assert mock_pipe.xadd.call_args[1] == {"approximate": True, "maxlen": 500}
+        mock_pipe.rpush.assert_not_called()
+
+    def test_event_topic_matcher(self):
+        topic_maps = {
+            "^acapy::record::([^:]*)::([^:]*)$": "acapy-record-with-state-$wallet_id",
+            "^acapy::record::([^:])?": "acapy-record-$wallet_id",
+            "acapy::ping::received": "acapy-ping-received",
+        }
+        matcher = EventTopicMatcher(topic_maps, "first")
+        assert matcher.templates_for("acapy::record::connections::active") == (
+            "acapy-record-with-state-$wallet_id",
+        )
+        assert matcher.templates_for("acapy::record::connections") == (
+            "acapy-record-$wallet_id",
+        )
+        assert matcher.templates_for("acapy::ping::received") == (
+            "acapy-ping-received",
+        )
+        assert matcher.templates_for("acapy::test") == ()
+        matcher.templates_for("acapy::ping::received")
+        assert matcher.templates_for.cache_info().hits == 1
+
+        matcher = EventTopicMatcher(
+            {**topic_maps, "^acapy::record::connections": "acapy-record-$wallet_id"}
+        )
+        assert matcher.match_mode == "all"
+        # Each template is used once, even if several patterns map to it
+        assert matcher.templates_for("acapy::record::connections::active") == (
+            "acapy-record-with-state-$wallet_id",
+            "acapy-record-$wallet_id",
+        )
+        with self.assertRaises(ValueError):
+            EventTopicMatcher(topic_maps, "test")
+
+    def test_get_topic_matcher(self):
+        config = test_module.EventConfig.default()
+        matcher = test_module.get_topic_matcher(config)
+        assert test_module.get_topic_matcher(config) is matcher
+        assert matcher.match_mode == "all"
+        assert matcher.templates_for("acapy::record::connections::active") == (
+            "acapy-record-with-state-$wallet_id",
+            "acapy-record-$wallet_id",
+        )
+        assert test_module.get_topic_matcher(
+            test_module.EventConfig(event_topic_match="first")
+        ).templates_for("acapy::record::connections::active") == (
+            "acapy-record-with-state-$wallet_id",
+        )
+
+    def test_project_fields(self):
+        value = {"a": 1, "b": {"c": 2, "d": {"e": 3, "f": 4}}, "g": [5]}
+        assert project_fields(value) is value
+        assert project_fields(value, include_fields=["a", "b.d.e", "x.y"]) == {
+            "a": 1,
+            "b": {"d": {"e": 3}},
+        }
+        assert project_fields(value, exclude_fields=["g", "b.d.f", "x.y"]) == {
+            "a": 1,
+            "b": {"c": 2, "d": {"e": 3}},
+        }
+        assert project_fields(
+            value, include_fields=["b"], exclude_fields=["b.c", "b.d"]
+        ) == {"b": {}}
+        # projection never modifies the event payload
+        assert value == {"a": 1, "b": {"c": 2, "d": {"e": 3, "f": 4}}, "g": [5]}
+
+    def test_apply_event_filter(self):
+        payload = {
+            "wallet_id": "base",
+            "state": "offer-sent",
+            "topic": "acapy::record::issue_credential_v2_0::offer-sent",
+            "category": "issue_credential_v2_0",
+            "payload": {"state": "offer-sent", "cred_offer": {"offers~attach": []}},
+        }
+        assert apply_event_filter(EventFilter(), payload) is payload
+        assert apply_event_filter(EventFilter(states=["offer-sent", "done"]), payload)
+        assert not apply_event_filter(EventFilter(states=["done"]), payload)
+        assert not apply_event_filter(EventFilter(categories=["connections"]), payload)
+        assert not apply_event_filter(
+            EventFilter(wallet_ids=["test_wallet_id"]), payload
+        )
+        assert apply_event_filter(
+            EventFilter(exclude_fields=["cred_offer.offers~attach"]),
+            payload,
+        )["payload"] == {"state": "offer-sent", "cred_offer": {}}
+        with async_mock.patch.object(
+            test_module.filters.random,
+            "random",
+            async_mock.MagicMock(side_effect=[0.2, 0.7]),
+        ):
+            event_filter = EventFilter(sample_rate=0.5)
+            assert apply_event_filter(event_filter, payload)
+            assert not apply_event_filter(event_filter, payload)
+
+    async def test_handle_event_filtered(self):
+        test_settings = deepcopy(SETTINGS)
+        test_settings["plugin_config"]["redis_queue"]["event"] = {
+            "event_topic_match": "first",
+            "event_filters": {
+                "^acapy::record::connections::": {
+                    "states": ["active"],
+                    "include-fields": ["connection_id", "state"],
+                },
+            },
+        }
+        self.profile.settings["plugin_config"] = test_settings["plugin_config"]
+        mock_pipe = async_mock.MagicMock(execute=async_mock.CoroutineMock())
+        self.profile.context.injector.bind_instance(
+            RedisClient,
+            async_mock.MagicMock(
+                pipeline=async_mock.MagicMock(return_value=mock_pipe),
+            ),
+        )
+        for state in ("request", "active"):
+            await handle_event(
+                self.profile,
+                async_mock.MagicMock(
+                    payload={"state": state, "connection_id": "test", "label": "x"},
+                    topic=f"acapy::record::connections::{state}",
+                ),
+            )
+        await handle_event(
+            self.profile,
+            async_mock.MagicMock(
+                payload={"state": "done", "label": "x"},
+                topic="acapy::record::present_proof::done",
+            ),
+        )
+        await on_shutdown(self.profile, None)
+        events = [
+            (topic, json.loads(event)["payload"])
+            for topic, *messages in (call[0] for call in mock_pipe.rpush.call_args_list)
+            for event in messages
+        ]
+        assert events == [
+            (
+                "acapy-record-with-state-base",
+                {
+                    "wallet_id": "base",
+                    "state": "active",
+                    "topic": "acapy::record::connections::active",
+                    "category": "connections",
+                    "payload": {"connection_id": "test", "state": "active"},
+                },
+            ),
+            (
+                "acapy-record-with-state-base",
+                {
+                    "wallet_id": "base",
+                    "state": "done",
+                    "topic": "acapy::record::present_proof::done",
+                    "category": "present_proof",
+                    "payload": {"state": "done", "label": "x"},
+                },
+            ),
+        ]
 
     def test_process_event_payload(self):
         assert process_event_payload(
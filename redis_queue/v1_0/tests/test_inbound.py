@@ -8,6 +8,8 @@ from aiohttp.test_utils import unused_port
 from asynctest import TestCase as AsyncTestCase, mock as async_mock, PropertyMock
 
 from .. import inbound as test_inbound
+from ..client import REDIS_CLIENTS, RedisClient
+from ..envelope import pack_envelope
 from ..inbound import RedisInboundTransport
 
 SETTINGS = {
@@ -73,13 +75,8 @@ TEST_INBOUND_MSG_B = str.encode(
     )
 )
 
-TEST_INBOUND_MSG_C = str.encode(
-    json.dumps(
-        {
-            "payload": PAYLOAD_B64,
-            "transport_type": "ws",
-        }
-    )
+TEST_INBOUND_MSG_C = pack_envelope(
+    {"transport_type": "ws"}, base64.urlsafe_b64decode(PAYLOAD_B64)
 )
 
 TEST_INBOUND_INVALID = b"""{
@@ -90,14 +87,13 @@ TEST_INBOUND_INVALID = b"""{
 
 class TestRedisInbound(AsyncTestCase):
     def setUp(self):
+        REDIS_CLIENTS.clear()
         self.port = unused_port()
         self.session = None
         self.profile = InMemoryProfile.test_profile()
 
     async def test_init(self):
-        self.profile.context.injector.bind_instance(
-            redis.asyncio.RedisCluster, async_mock.MagicMock()
-        )
+        self.profile.context.injector.bind_instance(RedisClient, async_mock.MagicMock())
         RedisInboundTransport.running = PropertyMock(
             side_effect=[True, True, True, False]
         )
@@ -160,7 +156,7 @@ class TestRedisInbound(AsyncTestCase):
     async def test_start(self):
         self.profile.settings["emit_new_didcomm_mime_type"] = False
         self.profile.context.injector.bind_instance(
-            redis.asyncio.RedisCluster,
+            RedisClient,
             async_mock.MagicMock(
                 hset=async_mock.CoroutineMock(),
                 ping=async_mock.CoroutineMock(),
@@ -251,7 +247,7 @@ class TestRedisInbound(AsyncTestCase):
     async def test_start_x(self):
         self.profile.settings["emit_new_didcomm_mime_type"] = True
         self.profile.context.injector.bind_instance(
-            redis.asyncio.RedisCluster,
+            RedisClient,
             async_mock.MagicMock(
                 hset=async_mock.CoroutineMock(),
                 ping=async_mock.CoroutineMock(),
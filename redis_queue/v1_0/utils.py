@@ -3,20 +3,86 @@ import datetime
 import base64
 import json
 import logging
+import zlib
 
-from redis.asyncio import RedisCluster
 from redis.exceptions import RedisError
-from typing import Union, List
+from typing import Any, Union, List
+
+from .client import RedisClient, ping_redis
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 LOGGER = logging.getLogger(__name__)
 
 
+def json_dumps_bytes(value: Any) -> bytes:
+    """Serialize value to JSON bytes, with orjson if it is installed."""
+    if orjson:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value).encode()
+
+
+def get_outbound_shard_topic(topic: str, endpoint: str, shards: int) -> str:
+    """Return the outbound shard topic for messages to endpoint.
+
+    Shard topics carry their index as hash tag, so shards land in different
+    cluster slots while the same shard of related topics shares one. With a
+    single shard, topic is used as is.
+    """
+    if shards <= 1:
+        return topic
+    return f"{topic}_{{{zlib.crc32(endpoint.encode()) % shards}}}"
+
+
+def get_outbound_shard_topics(topic: str, shards: int) -> List[str]:
+    """Return all outbound shard topics for topic."""
+    if shards <= 1:
+        return [topic]
+    return [f"{topic}_{{{index}}}" for index in range(shards)]
+
+
+def compression_supported(codec: str) -> bool:
+    """Return whether codec is available, zstd requires zstandard."""
+    return codec == "zlib" or (codec == "zstd" and zstandard is not None)
+
+
+def compress_payload(data: bytes, codec: str) -> bytes:
+    """Compress data with codec, zlib or zstd [requires zstandard]."""
+    if codec == "zlib":
+        return zlib.compress(data)
+    if codec == "zstd" and zstandard:
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError(f"Unsupported compression: {codec}")
+
+
+def decompress_payload(data: bytes, codec: str) -> bytes:
+    """Decompress data compressed with compress_payload."""
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "zstd" and zstandard:
+        try:
+            return zstandard.ZstdDecompressor().decompress(data)
+        except zstandard.ZstdError as err:
+            raise ValueError(f"Invalid zstd payload: {err}") from err
+    raise ValueError(f"Unsupported compression: {codec}")
+
+
 def str_to_datetime(datetime_str):
     return datetime.datetime.strptime(datetime_str, "%Y-%m-%dT%H:%M:%SZ")
 
 
-def curr_datetime_to_str():
-    return (datetime.datetime.now()).strftime("%Y-%m-%dT%H:%M:%SZ")
+def curr_datetime_to_str(offset_s: float = 0):
+    return (datetime.datetime.now() + datetime.timedelta(seconds=offset_s)).strftime(
+        "%Y-%m-%dT%H:%M:%SZ"
+    )
 
 
 def get_timedelta_seconds(rec_datetime):
@@ -37,14 +103,19 @@ def b64_to_bytes(val: Union[str, bytes], urlsafe=True) -> bytes:
     return base64.b64decode(val)
 
 
-def _recipients_from_packed_message(packed_message: bytes) -> List[str]:
+def recipients_from_packed_message(packed_message: Union[bytes, dict]) -> List[str]:
     """
     Inspect the header of the packed message and extract the recipient key.
+
+    packed_message may also be the already parsed JSON wrapper.
     """
-    try:
-        wrapper = json.loads(packed_message)
-    except Exception as err:
-        raise ValueError("Invalid packed message") from err
+    if isinstance(packed_message, dict):
+        wrapper = packed_message
+    else:
+        try:
+            wrapper = json.loads(packed_message)
+        except Exception as err:
+            raise ValueError("Invalid packed message") from err
 
     recips_json = b64_to_bytes(wrapper["protected"], urlsafe=True).decode("ascii")
     try:
@@ -55,24 +126,142 @@ def _recipients_from_packed_message(packed_message: bytes) -> List[str]:
     return [recip["header"]["kid"] for recip in recips_outer["recipients"]]
 
 
-async def get_recip_keys_list_for_uid(redis: RedisCluster, plugin_uid: bytes):
+class MediatorKeys:
+    """Names of the mediator metadata keys.
+
+    Without a prefix these are the legacy names, each in its own cluster slot.
+    With a prefix, every name carries it as hash tag, so all the mediator
+    metadata lives in one slot and can be updated by a single script.
+    """
+
+    NAMES = (
+        "uid_recip_keys_map",
+        "recip_key_uid_map",
+        "uid_last_access_map",
+        "uid_recip_key_pending_msg_count",
+        "round_robin_iterator",
+    )
+
+    def __init__(self, prefix: str = None):
+        """Initialize MediatorKeys."""
+        self.prefix = prefix
+        for name in self.NAMES:
+            setattr(self, name, f"{{{prefix}}}:{name}" if prefix else name)
+
+    @property
+    def co_located(self) -> bool:
+        """Return True if all mediator metadata shares one cluster slot."""
+        return bool(self.prefix)
+
+
+LEGACY_MEDIATOR_KEYS = MediatorKeys()
+
+# KEYS: recip_key_uid_map, uid_recip_key_pending_msg_count; ARGV: recip_key
+PENDING_MSG_COUNT_SCRIPT = """
+local uid = redis.call("HGET", KEYS[1], ARGV[1])
+if not uid then
+    return 0
+end
+return tonumber(redis.call("HGET", KEYS[2], uid .. "_" .. ARGV[1])) or 0
+"""
+
+# KEYS: uid_last_access_map, uid_recip_key_pending_msg_count
+# ARGV: plugin_uid, uid_recip_key, last access time
+INBOUND_MSG_RECEIVED_SCRIPT = """
+redis.call("HSET", KEYS[1], ARGV[1], ARGV[3])
+local count = tonumber(redis.call("HGET", KEYS[2], ARGV[2]))
+if count and count >= 1 then
+    return redis.call("HINCRBY", KEYS[2], ARGV[2], -1)
+end
+return count or 0
+"""
+
+
+# KEYS: recip_key_uid_map, uid_last_access_map, uid_recip_key_pending_msg_count
+# ARGV: recip_key, stale last access time
+# Last access times sort as strings, the UID is stale if not newer than ARGV[2]
+ROUTE_RECIP_KEY_SCRIPT = """
+local uid = redis.call("HGET", KEYS[1], ARGV[1])
+if not uid then
+    return false
+end
+local last_access = redis.call("HGET", KEYS[2], uid)
+if not last_access or last_access <= ARGV[2] then
+    return false
+end
+redis.call("HINCRBY", KEYS[3], uid .. "_" .. ARGV[1], 1)
+return uid
+"""
+
+# KEYS: round_robin_iterator, uid_recip_keys_map; ARGV: UID to ignore or ""
+NEXT_UID_SCRIPT = """
+local uids = redis.call("HKEYS", KEYS[2])
+if ARGV[1] ~= "" and #uids > 1 then
+    for i, uid in ipairs(uids) do
+        if uid == ARGV[1] then
+            table.remove(uids, i)
+            break
+        end
+    end
+end
+if #uids == 0 then
+    return false
+end
+local next_iter = tonumber(redis.call("GET", KEYS[1])) or 0
+local uid = uids[next_iter + 1] or uids[1]
+next_iter = next_iter + 1
+if next_iter >= #uids then
+    next_iter = 0
+end
+redis.call("SET", KEYS[1], next_iter)
+return uid
+"""
+
+# Seconds without inbound activity after which a plugin UID is stale
+STALE_UID_S = 15
+
+
+async def get_recip_keys_list_for_uid(
+    redis: RedisClient,
+    plugin_uid: bytes,
+    keys: MediatorKeys = None,
+):
     """Get recip_keys list associated with plugin UID."""
-    recip_keys_encoded = await redis.hget("uid_recip_keys_map", plugin_uid)
+    keys = keys or LEGACY_MEDIATOR_KEYS
+    recip_keys_encoded = await redis.hget(keys.uid_recip_keys_map, plugin_uid)
     if not recip_keys_encoded:
         return []
     inbound_msg_keys = json.loads(b64_to_bytes(recip_keys_encoded).decode())
     return inbound_msg_keys
 
 
-async def get_new_valid_uid(redis: RedisCluster, to_ignore_uid: bytes = None):
+async def get_new_valid_uid(
+    redis: RedisClient,
+    to_ignore_uid: bytes = None,
+    keys: MediatorKeys = None,
+):
     """Get a new plugin UID for recip_key assignment/reassignment."""
+    keys = keys or LEGACY_MEDIATOR_KEYS
+    while keys.co_located:
+        new_uid = await redis.eval(
+            NEXT_UID_SCRIPT,
+            2,
+            keys.round_robin_iterator,
+            keys.uid_recip_keys_map,
+            to_ignore_uid or "",
+        )
+        if new_uid:
+            return new_uid
+        LOGGER.error("No plugin instance available for assignment")
+        await ping_redis(redis)
+        await asyncio.sleep(3)
     new_uid = None
     uid_not_selected = False
     while not uid_not_selected:
-        if not await redis.get("round_robin_iterator"):
-            await redis.set("round_robin_iterator", 0)
-        next_iter = int((await redis.get("round_robin_iterator")).decode())
-        uid_list = await redis.hkeys("uid_recip_keys_map")
+        if not await redis.get(keys.round_robin_iterator):
+            await redis.set(keys.round_robin_iterator, 0)
+        next_iter = int((await redis.get(keys.round_robin_iterator)).decode())
+        uid_list = await redis.hkeys(keys.uid_recip_keys_map)
         if to_ignore_uid and len(uid_list) > 1:
             try:
                 uid_list.remove(to_ignore_uid)
@@ -80,7 +269,7 @@ async def get_new_valid_uid(redis: RedisCluster, to_ignore_uid: bytes = None):
                 pass
         if len(uid_list) == 0:
             LOGGER.error("No plugin instance available for assignment")
-            await redis.ping(target_nodes=RedisCluster.PRIMARIES)
+            await ping_redis(redis)
             await asyncio.sleep(3)
             continue
         try:
@@ -89,46 +278,50 @@ async def get_new_valid_uid(redis: RedisCluster, to_ignore_uid: bytes = None):
             new_uid = uid_list[0]
         next_iter = next_iter + 1
         if next_iter < len(uid_list):
-            await redis.set("round_robin_iterator", next_iter)
+            await redis.set(keys.round_robin_iterator, next_iter)
         else:
-            await redis.set("round_robin_iterator", 0)
+            await redis.set(keys.round_robin_iterator, 0)
         uid_not_selected = True
     return new_uid
 
 
-async def assign_recip_key_to_new_uid(redis: RedisCluster, recip_key: str):
+async def assign_recip_key_to_new_uid(
+    redis: RedisClient, recip_key: str, keys: MediatorKeys = None
+):
     """Assign recip_key to a new plugin UID."""
-    new_uid = await get_new_valid_uid(redis)
+    keys = keys or LEGACY_MEDIATOR_KEYS
+    new_uid = await get_new_valid_uid(redis, keys=keys)
     recip_key_encoded = recip_key.encode("utf-8")
-    await redis.hset("recip_key_uid_map", recip_key_encoded, new_uid)
-    recip_keys_list = await get_recip_keys_list_for_uid(redis, new_uid)
+    await redis.hset(keys.recip_key_uid_map, recip_key_encoded, new_uid)
+    recip_keys_list = await get_recip_keys_list_for_uid(redis, new_uid, keys)
     recip_keys_set = set(recip_keys_list)
     if recip_key not in recip_keys_set:
         recip_keys_set.add(recip_key)
         new_recip_keys_set = base64.urlsafe_b64encode(
             json.dumps(list(recip_keys_set)).encode("utf-8")
         ).decode()
-        await redis.hset("uid_recip_keys_map", new_uid, new_recip_keys_set)
+        await redis.hset(keys.uid_recip_keys_map, new_uid, new_recip_keys_set)
     uid_recip_key = f"{new_uid.decode()}_{recip_key}".encode("utf-8")
-    await redis.hset("uid_recip_key_pending_msg_count", uid_recip_key, 0)
+    await redis.hset(keys.uid_recip_key_pending_msg_count, uid_recip_key, 0)
     return new_uid
 
 
 async def reassign_recip_key_to_uid(
-    redis: RedisCluster, old_uid: bytes, recip_key: str
+    redis: RedisClient, old_uid: bytes, recip_key: str, keys: MediatorKeys = None
 ):
     """Reassign recip_key from old_uid to a new plugin UID."""
-    new_uid = await get_new_valid_uid(redis, old_uid)
+    keys = keys or LEGACY_MEDIATOR_KEYS
+    new_uid = await get_new_valid_uid(redis, old_uid, keys)
     recip_key_encoded = recip_key.encode("utf-8")
-    old_recip_keys_list = await get_recip_keys_list_for_uid(redis, old_uid)
-    new_recip_keys_list = await get_recip_keys_list_for_uid(redis, new_uid)
+    old_recip_keys_list = await get_recip_keys_list_for_uid(redis, old_uid, keys)
+    new_recip_keys_list = await get_recip_keys_list_for_uid(redis, new_uid, keys)
     old_recip_keys_set = set(old_recip_keys_list)
     try:
         old_recip_keys_set.remove(recip_key)
     except (KeyError, ValueError):
         pass
     await redis.hset(
-        "uid_recip_keys_map",
+        keys.uid_recip_keys_map,
         old_uid,
         base64.urlsafe_b64encode(
             json.dumps(list(old_recip_keys_set)).encode("utf-8")
@@ -136,58 +329,104 @@ async def reassign_recip_key_to_uid(
     )
     old_uid_recip_key = f"{old_uid.decode()}_{recip_key}".encode("utf-8")
     old_pending_msg_count = await redis.hget(
-        "uid_recip_key_pending_msg_count", old_uid_recip_key
+        keys.uid_recip_key_pending_msg_count, old_uid_recip_key
     )
-    await redis.hdel("uid_recip_key_pending_msg_count", old_uid_recip_key)
-    await redis.hset("recip_key_uid_map", recip_key_encoded, new_uid)
+    await redis.hdel(keys.uid_recip_key_pending_msg_count, old_uid_recip_key)
+    await redis.hset(keys.recip_key_uid_map, recip_key_encoded, new_uid)
     new_recip_keys_set = set(new_recip_keys_list)
     new_recip_keys_set.add(recip_key)
     new_recip_keys_list = base64.urlsafe_b64encode(
         json.dumps(list(new_recip_keys_set)).encode("utf-8")
     ).decode()
-    await redis.hset("uid_recip_keys_map", new_uid, new_recip_keys_list)
+    await redis.hset(keys.uid_recip_keys_map, new_uid, new_recip_keys_list)
     new_uid_recip_key = f"{new_uid.decode()}_{recip_key}".encode("utf-8")
     if old_pending_msg_count:
         await redis.hincrby(
-            "uid_recip_key_pending_msg_count",
+            keys.uid_recip_key_pending_msg_count,
             new_uid_recip_key,
             int(old_pending_msg_count.decode()),
         )
     return new_uid
 
 
+async def get_pending_msg_count(
+    redis: RedisClient, recip_key: str, keys: MediatorKeys = None
+) -> int:
+    """Get pending message count for recip_key on its assigned plugin UID."""
+    keys = keys or LEGACY_MEDIATOR_KEYS
+    if keys.co_located:
+        return int(
+            await redis.eval(
+                PENDING_MSG_COUNT_SCRIPT,
+                2,
+                keys.recip_key_uid_map,
+                keys.uid_recip_key_pending_msg_count,
+                recip_key,
+            )
+        )
+    plugin_uid = await redis.hget(keys.recip_key_uid_map, recip_key.encode("utf-8"))
+    if not plugin_uid:
+        return 0
+    uid_recip_key = f"{plugin_uid.decode()}_{recip_key}".encode("utf-8")
+    pending_msg_count = await redis.hget(
+        keys.uid_recip_key_pending_msg_count, uid_recip_key
+    )
+    if not pending_msg_count:
+        return 0
+    return int(pending_msg_count.decode())
+
+
 async def process_payload_recip_key(
-    redis: RedisCluster, payload: Union[str, bytes], topic: str
-):
-    recip_key_in = ",".join(_recipients_from_packed_message(payload))
+    redis: RedisClient,
+    payload: Union[str, bytes],
+    topic: str,
+    keys: MediatorKeys = None,
+    recip_keys: List[str] = None,
+) -> str:
+    """Route payload to the inbound topic of its recipient and return the topic.
+
+    recip_keys are the recipients of payload if they were already parsed.
+    With co-located keys, a recipient assigned to an active plugin UID is
+    routed by a single script, assigning or reassigning it is not scripted.
+    """
+    keys = keys or LEGACY_MEDIATOR_KEYS
+    if recip_keys is None:
+        recip_keys = recipients_from_packed_message(payload)
+    recip_key_in = ",".join(recip_keys)
     recip_key_in_encoded = recip_key_in.encode()
-    message = str.encode(
-        json.dumps(
-            {
-                "payload": base64.urlsafe_b64encode(payload).decode(),
-            }
-        ),
-    )
-    if await redis.hexists("recip_key_uid_map", recip_key_in_encoded):
-        plugin_uid = await redis.hget("recip_key_uid_map", recip_key_in_encoded)
+    if keys.co_located and await redis.eval(
+        ROUTE_RECIP_KEY_SCRIPT,
+        3,
+        keys.recip_key_uid_map,
+        keys.uid_last_access_map,
+        keys.uid_recip_key_pending_msg_count,
+        recip_key_in_encoded,
+        curr_datetime_to_str(-STALE_UID_S),
+    ):
+        return f"{topic}_{recip_key_in}"
+    if await redis.hexists(keys.recip_key_uid_map, recip_key_in_encoded):
+        plugin_uid = await redis.hget(keys.recip_key_uid_map, recip_key_in_encoded)
     else:
-        plugin_uid = await assign_recip_key_to_new_uid(redis, recip_key_in)
-    last_accessed_map_value = await redis.hget("uid_last_access_map", plugin_uid)
+        plugin_uid = await assign_recip_key_to_new_uid(redis, recip_key_in, keys)
+    last_accessed_map_value = await redis.hget(keys.uid_last_access_map, plugin_uid)
     stale_uid_check = False
     if not last_accessed_map_value:
         stale_uid_check = True
     elif last_accessed_map_value and (
-        get_timedelta_seconds(str_to_datetime(last_accessed_map_value.decode())) >= 15
+        get_timedelta_seconds(str_to_datetime(last_accessed_map_value.decode()))
+        >= STALE_UID_S
     ):
         stale_uid_check = True
     if stale_uid_check:
         old_uid = plugin_uid
-        assigned_recip_key_list = await get_recip_keys_list_for_uid(redis, old_uid)
+        assigned_recip_key_list = await get_recip_keys_list_for_uid(
+            redis, old_uid, keys
+        )
         reassign_uid = False
         for recip_key in assigned_recip_key_list:
             uid_recip_key = f"{old_uid.decode()}_{recip_key}".encode("utf-8")
             enc_uid_recip_key_msg_cnt = await redis.hget(
-                "uid_recip_key_pending_msg_count", uid_recip_key
+                keys.uid_recip_key_pending_msg_count, uid_recip_key
             )
             if (
                 enc_uid_recip_key_msg_cnt is not None
@@ -197,15 +436,52 @@ async def process_payload_recip_key(
                 break
         if reassign_uid:
             for recip_key in assigned_recip_key_list:
-                new_uid = await reassign_recip_key_to_uid(redis, old_uid, recip_key)
+                new_uid = await reassign_recip_key_to_uid(
+                    redis, old_uid, recip_key, keys
+                )
                 if recip_key == recip_key_in:
                     plugin_uid = new_uid
-            updated_recip_keys_list = await get_recip_keys_list_for_uid(redis, old_uid)
+            updated_recip_keys_list = await get_recip_keys_list_for_uid(
+                redis, old_uid, keys
+            )
             if len(updated_recip_keys_list) == 0:
                 await redis.hdel(
-                    "uid_recip_keys_map",
+                    keys.uid_recip_keys_map,
                     old_uid,
                 )
     uid_recip_key = f"{plugin_uid.decode()}_{recip_key_in}".encode("utf-8")
-    await redis.hincrby("uid_recip_key_pending_msg_count", uid_recip_key, 1)
-    return (f"{topic}_{recip_key_in}", message)
+    await redis.hincrby(keys.uid_recip_key_pending_msg_count, uid_recip_key, 1)
+    return f"{topic}_{recip_key_in}"
+
+
+async def record_inbound_msg_received(
+    redis: RedisClient,
+    plugin_uid: bytes,
+    recip_key: str,
+    keys: MediatorKeys = None,
+):
+    """Mark plugin_uid as active and count down the pending messages of recip_key."""
+    keys = keys or LEGACY_MEDIATOR_KEYS
+    last_access = curr_datetime_to_str().encode("utf-8")
+    uid_recip_key = f"{plugin_uid.decode()}_{recip_key}".encode("utf-8")
+    if keys.co_located:
+        await redis.eval(
+            INBOUND_MSG_RECEIVED_SCRIPT,
+            2,
+            keys.uid_last_access_map,
+            keys.uid_recip_key_pending_msg_count,
+            plugin_uid,
+            uid_recip_key,
+            last_access,
+        )
+        return
+    await redis.hset(keys.uid_last_access_map, plugin_uid, last_access)
+    enc_uid_recip_key_count = await redis.hget(
+        keys.uid_recip_key_pending_msg_count, uid_recip_key
+    )
+    if enc_uid_recip_key_count and int(enc_uid_recip_key_count.decode()) >= 1:
+        await redis.hset(
+            keys.uid_recip_key_pending_msg_count,
+            uid_recip_key,
+            (int(enc_uid_recip_key_count.decode()) - 1),
+        )
@@ -1,19 +1,39 @@
 import asyncio
 import logging
 import base64
+import binascii
 import signal
+import socket
 import json
+import zlib
 
-from aiohttp import WSMessage, WSMsgType, web
-from contextlib import suppress
-from redis.asyncio import RedisCluster
+from aiohttp import WSCloseCode, WSMessage, WSMsgType, web
+from contextlib import contextmanager, suppress
 from redis.exceptions import RedisError, RedisClusterException
 from os import getenv
 from uuid import uuid4
-from typing import Union
+from typing import List, Optional, Tuple, Union
 
 from status_endpoint.status_endpoints import start_status_endpoints_server
-from redis_queue.v1_0.utils import process_payload_recip_key, b64_to_bytes
+from redis_queue.v1_0.client import (
+    create_redis_client,
+    ping_redis,
+    redis_client_options_from_env,
+)
+from redis_queue.v1_0.envelope import (
+    ENVELOPE_BINARY,
+    ENVELOPE_JSON,
+    decode_envelope,
+    pack_envelope,
+)
+from redis_queue.v1_0.utils import (
+    MediatorKeys,
+    b64_to_bytes,
+    decompress_payload,
+    get_pending_msg_count,
+    process_payload_recip_key,
+    recipients_from_packed_message,
+)
 
 logging.basicConfig(
     format="%(asctime)s | %(levelname)s: %(message)s",
@@ -21,6 +41,58 @@ logging.basicConfig(
 )
 
 
+def parse_message(message_data: Union[bytes, bytearray]) -> Optional[dict]:
+    """Return the JSON object of an inbound message, None if it is not one."""
+    try:
+        message_dict = json.loads(message_data)
+    except ValueError:
+        return None
+    return message_dict if isinstance(message_dict, dict) else None
+
+
+def parse_recip_keys(message_dict: Optional[dict]) -> Optional[List[str]]:
+    """Return the recipient keys of a parsed packed message, None if invalid."""
+    if message_dict is None:
+        return None
+    try:
+        return recipients_from_packed_message(message_dict)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def log_task_exception(task: asyncio.Future):
+    """Log the exception a finished task failed with, if any."""
+    if not task.cancelled() and task.exception():
+        logging.error("Unexpected task exception", exc_info=task.exception())
+
+
+def build_inbound_message(
+    message_data: Union[bytes, bytearray],
+    transport_type: str,
+    txn_id: str = None,
+    envelope_format: str = ENVELOPE_JSON,
+) -> bytes:
+    """Build the inbound queue message for message_data.
+
+    The payload is base64 encoded straight into the output bytes, without
+    round-tripping the message through str and json.dumps, or appended as is
+    to a binary envelope.
+    """
+    fields = {"transport_type": transport_type}
+    if txn_id:
+        fields["txn_id"] = txn_id
+    if envelope_format == ENVELOPE_BINARY:
+        return pack_envelope(fields, message_data)
+    return b"".join(
+        (
+            b'{"payload": "',
+            base64.urlsafe_b64encode(message_data),
+            b'", ',
+            json.dumps(fields)[1:].encode("utf-8"),
+        )
+    )
+
+
 class Relay:
     """Inbound WS delivery relay."""
 
@@ -34,8 +106,32 @@ class Relay:
         site_port: str,
         direct_resp_topic: str,
         inbound_topic: str,
+        max_inflight_msgs: int = 0,
+        max_inflight_bytes: int = 0,
+        max_pending_msgs_per_recip_key: int = 0,
+        max_body_size: int = 1024**2,
+        ws_max_concurrent_msgs: int = 10,
+        outbound_topic: str = None,
+        ws_session_topic: str = None,
+        envelope_format: str = ENVELOPE_JSON,
+        mediator_key_prefix: str = None,
+        redis_options: dict = None,
+        relay_id: str = None,
     ):
-        """Initialize Relay."""
+        """Initialize Relay.
+
+        The max_inflight_* and max_pending_* limits are admission controls, a
+        value of 0 disables the limit. max_body_size is the largest inbound
+        message accepted, in bytes. ws_max_concurrent_msgs bounds the direct
+        responses waited on at once on a single WS connection. When ws_session_topic is
+        set, WSRelay registers its live sessions under it so outbound messages
+        can be pushed down the open socket, falling back to outbound_topic.
+        Those are queued for this relay under relay_id, which should survive
+        restarts so a restarted relay hands back what was queued meanwhile.
+        envelope_format is the format of the queued inbound messages.
+        mediator_key_prefix must match the connection.mediator_key_prefix of
+        the plugin. redis_options are passed on to create_redis_client.
+        """
         self.site_host = site_host
         self.site_port = site_port
         self.redis = None
@@ -44,12 +140,34 @@ class Relay:
         self.inbound_topic = inbound_topic
         self.site = None
         self.timedelay_s = 1
+        self.enqueue_timeout_s = 15
+        self.enqueue_backoff_base_s = 0.1
+        self.enqueue_backoff_max_s = 2
+        self.max_inflight_msgs = max_inflight_msgs
+        self.max_inflight_bytes = max_inflight_bytes
+        self.max_pending_msgs_per_recip_key = max_pending_msgs_per_recip_key
+        self.max_body_size = max_body_size
+        self.ws_max_concurrent_msgs = ws_max_concurrent_msgs
+        self.outbound_topic = outbound_topic
+        self.ws_session_topic = ws_session_topic
+        self.ws_session_ttl_s = 30
+        self.ws_session_outbound_topic = (
+            f"{ws_session_topic}_relay_{relay_id or uuid4()}"
+            if ws_session_topic
+            else None
+        )
+        self.ws_sessions = {}
+        self.inflight_msgs = 0
+        self.inflight_bytes = 0
+        self.mediator_keys = MediatorKeys(mediator_key_prefix)
         self.connection_url = connection_url
+        self.redis_options = redis_options or {}
+        self.envelope_format = envelope_format
 
     async def is_running(self) -> bool:
         """Check if delivery service agent is running properly."""
         try:
-            await self.redis.ping(target_nodes=RedisCluster.PRIMARIES)
+            await ping_redis(self.redis)
             if self.running:
                 return True
             else:
@@ -92,11 +210,106 @@ class Relay:
             self.direct_response_txn_request_map[txn_id] = response_data
             await asyncio.sleep(self.timedelay_s)
 
+    async def check_admission(
+        self, message_data: bytes, recip_keys: Optional[List[str]] = None
+    ) -> Optional[int]:
+        """Return the HTTP status to reject message_data with, if any.
+
+        503 when the relay itself is overloaded, 429 when the recipient's
+        inbound queue is already too deep. recip_keys are the recipients of
+        message_data if they were already parsed. message_data must already be
+        tracked as in-flight, so concurrent messages cannot all be admitted
+        while this one waits on Redis.
+        """
+        if self.max_inflight_msgs and self.inflight_msgs > self.max_inflight_msgs:
+            logging.warning("Max in-flight messages reached, rejecting message")
+            return 503
+        if self.max_inflight_bytes and self.inflight_bytes > self.max_inflight_bytes:
+            logging.warning("Max in-flight bytes reached, rejecting message")
+            return 503
+        if self.max_pending_msgs_per_recip_key:
+            if recip_keys is None:
+                recip_keys = parse_recip_keys(parse_message(message_data))
+            if recip_keys is None:
+                # Left for process_payload_recip_key to report
+                return None
+            recip_key = ",".join(recip_keys)
+            try:
+                pending_msg_count = await get_pending_msg_count(
+                    self.redis, recip_key, self.mediator_keys
+                )
+            except (RedisError, RedisClusterException) as err:
+                logging.exception(f"Unexpected redis client exception: {err}")
+                return 503
+            if pending_msg_count >= self.max_pending_msgs_per_recip_key:
+                logging.warning(f"Too many pending messages for {recip_key}")
+                return 429
+        return None
+
+    @contextmanager
+    def track_inflight(self, message_data: bytes):
+        """Account for message_data as in-flight for the duration of the block."""
+        self.inflight_msgs += 1
+        self.inflight_bytes += len(message_data)
+        try:
+            yield
+        finally:
+            self.inflight_msgs -= 1
+            self.inflight_bytes -= len(message_data)
+
+    async def enqueue_message(
+        self,
+        message_data: bytes,
+        message: bytes,
+        recip_keys: Optional[List[str]] = None,
+    ) -> bool:
+        """Route message once and push it to the inbound queue.
+
+        Routing and pushing together are bounded by enqueue_timeout_s. Returns
+        False if the message was not queued.
+        """
+        try:
+            return await asyncio.wait_for(
+                self.route_and_push(message_data, message, recip_keys),
+                self.enqueue_timeout_s,
+            )
+        except asyncio.TimeoutError:
+            logging.error("Timed out queueing inbound message")
+            return False
+
+    async def route_and_push(
+        self,
+        message_data: bytes,
+        message: bytes,
+        recip_keys: Optional[List[str]] = None,
+    ) -> bool:
+        """Route message and push it, retrying the push with exponential backoff."""
+        try:
+            recip_key_incl_topic = await process_payload_recip_key(
+                self.redis,
+                message_data,
+                self.inbound_topic,
+                self.mediator_keys,
+                recip_keys,
+            )
+        except (RedisError, RedisClusterException) as err:
+            logging.exception(f"Unable to route inbound message: {err}")
+            return False
+        backoff_s = self.enqueue_backoff_base_s
+        while True:
+            try:
+                await self.redis.rpush(recip_key_incl_topic, message)
+                return True
+            except (RedisError, RedisClusterException) as err:
+                logging.exception(f"Unexpected redis client exception: {err}")
+            await asyncio.sleep(backoff_s)
+            backoff_s = min(backoff_s * 2, self.enqueue_backoff_max_s)
+
     async def get_direct_responses(self, txn_id):
         """Get direct_response for a specific transaction/request."""
         while self.running:
             if txn_id in self.direct_response_txn_request_map:
-                return self.direct_response_txn_request_map[txn_id]
+                return self.direct_response_txn_request_map.pop(txn_id)
             await asyncio.sleep(self.timedelay_s)
 
 
@@ -106,14 +319,22 @@ class WSRelay(Relay):
     async def run(self):
         """Run the service."""
         try:
-            self.redis = RedisCluster.from_url(url=self.connection_url)
+            self.redis = create_redis_client(self.connection_url, **self.redis_options)
             self.ready = True
             self.running = True
-            await asyncio.gather(self.start(), self.process_direct_responses())
+            tasks = [self.start(), self.process_direct_responses()]
+            if self.ws_session_topic:
+                tasks.extend(
+                    [self.process_ws_session_messages(), self.refresh_ws_sessions()]
+                )
+            await asyncio.gather(*tasks)
         except (RedisError, RedisClusterException) as err:
             self.ready = False
             self.running = False
             logging.exception(f"Unexpected redis client exception: {err}")
+        finally:
+            if self.ws_session_topic and self.redis:
+                await self.release_ws_sessions()
 
     async def start(self):
         """Construct the aiohttp application."""
@@ -125,103 +346,50 @@ class WSRelay(Relay):
         await self.site.start()
 
     async def message_handler(self, request):
-        """Message handler for inbound messages."""
+        """Message handler for inbound messages.
+
+        Frames are routed and queued in the order they are read. Only waiting
+        for a direct response runs in its own task, with at most
+        ws_max_concurrent_msgs waiting per connection, so it does not hold up
+        the socket.
+        """
         ws = web.WebSocketResponse(
             autoping=True,
             heartbeat=3,
             receive_timeout=15,
+            max_msg_size=self.max_body_size,
         )
         await ws.prepare(request)
-        loop = asyncio.get_event_loop()
-        inbound = loop.create_task(ws.receive())
-        while not ws.closed:
-            await asyncio.wait((inbound), return_when=asyncio.FIRST_COMPLETED)
-            if inbound.done():
-                msg: WSMessage = inbound.result()
-                if isinstance(msg.data, str):
-                    message_data = (msg.data).encode("utf-8")
-                else:
-                    message_data = msg.data
+        window = asyncio.Semaphore(self.ws_max_concurrent_msgs)
+        pending = set()
+        try:
+            while not ws.closed:
+                msg: WSMessage = await ws.receive()
                 if msg.type in (WSMsgType.TEXT, WSMsgType.BINARY):
-                    message_dict = json.loads(msg.data)
-                    direct_response_request = False
-                    transport_dec = message_dict.get("~transport")
-                    if transport_dec:
-                        direct_response_mode = transport_dec.get("return_route")
-                        if direct_response_mode and direct_response_mode != "none":
-                            direct_response_request = True
-                    txn_id = str(uuid4())
-                    if direct_response_request:
-                        self.direct_response_txn_request_map[txn_id] = request
-                        message = str.encode(
-                            json.dumps(
-                                {
-                                    "payload": base64.urlsafe_b64encode(
-                                        message_data
-                                    ).decode(),
-                                    "txn_id": txn_id,
-                                    "transport_type": "ws",
-                                }
-                            )
-                        )
-                        response_sent = False
-                        while not response_sent:
-                            recip_key_incl_topic, _ = await process_payload_recip_key(
-                                self.redis, message_data, self.inbound_topic
-                            )
-                            try:
-                                await self.redis.rpush(recip_key_incl_topic, message)
-                                response_sent = True
-                            except (RedisError, RedisClusterException) as err:
-                                await asyncio.sleep(1)
-                                logging.exception(
-                                    f"Unexpected redis client exception: {err}"
-                                )
-                        try:
-                            response_data = await asyncio.wait_for(
-                                self.get_direct_responses(
-                                    txn_id=txn_id,
-                                ),
-                                15,
-                            )
-                            response = b64_to_bytes(response_data["response"])
-                            if response:
-                                if isinstance(response, bytes):
-                                    await ws.send_bytes(response)
-                                else:
-                                    await ws.send_str(response)
-                        except asyncio.TimeoutError:
-                            pass
+                    if isinstance(msg.data, str):
+                        message_data = (msg.data).encode("utf-8")
                     else:
-                        logging.info(f"Message received from {request.remote}")
-                        message = str.encode(
-                            json.dumps(
-                                {
-                                    "payload": base64.urlsafe_b64encode(
-                                        message_data
-                                    ).decode(),
-                                    "transport_type": "ws",
-                                }
-                            )
-                        )
-                        msg_sent = False
-                        while not msg_sent:
-                            recip_key_incl_topic, _ = await process_payload_recip_key(
-                                self.redis, message_data, self.inbound_topic
-                            )
-                            try:
-                                await self.redis.rpush(recip_key_incl_topic, message)
-                                msg_sent = True
-                            except (RedisError, RedisClusterException) as err:
-                                await asyncio.sleep(1)
-                                logging.exception(
-                                    f"Unexpected redis client exception: {err}"
-                                )
+                        message_data = msg.data
+                    message_dict = parse_message(message_data)
+                    recip_keys = parse_recip_keys(message_dict)
+                    txn_id = await self.dispatch_message(
+                        ws, request, message_data, recip_keys, message_dict
+                    )
+                    if not txn_id:
+                        continue
+                    await window.acquire()
+                    task = asyncio.ensure_future(self.send_direct_response(ws, txn_id))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                    task.add_done_callback(lambda _: window.release())
+                    task.add_done_callback(log_task_exception)
                 elif msg.type == WSMsgType.ERROR:
                     logging.error(
                         "Websocket connection closed with exception: %s",
                         ws.exception(),
                     )
+                elif msg.type in (WSMsgType.CLOSE, WSMsgType.CLOSING, WSMsgType.CLOSED):
+                    break
                 else:
                     logging.error(
                         "Unexpected Websocket message type received: %s: %s, %s",
@@ -229,15 +397,245 @@ class WSRelay(Relay):
                         msg.data,
                         msg.extra,
                     )
-                if not ws.closed:
-                    inbound = loop.create_task(ws.receive())
-        if inbound and not inbound.done():
-            inbound.cancel()
-        if not ws.closed:
-            await ws.close()
+        except asyncio.TimeoutError:
+            logging.warning("Websocket connection timed out")
+        finally:
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            await self.unregister_ws_session(ws)
+            if not ws.closed:
+                await ws.close()
         logging.error("Websocket connection closed")
         return ws
 
+    async def dispatch_message(
+        self,
+        ws: web.WebSocketResponse,
+        request,
+        message_data: bytes,
+        recip_keys: Optional[List[str]] = None,
+        message_dict: Optional[dict] = None,
+    ) -> Optional[str]:
+        """Queue a single inbound WS frame, closing the socket if not queued.
+
+        Returns the transaction id to wait on if a direct response was requested.
+        """
+        txn_id = None
+        try:
+            with self.track_inflight(message_data):
+                if await self.check_admission(message_data, recip_keys):
+                    queued = False
+                else:
+                    queued, txn_id = await self.process_message(
+                        ws,
+                        request,
+                        message_data,
+                        recip_keys=recip_keys,
+                        message_dict=message_dict,
+                    )
+        except (ValueError, AttributeError, KeyError, TypeError) as err:
+            # Invalid JSON, or valid JSON that is not a DIDComm message
+            logging.exception(f"Failed to process message: {err}")
+            return None
+        if not queued and not ws.closed:
+            await ws.close(code=WSCloseCode.TRY_AGAIN_LATER)
+        return txn_id
+
+    async def process_message(
+        self,
+        ws: web.WebSocketResponse,
+        request,
+        message_data: bytes,
+        recip_keys: Optional[List[str]] = None,
+        message_dict: Optional[dict] = None,
+    ) -> Tuple[bool, Optional[str]]:
+        """Queue an inbound WS message.
+
+        Returns whether it was queued and, if a direct response was requested,
+        the transaction id to wait on. message_dict is message_data already
+        parsed, if it is a JSON object.
+        """
+        if message_dict is None:
+            message_dict = json.loads(message_data)
+        direct_response_request = False
+        transport_dec = message_dict.get("~transport")
+        if transport_dec:
+            direct_response_mode = transport_dec.get("return_route")
+            if direct_response_mode and direct_response_mode != "none":
+                direct_response_request = True
+        txn_id = str(uuid4())
+        if direct_response_request:
+            message = build_inbound_message(
+                message_data, "ws", txn_id, self.envelope_format
+            )
+            if not await self.enqueue_message(message_data, message, recip_keys):
+                return False, None
+            return True, txn_id
+        logging.info(f"Message received from {request.remote}")
+        message = build_inbound_message(
+            message_data, "ws", envelope_format=self.envelope_format
+        )
+        return await self.enqueue_message(message_data, message, recip_keys), None
+
+    async def send_direct_response(self, ws: web.WebSocketResponse, txn_id: str):
+        """Wait for the direct response to txn_id and send it over ws."""
+        try:
+            response_data = await asyncio.wait_for(
+                self.get_direct_responses(
+                    txn_id=txn_id,
+                ),
+                15,
+            )
+        except asyncio.TimeoutError:
+            return
+        response = b64_to_bytes(response_data["response"])
+        if response:
+            await self.register_ws_session(ws, response)
+            if isinstance(response, bytes):
+                await ws.send_bytes(response)
+            else:
+                await ws.send_str(response)
+
+    async def register_ws_session(self, ws: web.WebSocketResponse, response: bytes):
+        """Register ws as the live session for the recipients of response."""
+        if not self.ws_session_topic:
+            return
+        try:
+            recip_keys = recipients_from_packed_message(response)
+        except (ValueError, KeyError, TypeError):
+            return
+        for recip_key in recip_keys:
+            if self.ws_sessions.get(recip_key) is ws:
+                continue
+            self.ws_sessions[recip_key] = ws
+            try:
+                await self.redis.set(
+                    f"{self.ws_session_topic}_{recip_key}",
+                    self.ws_session_outbound_topic,
+                    ex=self.ws_session_ttl_s,
+                )
+            except (RedisError, RedisClusterException) as err:
+                logging.exception(f"Unexpected redis client exception: {err}")
+
+    async def unregister_ws_session(self, ws: web.WebSocketResponse):
+        """Remove the session registry entries pointing to ws."""
+        recip_keys = [
+            recip_key
+            for recip_key, session_ws in self.ws_sessions.items()
+            if session_ws is ws
+        ]
+        for recip_key in recip_keys:
+            del self.ws_sessions[recip_key]
+            await self.delete_ws_session_entry(recip_key)
+
+    async def delete_ws_session_entry(self, recip_key: str):
+        """Remove the registry entry of recip_key if it names this relay."""
+        session_key = f"{self.ws_session_topic}_{recip_key}"
+        try:
+            session_topic = await self.redis.get(session_key)
+            if session_topic == self.ws_session_outbound_topic.encode("utf-8"):
+                await self.redis.delete(session_key)
+        except (RedisError, RedisClusterException) as err:
+            logging.exception(f"Unexpected redis client exception: {err}")
+
+    async def release_ws_sessions(self):
+        """Hand the sessions held by this relay back for regular delivery.
+
+        The registry entries are removed first, so no more messages are queued
+        for this relay, then what is left in its queue goes to outbound_topic.
+        """
+        for ws in set(self.ws_sessions.values()):
+            await self.unregister_ws_session(ws)
+        requeued = 0
+        while True:
+            try:
+                outbound = await self.redis.lpop(self.ws_session_outbound_topic)
+                if outbound is None:
+                    break
+                await self.redis.rpush(self.outbound_topic, outbound)
+            except (RedisError, RedisClusterException) as err:
+                logging.exception(f"Unexpected redis client exception: {err}")
+                break
+            requeued += 1
+        if requeued:
+            logging.info(f"Handed back {requeued} WS session messages")
+
+    async def refresh_ws_sessions(self):
+        """Keep the registry entries of live sessions from expiring."""
+        while self.running:
+            await asyncio.sleep(self.ws_session_ttl_s / 3)
+            for ws in {ws for ws in self.ws_sessions.values() if ws.closed}:
+                await self.unregister_ws_session(ws)
+            if not self.ws_sessions:
+                continue
+            pipe = self.redis.pipeline(transaction=False)
+            for recip_key in self.ws_sessions:
+                pipe.set(
+                    f"{self.ws_session_topic}_{recip_key}",
+                    self.ws_session_outbound_topic,
+                    ex=self.ws_session_ttl_s,
+                )
+            try:
+                await pipe.execute()
+            except (RedisError, RedisClusterException) as err:
+                logging.exception(f"Unexpected redis client exception: {err}")
+
+    async def process_ws_session_messages(self):
+        """Send outbound messages queued for the WS sessions held by this relay.
+
+        Messages for sessions that are gone, including ones queued before a
+        restart of this relay, are handed back for regular delivery.
+        """
+        while self.running:
+            try:
+                msg = await self.redis.blpop(self.ws_session_outbound_topic, 0.2)
+            except (RedisError, RedisClusterException) as err:
+                await asyncio.sleep(1)
+                logging.exception(f"Unexpected redis client exception: {err}")
+                continue
+            if not msg:
+                await asyncio.sleep(0.2)
+                continue
+            outbound = msg[1]
+            try:
+                fields = decode_envelope(outbound)
+                payload = fields["payload"]
+                content_encoding = (fields.get("metadata") or {}).get(
+                    "content-encoding"
+                )
+                if content_encoding:
+                    payload = decompress_payload(payload, content_encoding)
+                recip_keys = recipients_from_packed_message(payload)
+            except (ValueError, KeyError, TypeError, binascii.Error, zlib.error):
+                logging.exception("Received invalid WS session message")
+                continue
+            ws = next(
+                (
+                    self.ws_sessions[recip_key]
+                    for recip_key in recip_keys
+                    if recip_key in self.ws_sessions
+                ),
+                None,
+            )
+            if ws:
+                if not ws.closed:
+                    try:
+                        await ws.send_bytes(payload)
+                        logging.info("Message pushed over WS session")
+                        continue
+                    except ConnectionError:
+                        logging.exception("Unable to push message over WS session")
+                await self.unregister_ws_session(ws)
+            else:
+                # Registered before a restart, the deliverer must stop routing here
+                for recip_key in recip_keys:
+                    await self.delete_ws_session_entry(recip_key)
+            # Session is gone, hand the message back for regular delivery
+            try:
+                await self.redis.rpush(self.outbound_topic, outbound)
+            except (RedisError, RedisClusterException) as err:
+                logging.exception(f"Unexpected redis client exception: {err}")
+
 
 class HttpRelay(Relay):
     """Inbound HTTP delivery service."""
@@ -245,7 +643,7 @@ class HttpRelay(Relay):
     async def run(self):
         """Run the service."""
         try:
-            self.redis = RedisCluster.from_url(url=self.connection_url)
+            self.redis = create_redis_client(self.connection_url, **self.redis_options)
             self.ready = True
             self.running = True
             await asyncio.gather(self.start(), self.process_direct_responses())
@@ -276,16 +674,45 @@ class HttpRelay(Relay):
 
     async def message_handler(self, request):
         """Message handler for inbound messages."""
-        ctype = request.headers.get("content-type", "")
-        if ctype.split(";", 1)[0].lower() == "application/json":
-            body = await request.text()
-        else:
-            body = await request.read()
-        if isinstance(body, str):
-            message_data = body.encode("utf-8")
-        else:
-            message_data = body
-        message_dict = json.loads(body)
+        message_data = await self.read_body(request)
+        if message_data is None:
+            logging.warning(f"Message from {request.remote} exceeds max body size")
+            return web.Response(status=413)
+        message_dict = parse_message(message_data)
+        recip_keys = parse_recip_keys(message_dict)
+        with self.track_inflight(message_data):
+            reject_status = await self.check_admission(message_data, recip_keys)
+            if reject_status:
+                return web.Response(status=reject_status)
+            return await self.process_message(
+                request, message_data, recip_keys=recip_keys, message_dict=message_dict
+            )
+
+    async def read_body(self, request) -> Optional[bytearray]:
+        """Stream the request body, returns None if it exceeds max_body_size."""
+        content_length = request.content_length
+        if content_length is not None and content_length > self.max_body_size:
+            return None
+        body = bytearray()
+        async for chunk in request.content.iter_any():
+            if len(body) + len(chunk) > self.max_body_size:
+                return None
+            body += chunk
+        return body
+
+    async def process_message(
+        self,
+        request,
+        message_data: Union[bytes, bytearray],
+        recip_keys: Optional[List[str]] = None,
+        message_dict: Optional[dict] = None,
+    ) -> web.Response:
+        """Queue an inbound HTTP message and build the response to the sender.
+
+        message_dict is message_data already parsed, if it is a JSON object.
+        """
+        if message_dict is None:
+            message_dict = json.loads(message_data)
         direct_response_request = False
         transport_dec = message_dict.get("~transport")
         if transport_dec:
@@ -294,27 +721,11 @@ class HttpRelay(Relay):
                 direct_response_request = True
         txn_id = str(uuid4())
         if direct_response_request:
-            self.direct_response_txn_request_map[txn_id] = request
-            message = str.encode(
-                json.dumps(
-                    {
-                        "payload": base64.urlsafe_b64encode(message_data).decode(),
-                        "txn_id": txn_id,
-                        "transport_type": "http",
-                    }
-                )
+            message = build_inbound_message(
+                message_data, "http", txn_id, self.envelope_format
             )
-            response_sent = False
-            while not response_sent:
-                recip_key_incl_topic, _ = await process_payload_recip_key(
-                    self.redis, message_data, self.inbound_topic
-                )
-                try:
-                    await self.redis.rpush(recip_key_incl_topic, message)
-                    response_sent = True
-                except (RedisError, RedisClusterException) as err:
-                    await asyncio.sleep(1)
-                    logging.exception(f"Unexpected redis client exception: {err}")
+            if not await self.enqueue_message(message_data, message, recip_keys):
+                return web.Response(status=503)
             try:
                 response_data = await asyncio.wait_for(
                     self.get_direct_responses(
@@ -342,25 +753,11 @@ class HttpRelay(Relay):
                 return web.Response(status=200)
         else:
             logging.info(f"Message received from {request.remote}")
-            message = str.encode(
-                json.dumps(
-                    {
-                        "payload": base64.urlsafe_b64encode(message_data).decode(),
-                        "transport_type": "http",
-                    }
-                )
+            message = build_inbound_message(
+                message_data, "http", envelope_format=self.envelope_format
             )
-            msg_sent = False
-            while not msg_sent:
-                recip_key_incl_topic, _ = await process_payload_recip_key(
-                    self.redis, message_data, self.inbound_topic
-                )
-                try:
-                    await self.redis.rpush(recip_key_incl_topic, message)
-                    msg_sent = True
-                except (RedisError, RedisClusterException) as err:
-                    await asyncio.sleep(1)
-                    logging.exception(f"Unexpected redis client exception: {err}")
+            if not await self.enqueue_message(message_data, message, recip_keys):
+                return web.Response(status=503)
             return web.Response(status=200)
 
 
@@ -372,12 +769,24 @@ async def main():
     STATUS_ENDPOINT_PORT = getenv("STATUS_ENDPOINT_PORT")
     STATUS_ENDPOINT_API_KEY = getenv("STATUS_ENDPOINT_API_KEY")
     INBOUND_TRANSPORT_CONFIG = getenv("INBOUND_TRANSPORT_CONFIG")
+    MAX_INFLIGHT_MSGS = int(getenv("MAX_INFLIGHT_MSGS", "0"))
+    MAX_INFLIGHT_BYTES = int(getenv("MAX_INFLIGHT_BYTES", "0"))
+    MAX_PENDING_MSGS_PER_RECIP_KEY = int(getenv("MAX_PENDING_MSGS_PER_RECIP_KEY", "0"))
+    MAX_BODY_SIZE = int(getenv("MAX_BODY_SIZE", str(1024**2)))
+    WS_MAX_CONCURRENT_MSGS = int(getenv("WS_MAX_CONCURRENT_MSGS", "10"))
+    WS_SESSION_DELIVERY = getenv("WS_SESSION_DELIVERY", "false").lower() == "true"
+    ENVELOPE_FORMAT = getenv("ENVELOPE_FORMAT", ENVELOPE_JSON)
+    MEDIATOR_KEY_PREFIX = getenv("MEDIATOR_KEY_PREFIX")
+    REDIS_OPTIONS = redis_client_options_from_env()
+    RELAY_ID = getenv("RELAY_ID", socket.gethostname())
     if not REDIS_SERVER_URL:
         raise SystemExit("No Redis host/connection provided.")
     if not INBOUND_TRANSPORT_CONFIG:
         raise SystemExit("No inbound transport config provided.")
     INBOUND_MSG_TOPIC = f"{TOPIC_PREFIX}_inbound"
     INBOUND_MSG_DIRECT_RESP = f"{TOPIC_PREFIX}_inbound_direct_response"
+    OUTBOUND_MSG_TOPIC = f"{TOPIC_PREFIX}_outbound"
+    WS_SESSION_TOPIC = f"{TOPIC_PREFIX}_ws_session" if WS_SESSION_DELIVERY else None
     handlers = []
     tasks = []
     for inbound_transport in json.loads(INBOUND_TRANSPORT_CONFIG):
@@ -393,6 +802,17 @@ async def main():
                 site_port,
                 INBOUND_MSG_DIRECT_RESP,
                 INBOUND_MSG_TOPIC,
+                max_inflight_msgs=MAX_INFLIGHT_MSGS,
+                max_inflight_bytes=MAX_INFLIGHT_BYTES,
+                max_pending_msgs_per_recip_key=MAX_PENDING_MSGS_PER_RECIP_KEY,
+                max_body_size=MAX_BODY_SIZE,
+                ws_max_concurrent_msgs=WS_MAX_CONCURRENT_MSGS,
+                outbound_topic=OUTBOUND_MSG_TOPIC,
+                ws_session_topic=WS_SESSION_TOPIC,
+                relay_id=f"{RELAY_ID}_{site_port}",
+                envelope_format=ENVELOPE_FORMAT,
+                mediator_key_prefix=MEDIATOR_KEY_PREFIX,
+                redis_options=REDIS_OPTIONS,
             )
             handlers.append(handler)
         elif transport_type == "http":
@@ -406,6 +826,13 @@ async def main():
                 site_port,
                 INBOUND_MSG_DIRECT_RESP,
                 INBOUND_MSG_TOPIC,
+                max_inflight_msgs=MAX_INFLIGHT_MSGS,
+                max_inflight_bytes=MAX_INFLIGHT_BYTES,
+                max_pending_msgs_per_recip_key=MAX_PENDING_MSGS_PER_RECIP_KEY,
+                max_body_size=MAX_BODY_SIZE,
+                envelope_format=ENVELOPE_FORMAT,
+                mediator_key_prefix=MEDIATOR_KEY_PREFIX,
+                redis_options=REDIS_OPTIONS,
             )
             handlers.append(handler)
         else:
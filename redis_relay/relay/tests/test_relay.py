@@ -1,10 +1,15 @@
 import aiohttp
+import asyncio
+import base64
 import os
 import json
 import redis
+import zlib
 
+from contextlib import contextmanager, ExitStack
 from asynctest import TestCase as AsyncTestCase, mock as async_mock, PropertyMock
 from pathlib import Path
+from redis_queue.v1_0.envelope import decode_envelope, pack_envelope
 
 from .. import relay as test_module
 from ..relay import HttpRelay, Relay, WSRelay
@@ -31,6 +36,18 @@ test_retry_msg_c = str.encode(
         }
     )
 )
+test_packed_msg = str.encode(
+    json.dumps(
+        {
+            "protected": base64.urlsafe_b64encode(
+                json.dumps(
+                    {"recipients": [{"header": {"kid": "test_recip_key"}}]}
+                ).encode()
+            ).decode(),
+            "ciphertext": "...",
+        }
+    )
+)
 test_retry_msg_d = str.encode(
     json.dumps(
         {
@@ -40,6 +57,51 @@ test_retry_msg_d = str.encode(
 )
 
 
+def mock_http_request(body, chunked=False):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+
+    async def iter_any():
+        for index in range(0, len(body), 64):
+            yield body[index : index + 64]
+
+    return async_mock.MagicMock(
+        content_length=None if chunked else len(body),
+        content=async_mock.MagicMock(iter_any=iter_any),
+        host="test",
+        remote="test",
+    )
+
+
+def mock_ws_msg(data, msg_type=aiohttp.WSMsgType.TEXT):
+    return async_mock.MagicMock(type=msg_type, data=data)
+
+
+@contextmanager
+def mock_ws_response(messages):
+    """Patch WebSocketResponse to receive messages and then a close frame."""
+    with ExitStack() as stack:
+        mocks = {}
+        for name, mock in (
+            ("prepare", async_mock.CoroutineMock()),
+            (
+                "receive",
+                async_mock.CoroutineMock(
+                    side_effect=messages + [mock_ws_msg(None, aiohttp.WSMsgType.CLOSED)]
+                ),
+            ),
+            ("closed", PropertyMock(return_value=False)),
+            ("close", async_mock.CoroutineMock()),
+            ("exception", async_mock.MagicMock()),
+            ("send_bytes", async_mock.CoroutineMock()),
+            ("send_str", async_mock.CoroutineMock()),
+        ):
+            mocks[name] = stack.enter_context(
+                async_mock.patch.object(test_module.web.WebSocketResponse, name, mock)
+            )
+        yield mocks
+
+
 class TestRedisHTTPHandler(AsyncTestCase):
     async def test_run(self):
         with async_mock.patch.object(
@@ -296,13 +358,8 @@ class TestRedisHTTPHandler(AsyncTestCase):
             await service.get_direct_responses("txn_124") == b"test2"
 
     async def test_message_handler(self):
-        mock_request = async_mock.MagicMock(
-            headers={"content-type": "application/json"},
-            text=async_mock.CoroutineMock(
-                return_value=str.encode(json.dumps({"test": "...."})).decode()
-            ),
-            host="test",
-            remote="test",
+        mock_request = mock_http_request(
+            str.encode(json.dumps({"test": "...."})).decode()
         )
         sentinel = PropertyMock(side_effect=[True, False])
         HttpRelay.running = sentinel
@@ -313,9 +370,7 @@ class TestRedisHTTPHandler(AsyncTestCase):
         ) as mock_redis, async_mock.patch.object(
             test_module,
             "process_payload_recip_key",
-            async_mock.CoroutineMock(
-                return_value=("acapy_inbound_input_recip_key", async_mock.MagicMock())
-            ),
+            async_mock.CoroutineMock(return_value="acapy_inbound_input_recip_key"),
         ):
             service = HttpRelay(
                 "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
@@ -340,9 +395,7 @@ class TestRedisHTTPHandler(AsyncTestCase):
         ) as mock_redis, async_mock.patch.object(
             test_module,
             "process_payload_recip_key",
-            async_mock.CoroutineMock(
-                return_value=("acapy_inbound_input_recip_key", async_mock.MagicMock())
-            ),
+            async_mock.CoroutineMock(return_value="acapy_inbound_input_recip_key"),
         ):
             service = HttpRelay(
                 "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
@@ -351,17 +404,10 @@ class TestRedisHTTPHandler(AsyncTestCase):
             mock_redis.blpop = async_mock.CoroutineMock()
             mock_redis.rpush = async_mock.CoroutineMock()
             service.redis = mock_redis
-            mock_request = async_mock.MagicMock(
-                headers={"content-type": "..."},
-                read=async_mock.CoroutineMock(
-                    return_value=str.encode(
-                        json.dumps(
-                            {"test": "....", "~transport": {"return_route": "..."}}
-                        )
-                    )
-                ),
-                host="test",
-                remote="test",
+            mock_request = mock_http_request(
+                str.encode(
+                    json.dumps({"test": "....", "~transport": {"return_route": "..."}})
+                )
             )
             assert (await service.message_handler(mock_request)).status == 200
         with async_mock.patch.object(
@@ -375,9 +421,7 @@ class TestRedisHTTPHandler(AsyncTestCase):
         ) as mock_redis, async_mock.patch.object(
             test_module,
             "process_payload_recip_key",
-            async_mock.CoroutineMock(
-                return_value=("acapy_inbound_input_recip_key", async_mock.MagicMock())
-            ),
+            async_mock.CoroutineMock(return_value="acapy_inbound_input_recip_key"),
         ):
             service = HttpRelay(
                 "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
@@ -386,19 +430,14 @@ class TestRedisHTTPHandler(AsyncTestCase):
             mock_redis.blpop = async_mock.CoroutineMock()
             mock_redis.rpush = async_mock.CoroutineMock()
             service.redis = mock_redis
-            mock_request = async_mock.MagicMock(
-                headers={"content-type": "..."},
-                read=async_mock.CoroutineMock(
-                    return_value=json.dumps(
-                        {
-                            "content-type": "application/json",
-                            "test": "....",
-                            "~transport": {"return_route": "..."},
-                        }
-                    )
-                ),
-                host="test",
-                remote="test",
+            mock_request = mock_http_request(
+                json.dumps(
+                    {
+                        "content-type": "application/json",
+                        "test": "....",
+                        "~transport": {"return_route": "..."},
+                    }
+                )
             )
             assert (await service.message_handler(mock_request)).status == 200
 
@@ -414,9 +453,7 @@ class TestRedisHTTPHandler(AsyncTestCase):
         ) as mock_redis, async_mock.patch.object(
             test_module,
             "process_payload_recip_key",
-            async_mock.CoroutineMock(
-                return_value=("acapy_inbound_input_recip_key", async_mock.MagicMock())
-            ),
+            async_mock.CoroutineMock(return_value="acapy_inbound_input_recip_key"),
         ):
             service = HttpRelay(
                 "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
@@ -427,17 +464,10 @@ class TestRedisHTTPHandler(AsyncTestCase):
                 side_effect=[test_module.RedisError, None]
             )
             service.redis = mock_redis
-            mock_request = async_mock.MagicMock(
-                headers={"content-type": "..."},
-                read=async_mock.CoroutineMock(
-                    return_value=str.encode(
-                        json.dumps(
-                            {"test": "....", "~transport": {"return_route": "..."}}
-                        )
-                    )
-                ),
-                host="test",
-                remote="test",
+            mock_request = mock_http_request(
+                str.encode(
+                    json.dumps({"test": "....", "~transport": {"return_route": "..."}})
+                )
             )
             await service.message_handler(mock_request)
 
@@ -450,15 +480,252 @@ class TestRedisHTTPHandler(AsyncTestCase):
                 side_effect=[test_module.RedisError, None]
             )
             service.redis = mock_redis
-            mock_request = async_mock.MagicMock(
-                headers={"content-type": "..."},
-                read=async_mock.CoroutineMock(
-                    return_value=str.encode(json.dumps({"test": "...."}))
-                ),
-                host="test",
-                remote="test",
+            mock_request = mock_http_request(str.encode(json.dumps({"test": "...."})))
+            await service.message_handler(mock_request)
+
+    async def test_message_handler_enqueue_deadline(self):
+        with async_mock.patch.object(
+            redis.asyncio.RedisCluster,
+            "from_url",
+            async_mock.MagicMock(),
+        ) as mock_redis, async_mock.patch.object(
+            test_module,
+            "process_payload_recip_key",
+            async_mock.CoroutineMock(return_value="acapy_inbound_input_recip_key"),
+        ) as mock_process_payload_recip_key:
+            service = HttpRelay(
+                "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
+            )
+            service.enqueue_timeout_s = 0.3
+            service.enqueue_backoff_base_s = 0.05
+            mock_redis.rpush = async_mock.CoroutineMock(
+                side_effect=test_module.RedisError
+            )
+            service.redis = mock_redis
+            mock_request = mock_http_request(
+                str.encode(
+                    json.dumps({"test": "....", "~transport": {"return_route": "..."}})
+                )
             )
+            assert (await service.message_handler(mock_request)).status == 503
+            assert service.direct_response_txn_request_map == {}
+            mock_request = mock_http_request(str.encode(json.dumps({"test": "...."})))
+            assert (await service.message_handler(mock_request)).status == 503
+            assert mock_redis.rpush.call_count > 2
+            assert mock_process_payload_recip_key.call_count == 2
+
+    async def test_message_handler_routing_deadline(self):
+        async def process_payload_recip_key(*args):
+            # Routing waits on a plugin UID that never becomes available
+            await asyncio.sleep(10)
+
+        with async_mock.patch.object(
+            test_module, "process_payload_recip_key", process_payload_recip_key
+        ):
+            service = HttpRelay(
+                "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
+            )
+            service.enqueue_timeout_s = 0.1
+            service.redis = async_mock.MagicMock(rpush=async_mock.CoroutineMock())
+            mock_request = mock_http_request(str.encode(json.dumps({"test": "...."})))
+            response = await asyncio.wait_for(service.message_handler(mock_request), 5)
+            assert response.status == 503
+            service.redis.rpush.assert_not_called()
+
+    async def test_message_handler_routing_x(self):
+        with async_mock.patch.object(
+            redis.asyncio.RedisCluster,
+            "from_url",
+            async_mock.MagicMock(),
+        ) as mock_redis, async_mock.patch.object(
+            test_module,
+            "process_payload_recip_key",
+            async_mock.CoroutineMock(side_effect=test_module.RedisError),
+        ):
+            service = HttpRelay(
+                "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
+            )
+            mock_redis.rpush = async_mock.CoroutineMock()
+            service.redis = mock_redis
+            mock_request = mock_http_request(str.encode(json.dumps({"test": "...."})))
+            assert (await service.message_handler(mock_request)).status == 503
+            mock_redis.rpush.assert_not_called()
+
+    async def test_message_handler_admission(self):
+        with async_mock.patch.object(
+            redis.asyncio.RedisCluster,
+            "from_url",
+            async_mock.MagicMock(),
+        ) as mock_redis, async_mock.patch.object(
+            HttpRelay, "process_message", async_mock.CoroutineMock()
+        ) as mock_process_message:
+            mock_request = mock_http_request(test_packed_msg)
+            service = HttpRelay(
+                "test",
+                "test",
+                "8080",
+                "direct_resp_topic",
+                "inbound_msg_topic",
+                max_inflight_msgs=1,
+            )
+            service.redis = mock_redis
+            service.inflight_msgs = 1
+            assert (await service.message_handler(mock_request)).status == 503
+            service = HttpRelay(
+                "test",
+                "test",
+                "8080",
+                "direct_resp_topic",
+                "inbound_msg_topic",
+                max_inflight_bytes=len(test_packed_msg) + 1,
+            )
+            service.redis = mock_redis
+            service.inflight_bytes = 2
+            assert (await service.message_handler(mock_request)).status == 503
+            mock_process_message.assert_not_called()
+            service.inflight_bytes = 0
             await service.message_handler(mock_request)
+            mock_process_message.assert_called_once()
+            assert service.inflight_msgs == 0
+            assert service.inflight_bytes == 0
+
+    async def test_message_handler_admission_concurrent(self):
+        async def get_pending_msg_count(*args):
+            await asyncio.sleep(0.01)
+            return 0
+
+        with async_mock.patch.object(
+            test_module,
+            "get_pending_msg_count",
+            async_mock.CoroutineMock(side_effect=get_pending_msg_count),
+        ), async_mock.patch.object(
+            HttpRelay,
+            "process_message",
+            async_mock.CoroutineMock(return_value=test_module.web.Response()),
+        ) as mock_process_message:
+            service = HttpRelay(
+                "test",
+                "test",
+                "8080",
+                "direct_resp_topic",
+                "inbound_msg_topic",
+                max_inflight_msgs=1,
+                max_pending_msgs_per_recip_key=5,
+            )
+            service.redis = async_mock.MagicMock()
+            responses = await asyncio.gather(
+                *[
+                    service.message_handler(mock_http_request(test_packed_msg))
+                    for _ in range(5)
+                ]
+            )
+            # The in-flight slot is taken before waiting on the pending count
+            assert sorted(response.status for response in responses) == [
+                200,
+                503,
+                503,
+                503,
+                503,
+            ]
+            mock_process_message.assert_called_once()
+            assert service.inflight_msgs == 0
+            assert service.inflight_bytes == 0
+
+    async def test_check_admission_recip_key(self):
+        with async_mock.patch.object(
+            test_module,
+            "get_pending_msg_count",
+            async_mock.CoroutineMock(side_effect=[5, 4, test_module.RedisError]),
+        ) as mock_get_pending_msg_count:
+            service = HttpRelay(
+                "test",
+                "test",
+                "8080",
+                "direct_resp_topic",
+                "inbound_msg_topic",
+                max_pending_msgs_per_recip_key=5,
+            )
+            service.redis = async_mock.MagicMock()
+            assert (await service.check_admission(test_packed_msg)) == 429
+            mock_get_pending_msg_count.assert_called_once_with(
+                service.redis, "test_recip_key", service.mediator_keys
+            )
+            assert (await service.check_admission(test_packed_msg)) is None
+            assert (await service.check_admission(test_packed_msg)) == 503
+            assert (await service.check_admission(b"invalid")) is None
+
+    async def test_message_handler_parses_recip_keys_once(self):
+        with async_mock.patch.object(
+            test_module,
+            "recipients_from_packed_message",
+            async_mock.MagicMock(return_value=["test_recip_key"]),
+        ) as mock_recipients, async_mock.patch.object(
+            test_module,
+            "get_pending_msg_count",
+            async_mock.CoroutineMock(return_value=0),
+        ), async_mock.patch.object(
+            test_module,
+            "process_payload_recip_key",
+            async_mock.CoroutineMock(return_value="acapy_inbound_test_recip_key"),
+        ) as mock_process_payload_recip_key:
+            service = HttpRelay(
+                "test",
+                "test",
+                "8080",
+                "direct_resp_topic",
+                "inbound_msg_topic",
+                max_pending_msgs_per_recip_key=5,
+            )
+            service.redis = async_mock.MagicMock(rpush=async_mock.CoroutineMock())
+            mock_request = mock_http_request(test_packed_msg)
+            assert (await service.message_handler(mock_request)).status == 200
+            mock_recipients.assert_called_once_with(json.loads(test_packed_msg))
+            assert mock_process_payload_recip_key.call_args[0][4] == ["test_recip_key"]
+
+    async def test_message_handler_max_body_size(self):
+        with async_mock.patch.object(
+            HttpRelay, "process_message", async_mock.CoroutineMock()
+        ) as mock_process_message:
+            service = HttpRelay(
+                "test",
+                "test",
+                "8080",
+                "direct_resp_topic",
+                "inbound_msg_topic",
+                max_body_size=100,
+            )
+            service.redis = async_mock.MagicMock()
+            mock_request = mock_http_request(b"{" + b" " * 150 + b"}")
+            assert (await service.message_handler(mock_request)).status == 413
+            mock_request = mock_http_request(b"{" + b" " * 150 + b"}", chunked=True)
+            assert (await service.message_handler(mock_request)).status == 413
+            mock_process_message.assert_not_called()
+            mock_request = mock_http_request(b"{" + b" " * 90 + b"}")
+            await service.message_handler(mock_request)
+            mock_process_message.assert_called_once()
+            assert mock_process_message.call_args[0][1] == b"{" + b" " * 90 + b"}"
+
+    def test_build_inbound_message(self):
+        message = json.loads(
+            test_module.build_inbound_message(bytearray(b'{"test": "...."}'), "http")
+        )
+        assert message == {
+            "payload": base64.urlsafe_b64encode(b'{"test": "...."}').decode(),
+            "transport_type": "http",
+        }
+        message = json.loads(
+            test_module.build_inbound_message(b'{"test": "...."}', "ws", "txn_123")
+        )
+        assert message["transport_type"] == "ws"
+        assert message["txn_id"] == "txn_123"
+        message = test_module.build_inbound_message(
+            b'{"test": "...."}', "ws", "txn_123", "binary"
+        )
+        assert decode_envelope(message) == {
+            "payload": b'{"test": "...."}',
+            "transport_type": "ws",
+            "txn_id": "txn_123",
+        }
 
     async def test_invite_handler(self):
         with async_mock.patch.object(
@@ -661,612 +928,584 @@ class TestRedisWSHandler(AsyncTestCase):
             host="test",
             remote="test",
         )
-        mock_msg = async_mock.MagicMock(
-            type=aiohttp.WSMsgType.TEXT.value,
-            data=str.encode(
-                json.dumps({"test": "....", "~transport": {"return_route": "..."}})
-            ),
-        )
-
-        with async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "prepare",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "receive",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "closed",
-            PropertyMock(side_effect=[False, False, True, False]),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "close",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "exception",
-            async_mock.MagicMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "send_bytes",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "send_str",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.asyncio,
-            "get_event_loop",
-            async_mock.MagicMock(
-                return_value=async_mock.MagicMock(
-                    run_until_complete=async_mock.MagicMock(),
-                    create_task=async_mock.MagicMock(
-                        return_value=async_mock.MagicMock(
-                            done=async_mock.MagicMock(return_value=True),
-                            result=async_mock.MagicMock(return_value=mock_msg),
+        with mock_ws_response(
+            [
+                mock_ws_msg(
+                    str.encode(
+                        json.dumps(
+                            {"test": "....", "~transport": {"return_route": "..."}}
                         )
-                    ),
-                )
-            ),
-        ) as mock_get_event_loop, async_mock.patch.object(
-            test_module.asyncio, "wait", async_mock.CoroutineMock()
-        ) as mock_wait, async_mock.patch.object(
+                    )
+                ),
+                mock_ws_msg(
+                    json.dumps({"test": "....", "~transport": {"return_route": "..."}})
+                ),
+            ]
+        ) as mock_ws, async_mock.patch.object(
             WSRelay,
             "get_direct_responses",
-            autospec=True,
-        ) as mock_get_direct_responses, async_mock.patch.object(
+            async_mock.CoroutineMock(
+                return_value={
+                    "response": "eyJ0ZXN0IjogIi4uLiIsICJ0ZXN0MiI6ICJ0ZXN0MiJ9"
+                }
+            ),
+        ), async_mock.patch.object(
             redis.asyncio.RedisCluster,
             "from_url",
             async_mock.MagicMock(),
         ) as mock_redis, async_mock.patch.object(
             test_module,
             "process_payload_recip_key",
-            async_mock.CoroutineMock(
-                return_value=("acapy_inbound_input_recip_key", async_mock.MagicMock())
-            ),
+            async_mock.CoroutineMock(return_value="acapy_inbound_input_recip_key"),
         ):
-            mock_get_direct_responses.return_value = {
-                "response": "eyJ0ZXN0IjogIi4uLiIsICJ0ZXN0MiI6ICJ0ZXN0MiJ9"
-            }
             service = WSRelay(
                 "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
             )
             service.timedelay_s = 0.1
-            mock_redis.blpop = async_mock.CoroutineMock()
             mock_redis.rpush = async_mock.CoroutineMock()
             service.redis = mock_redis
             await service.message_handler(mock_request)
+            assert mock_redis.rpush.call_count == 2
+            assert mock_ws["send_bytes"].call_count == 2
+            mock_ws["close"].assert_called_once_with()
 
     async def test_message_handler_b(self):
         mock_request = async_mock.MagicMock(
             host="test",
             remote="test",
         )
-        mock_msg = async_mock.MagicMock(
-            type=aiohttp.WSMsgType.TEXT.value,
-            data=json.dumps({"test": "....", "~transport": {"return_route": "..."}}),
-        )
-
-        with async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "prepare",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "receive",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "closed",
-            PropertyMock(side_effect=[False, False, True, False]),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "close",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "exception",
-            async_mock.MagicMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "send_bytes",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "send_str",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.asyncio,
-            "get_event_loop",
-            async_mock.MagicMock(
-                return_value=async_mock.MagicMock(
-                    run_until_complete=async_mock.MagicMock(),
-                    create_task=async_mock.MagicMock(
-                        return_value=async_mock.MagicMock(
-                            done=async_mock.MagicMock(return_value=True),
-                            result=async_mock.MagicMock(return_value=mock_msg),
-                        )
-                    ),
-                )
-            ),
-        ) as mock_get_event_loop, async_mock.patch.object(
-            test_module.asyncio, "wait", async_mock.CoroutineMock()
-        ) as mock_wait, async_mock.patch.object(
-            WSRelay,
-            "get_direct_responses",
-            autospec=True,
-        ) as mock_get_direct_responses, async_mock.patch.object(
+        with mock_ws_response(
+            [mock_ws_msg(json.dumps({"test": "...."}))]
+        ) as mock_ws, async_mock.patch.object(
             redis.asyncio.RedisCluster,
             "from_url",
             async_mock.MagicMock(),
         ) as mock_redis, async_mock.patch.object(
             test_module,
             "process_payload_recip_key",
-            async_mock.CoroutineMock(
-                return_value=("acapy_inbound_input_recip_key", async_mock.MagicMock())
-            ),
+            async_mock.CoroutineMock(return_value="acapy_inbound_input_recip_key"),
         ):
-            mock_get_direct_responses.return_value = {
-                "response": "eyJ0ZXN0IjogIi4uLiIsICJ0ZXN0MiI6ICJ0ZXN0MiJ9"
-            }
             service = WSRelay(
                 "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
             )
             service.timedelay_s = 0.1
-            mock_redis.blpop = async_mock.CoroutineMock()
-            mock_redis.rpush = async_mock.CoroutineMock()
+            mock_redis.rpush = async_mock.CoroutineMock(
+                side_effect=[test_module.RedisError, None]
+            )
             service.redis = mock_redis
             await service.message_handler(mock_request)
+            assert mock_redis.rpush.call_count == 2
+            mock_ws["send_bytes"].assert_not_called()
 
-    async def test_message_handler_c(self):
+    async def test_message_handler_concurrent(self):
         mock_request = async_mock.MagicMock(
             host="test",
             remote="test",
         )
-        mock_msg = async_mock.MagicMock(
-            type=aiohttp.WSMsgType.TEXT.value,
-            data=json.dumps({"test": "...."}),
-        )
+        direct_response_ready = asyncio.Event()
 
-        with async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "prepare",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "receive",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "closed",
-            PropertyMock(side_effect=[False, False, True, False]),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "close",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "exception",
-            async_mock.MagicMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "send_bytes",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "send_str",
-            async_mock.CoroutineMock(),
+        async def get_direct_responses(txn_id):
+            await direct_response_ready.wait()
+            return {"response": "eyJ0ZXN0IjogIi4uLiJ9"}
+
+        async def rpush(topic, message):
+            if (
+                json.loads(message)["payload"]
+                == base64.urlsafe_b64encode(b'{"test": "second"}').decode()
+            ):
+                direct_response_ready.set()
+
+        with mock_ws_response(
+            [
+                mock_ws_msg(
+                    json.dumps({"test": "first", "~transport": {"return_route": "all"}})
+                ),
+                mock_ws_msg(json.dumps({"test": "second"})),
+            ]
+        ) as mock_ws, async_mock.patch.object(
+            WSRelay, "get_direct_responses", side_effect=get_direct_responses
         ), async_mock.patch.object(
-            test_module.asyncio,
-            "get_event_loop",
-            async_mock.MagicMock(
-                return_value=async_mock.MagicMock(
-                    run_until_complete=async_mock.MagicMock(),
-                    create_task=async_mock.MagicMock(
-                        return_value=async_mock.MagicMock(
-                            done=async_mock.MagicMock(return_value=True),
-                            result=async_mock.MagicMock(return_value=mock_msg),
-                        )
-                    ),
-                )
-            ),
-        ) as mock_get_event_loop, async_mock.patch.object(
-            test_module.asyncio, "wait", async_mock.CoroutineMock()
-        ) as mock_wait, async_mock.patch.object(
-            WSRelay,
-            "get_direct_responses",
-            autospec=True,
-        ) as mock_get_direct_responses, async_mock.patch.object(
-            redis.cluster.RedisCluster,
-            "from_url",
-            async_mock.MagicMock(),
-        ) as mock_redis, async_mock.patch.object(
             test_module,
             "process_payload_recip_key",
-            async_mock.CoroutineMock(
-                return_value=("acapy_inbound_input_recip_key", async_mock.MagicMock())
-            ),
+            async_mock.CoroutineMock(return_value="acapy_inbound_input_recip_key"),
         ):
             service = WSRelay(
                 "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
             )
-            service.timedelay_s = 0.1
-            mock_redis.blpop = async_mock.CoroutineMock()
-            mock_redis.rpush = async_mock.CoroutineMock()
-            service.redis = mock_redis
-            await service.message_handler(mock_request)
+            service.redis = async_mock.MagicMock(
+                rpush=async_mock.CoroutineMock(side_effect=rpush)
+            )
+            # The second message must be queued while the first waits for its
+            # direct response, otherwise this would hang
+            await asyncio.wait_for(service.message_handler(mock_request), 5)
+            mock_ws["send_bytes"].assert_called_once_with(b'{"test": "..."}')
 
-    async def test_message_handler_x(self):
+    async def test_message_handler_window(self):
         mock_request = async_mock.MagicMock(
             host="test",
             remote="test",
         )
-        mock_msg = async_mock.MagicMock(
-            type=aiohttp.WSMsgType.TEXT.value,
-            data=json.dumps({"test": "....", "~transport": {"return_route": "..."}}),
-        )
+        in_progress = 0
+        max_in_progress = 0
 
-        with async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "prepare",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "receive",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "closed",
-            PropertyMock(side_effect=[False, False, True, False]),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "close",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "exception",
-            async_mock.MagicMock(),
+        async def send_direct_response(ws, txn_id):
+            nonlocal in_progress, max_in_progress
+            in_progress += 1
+            max_in_progress = max(max_in_progress, in_progress)
+            await asyncio.sleep(0.05)
+            in_progress -= 1
+
+        with mock_ws_response(
+            [mock_ws_msg(json.dumps({"test": str(index)})) for index in range(5)]
         ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "send_bytes",
-            async_mock.CoroutineMock(),
+            WSRelay,
+            "process_message",
+            async_mock.CoroutineMock(return_value=(True, "test_txn_id")),
         ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "send_str",
-            async_mock.CoroutineMock(),
+            WSRelay, "send_direct_response", side_effect=send_direct_response
+        ) as mock_send_direct_response:
+            service = WSRelay(
+                "test",
+                "test",
+                "8080",
+                "direct_resp_topic",
+                "inbound_msg_topic",
+                ws_max_concurrent_msgs=2,
+            )
+            service.redis = async_mock.MagicMock()
+            await service.message_handler(mock_request)
+            assert max_in_progress == 2
+            assert mock_send_direct_response.call_count == 5
+            assert service.inflight_msgs == 0
+
+    async def test_message_handler_in_order(self):
+        mock_request = async_mock.MagicMock(
+            host="test",
+            remote="test",
+        )
+        delays = [0.05, 0]
+
+        async def process_payload_recip_key(*args):
+            # The first message takes longer to route than the second
+            await asyncio.sleep(delays.pop(0))
+            return "acapy_inbound_input_recip_key"
+
+        with mock_ws_response(
+            [mock_ws_msg(json.dumps({"test": str(index)})) for index in range(2)]
         ), async_mock.patch.object(
-            test_module.asyncio,
-            "get_event_loop",
-            async_mock.MagicMock(
-                return_value=async_mock.MagicMock(
-                    run_until_complete=async_mock.MagicMock(),
-                    create_task=async_mock.MagicMock(
-                        return_value=async_mock.MagicMock(
-                            done=async_mock.MagicMock(return_value=True),
-                            result=async_mock.MagicMock(return_value=mock_msg),
-                        )
-                    ),
-                )
-            ),
-        ) as mock_get_event_loop, async_mock.patch.object(
-            test_module.asyncio, "wait", async_mock.CoroutineMock()
-        ) as mock_wait, async_mock.patch.object(
-            WSRelay,
-            "get_direct_responses",
-            autospec=True,
-        ) as mock_get_direct_responses, async_mock.patch.object(
-            redis.asyncio.RedisCluster,
-            "from_url",
-            async_mock.MagicMock(),
-        ) as mock_redis, async_mock.patch.object(
-            test_module,
-            "process_payload_recip_key",
-            async_mock.CoroutineMock(
-                return_value=("acapy_inbound_input_recip_key", async_mock.MagicMock())
-            ),
+            test_module, "process_payload_recip_key", process_payload_recip_key
         ):
-            mock_get_direct_responses.side_effect = test_module.asyncio.TimeoutError
             service = WSRelay(
                 "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
             )
-            service.timedelay_s = 0.1
-            mock_redis.blpop = async_mock.CoroutineMock()
-            mock_redis.rpush = async_mock.CoroutineMock()
-            service.redis = mock_redis
+            service.redis = async_mock.MagicMock(rpush=async_mock.CoroutineMock())
             await service.message_handler(mock_request)
+            assert [
+                base64.urlsafe_b64decode(json.loads(call[0][1])["payload"])
+                for call in service.redis.rpush.call_args_list
+            ] == [b'{"test": "0"}', b'{"test": "1"}']
 
-        mock_msg = async_mock.MagicMock(
-            type=aiohttp.WSMsgType.TEXT.value,
-            data=json.dumps({"test": "....", "~transport": {"return_route": "..."}}),
+    async def test_message_handler_direct_response_x(self):
+        mock_request = async_mock.MagicMock(
+            host="test",
+            remote="test",
         )
-
-        with async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "prepare",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "receive",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "closed",
-            PropertyMock(side_effect=[False, False, True, False]),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "close",
-            async_mock.CoroutineMock(),
+        with mock_ws_response(
+            [mock_ws_msg(json.dumps({"test": "..."}))]
         ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "exception",
-            async_mock.MagicMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "send_bytes",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "send_str",
-            async_mock.CoroutineMock(),
+            WSRelay,
+            "process_message",
+            async_mock.CoroutineMock(return_value=(True, "test_txn_id")),
         ), async_mock.patch.object(
-            test_module.asyncio,
-            "get_event_loop",
-            async_mock.MagicMock(
-                return_value=async_mock.MagicMock(
-                    run_until_complete=async_mock.MagicMock(),
-                    create_task=async_mock.MagicMock(
-                        return_value=async_mock.MagicMock(
-                            done=async_mock.MagicMock(return_value=True),
-                            result=async_mock.MagicMock(return_value=mock_msg),
-                        )
-                    ),
-                )
-            ),
-        ) as mock_get_event_loop, async_mock.patch.object(
-            test_module.asyncio, "wait", async_mock.CoroutineMock()
-        ) as mock_wait, async_mock.patch.object(
             WSRelay,
-            "get_direct_responses",
-            autospec=True,
-        ) as mock_get_direct_responses, async_mock.patch.object(
-            redis.asyncio.RedisCluster,
-            "from_url",
-            async_mock.MagicMock(),
-        ) as mock_redis, async_mock.patch.object(
-            test_module,
-            "process_payload_recip_key",
-            async_mock.CoroutineMock(
-                return_value=("acapy_inbound_input_recip_key", async_mock.MagicMock())
-            ),
-        ):
-            mock_get_direct_responses.return_value = {
-                "response": "eyJ0ZXN0IjogIi4uLiIsICJ0ZXN0MiI6ICJ0ZXN0MiJ9"
-            }
+            "send_direct_response",
+            async_mock.CoroutineMock(side_effect=ConnectionError),
+        ), async_mock.patch.object(
+            test_module, "logging", async_mock.MagicMock()
+        ) as mock_logging:
             service = WSRelay(
                 "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
             )
-            service.timedelay_s = 0.1
-            mock_redis.blpop = async_mock.CoroutineMock()
-            mock_redis.rpush = async_mock.CoroutineMock(
-                side_effect=[test_module.RedisError, None]
-            )
-            service.redis = mock_redis
+            service.redis = async_mock.MagicMock()
             await service.message_handler(mock_request)
+            mock_logging.error.assert_any_call(
+                "Unexpected task exception", exc_info=async_mock.ANY
+            )
 
-        mock_msg = async_mock.MagicMock(
-            type=aiohttp.WSMsgType.ERROR.value,
-            data=json.dumps({"test": "...."}),
+    async def test_message_handler_receive_timeout(self):
+        mock_request = async_mock.MagicMock(
+            host="test",
+            remote="test",
         )
+        finished = []
 
-        with async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "prepare",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "receive",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "closed",
-            PropertyMock(side_effect=[False, False, True, True]),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "close",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "exception",
-            async_mock.MagicMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "send_bytes",
-            async_mock.CoroutineMock(),
+        async def send_direct_response(ws, txn_id):
+            await asyncio.sleep(0.05)
+            finished.append(txn_id)
+
+        with mock_ws_response(
+            [mock_ws_msg(json.dumps({"test": "..."})), asyncio.TimeoutError()]
+        ) as mock_ws, async_mock.patch.object(
+            WSRelay,
+            "process_message",
+            async_mock.CoroutineMock(return_value=(True, "test_txn_id")),
         ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "send_str",
-            async_mock.CoroutineMock(),
+            WSRelay, "send_direct_response", side_effect=send_direct_response
         ), async_mock.patch.object(
-            test_module.asyncio,
-            "get_event_loop",
-            async_mock.MagicMock(
-                return_value=async_mock.MagicMock(
-                    run_until_complete=async_mock.MagicMock(),
-                    create_task=async_mock.MagicMock(
-                        return_value=async_mock.MagicMock(
-                            done=async_mock.MagicMock(return_value=True),
-                            result=async_mock.MagicMock(return_value=mock_msg),
-                        )
-                    ),
-                )
-            ),
-        ) as mock_get_event_loop, async_mock.patch.object(
-            test_module.asyncio, "wait", async_mock.CoroutineMock()
-        ) as mock_wait, async_mock.patch.object(
-            redis.asyncio.RedisCluster,
-            "from_url",
-            async_mock.MagicMock(),
-        ) as mock_redis, async_mock.patch.object(
-            test_module,
-            "process_payload_recip_key",
-            async_mock.CoroutineMock(
-                return_value=("acapy_inbound_input_recip_key", async_mock.MagicMock())
-            ),
-        ):
+            WSRelay, "unregister_ws_session", async_mock.CoroutineMock()
+        ) as mock_unregister:
             service = WSRelay(
                 "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
             )
-            service.timedelay_s = 0.1
-            mock_redis.blpop = async_mock.CoroutineMock()
-            mock_redis.rpush = async_mock.CoroutineMock()
-            service.redis = mock_redis
+            service.redis = async_mock.MagicMock()
             await service.message_handler(mock_request)
+            assert len(finished) == 1
+            mock_unregister.assert_called_once()
+            mock_ws["close"].assert_called_once()
 
-        mock_msg = async_mock.MagicMock(
-            type="invlaid",
-            data=json.dumps({"test": "...."}),
+    async def test_dispatch_message_not_dict(self):
+        service = WSRelay(
+            "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
         )
+        service.redis = async_mock.MagicMock()
+        mock_ws = async_mock.MagicMock(close=async_mock.CoroutineMock(), closed=False)
+        for message_data in (b'["test"]', b'{"~transport": "test"}'):
+            await service.dispatch_message(
+                mock_ws, async_mock.MagicMock(), message_data
+            )
+        mock_ws.close.assert_not_called()
+        assert service.inflight_msgs == 0
 
-        with async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "prepare",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "receive",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "closed",
-            PropertyMock(side_effect=[False, False, True, True]),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "close",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "exception",
-            async_mock.MagicMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "send_bytes",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "send_str",
-            async_mock.CoroutineMock(),
+    async def test_message_handler_x(self):
+        mock_request = async_mock.MagicMock(
+            host="test",
+            remote="test",
+        )
+        with mock_ws_response(
+            [
+                mock_ws_msg(
+                    json.dumps({"test": "....", "~transport": {"return_route": "..."}})
+                ),
+                mock_ws_msg(b"invalid"),
+                mock_ws_msg(json.dumps({"test": "...."}), aiohttp.WSMsgType.ERROR),
+                mock_ws_msg(json.dumps({"test": "...."}), "invalid"),
+            ]
+        ) as mock_ws, async_mock.patch.object(
+            WSRelay,
+            "get_direct_responses",
+            async_mock.CoroutineMock(side_effect=test_module.asyncio.TimeoutError),
         ), async_mock.patch.object(
-            test_module.asyncio,
-            "get_event_loop",
-            async_mock.MagicMock(
-                return_value=async_mock.MagicMock(
-                    run_until_complete=async_mock.MagicMock(),
-                    create_task=async_mock.MagicMock(
-                        return_value=async_mock.MagicMock(
-                            done=async_mock.MagicMock(return_value=True),
-                            result=async_mock.MagicMock(return_value=mock_msg),
-                        )
-                    ),
-                )
-            ),
-        ) as mock_get_event_loop, async_mock.patch.object(
-            test_module.asyncio, "wait", async_mock.CoroutineMock()
-        ) as mock_wait, async_mock.patch.object(
             redis.asyncio.RedisCluster,
             "from_url",
             async_mock.MagicMock(),
         ) as mock_redis, async_mock.patch.object(
             test_module,
             "process_payload_recip_key",
-            async_mock.CoroutineMock(
-                return_value=("acapy_inbound_input_recip_key", async_mock.MagicMock())
-            ),
+            async_mock.CoroutineMock(return_value="acapy_inbound_input_recip_key"),
         ):
             service = WSRelay(
                 "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
             )
             service.timedelay_s = 0.1
-            mock_redis.blpop = async_mock.CoroutineMock()
-            mock_redis.rpush = async_mock.CoroutineMock()
+            mock_redis.rpush = async_mock.CoroutineMock(
+                side_effect=[test_module.RedisError, None]
+            )
             service.redis = mock_redis
             await service.message_handler(mock_request)
+            mock_ws["exception"].assert_called_once()
+            mock_ws["send_bytes"].assert_not_called()
+            assert service.inflight_msgs == 0
 
-        mock_msg = async_mock.MagicMock(
-            type=aiohttp.WSMsgType.TEXT.value,
-            data=json.dumps({"test": "...."}),
+    async def test_message_handler_not_queued(self):
+        mock_request = async_mock.MagicMock(
+            host="test",
+            remote="test",
         )
+        with mock_ws_response(
+            [mock_ws_msg(json.dumps({"test": "...."}))]
+        ) as mock_ws, async_mock.patch.object(
+            WSRelay, "enqueue_message", async_mock.CoroutineMock(return_value=False)
+        ):
+            service = WSRelay(
+                "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
+            )
+            service.redis = async_mock.MagicMock()
+            await service.message_handler(mock_request)
+            mock_ws["close"].assert_any_call(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER)
+        with mock_ws_response(
+            [mock_ws_msg(json.dumps({"test": "...."}))]
+        ) as mock_ws, async_mock.patch.object(
+            WSRelay, "check_admission", async_mock.CoroutineMock(return_value=503)
+        ), async_mock.patch.object(
+            WSRelay, "process_message", async_mock.CoroutineMock()
+        ) as mock_process_message:
+            service = WSRelay(
+                "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
+            )
+            service.redis = async_mock.MagicMock()
+            await service.message_handler(mock_request)
+            mock_ws["close"].assert_any_call(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER)
+            mock_process_message.assert_not_called()
 
+    async def test_run_ws_session(self):
         with async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "prepare",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "receive",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "closed",
-            PropertyMock(side_effect=[False, False, True, False]),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "close",
-            async_mock.CoroutineMock(),
-        ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "exception",
+            redis.asyncio.RedisCluster,
+            "from_url",
             async_mock.MagicMock(),
         ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "send_bytes",
-            async_mock.CoroutineMock(),
+            WSRelay, "process_direct_responses", async_mock.CoroutineMock()
         ), async_mock.patch.object(
-            test_module.web.WebSocketResponse,
-            "send_str",
-            async_mock.CoroutineMock(),
+            WSRelay, "start", async_mock.CoroutineMock()
         ), async_mock.patch.object(
-            test_module.asyncio,
-            "get_event_loop",
-            async_mock.MagicMock(
-                return_value=async_mock.MagicMock(
-                    run_until_complete=async_mock.MagicMock(),
-                    create_task=async_mock.MagicMock(
-                        return_value=async_mock.MagicMock(
-                            done=async_mock.MagicMock(return_value=True),
-                            result=async_mock.MagicMock(return_value=mock_msg),
-                        )
-                    ),
-                )
+            WSRelay, "process_ws_session_messages", async_mock.CoroutineMock()
+        ) as mock_process_ws_session_messages, async_mock.patch.object(
+            WSRelay, "refresh_ws_sessions", async_mock.CoroutineMock()
+        ) as mock_refresh_ws_sessions, async_mock.patch.object(
+            WSRelay, "release_ws_sessions", async_mock.CoroutineMock()
+        ) as mock_release_ws_sessions:
+            relay = WSRelay(
+                "test",
+                "test",
+                "8080",
+                "direct_resp_topic",
+                "inbound_msg_topic",
+                outbound_topic="acapy_outbound",
+                ws_session_topic="acapy_ws_session",
+            )
+            await relay.run()
+            mock_process_ws_session_messages.assert_called_once()
+            mock_refresh_ws_sessions.assert_called_once()
+            mock_release_ws_sessions.assert_called_once()
+
+    async def test_release_ws_sessions(self):
+        service = WSRelay(
+            "test",
+            "test",
+            "8080",
+            "direct_resp_topic",
+            "inbound_msg_topic",
+            outbound_topic="acapy_outbound",
+            ws_session_topic="acapy_ws_session",
+            relay_id="test_relay",
+        )
+        assert service.ws_session_outbound_topic == "acapy_ws_session_relay_test_relay"
+        service.ws_sessions = {"test_recip_key": async_mock.MagicMock()}
+        service.redis = async_mock.MagicMock(
+            get=async_mock.CoroutineMock(
+                return_value=service.ws_session_outbound_topic.encode()
             ),
-        ) as mock_get_event_loop, async_mock.patch.object(
-            test_module.asyncio, "wait", async_mock.CoroutineMock()
-        ) as mock_wait, async_mock.patch.object(
-            test_module.asyncio,
-            "wait_for",
-            async_mock.CoroutineMock(return_value=b"{}"),
-        ) as mock_wait_for, async_mock.patch.object(
-            redis.asyncio.RedisCluster,
-            "from_url",
-            async_mock.MagicMock(),
-        ) as mock_redis, async_mock.patch.object(
-            test_module,
-            "process_payload_recip_key",
-            async_mock.CoroutineMock(
-                return_value=("acapy_inbound_input_recip_key", async_mock.MagicMock())
+            delete=async_mock.CoroutineMock(),
+            lpop=async_mock.CoroutineMock(side_effect=[b"test_1", b"test_2", None]),
+            rpush=async_mock.CoroutineMock(),
+        )
+        await service.release_ws_sessions()
+        assert service.ws_sessions == {}
+        service.redis.delete.assert_called_once_with("acapy_ws_session_test_recip_key")
+        service.redis.lpop.assert_called_with("acapy_ws_session_relay_test_relay")
+        assert service.redis.rpush.call_args_list == [
+            async_mock.call("acapy_outbound", b"test_1"),
+            async_mock.call("acapy_outbound", b"test_2"),
+        ]
+
+    async def test_register_ws_session(self):
+        service = WSRelay(
+            "test",
+            "test",
+            "8080",
+            "direct_resp_topic",
+            "inbound_msg_topic",
+            outbound_topic="acapy_outbound",
+            ws_session_topic="acapy_ws_session",
+        )
+        service.redis = async_mock.MagicMock(
+            set=async_mock.CoroutineMock(),
+            get=async_mock.CoroutineMock(
+                return_value=service.ws_session_outbound_topic.encode()
             ),
-        ):
-            service = WSRelay(
-                "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
-            )
-            service.timedelay_s = 0.1
-            mock_redis.blpop = async_mock.CoroutineMock()
-            mock_redis.rpush = async_mock.CoroutineMock(
-                side_effect=[test_module.RedisError, None]
+            delete=async_mock.CoroutineMock(),
+        )
+        mock_ws = async_mock.MagicMock()
+        await service.register_ws_session(mock_ws, b"invalid")
+        await service.register_ws_session(mock_ws, test_packed_msg)
+        await service.register_ws_session(mock_ws, test_packed_msg)
+        service.redis.set.assert_called_once_with(
+            "acapy_ws_session_test_recip_key",
+            service.ws_session_outbound_topic,
+            ex=service.ws_session_ttl_s,
+        )
+        assert service.ws_sessions == {"test_recip_key": mock_ws}
+        await service.unregister_ws_session(async_mock.MagicMock())
+        assert service.ws_sessions == {"test_recip_key": mock_ws}
+        await service.unregister_ws_session(mock_ws)
+        assert service.ws_sessions == {}
+        service.redis.delete.assert_called_once_with("acapy_ws_session_test_recip_key")
+
+        service = WSRelay(
+            "test", "test", "8080", "direct_resp_topic", "inbound_msg_topic"
+        )
+        service.redis = async_mock.MagicMock(set=async_mock.CoroutineMock())
+        await service.register_ws_session(mock_ws, test_packed_msg)
+        service.redis.set.assert_not_called()
+
+    async def test_refresh_ws_sessions(self):
+        WSRelay.running = PropertyMock(side_effect=[True, True, False])
+        service = WSRelay(
+            "test",
+            "test",
+            "8080",
+            "direct_resp_topic",
+            "inbound_msg_topic",
+            outbound_topic="acapy_outbound",
+            ws_session_topic="acapy_ws_session",
+        )
+        service.ws_session_ttl_s = 0.03
+        service.ws_sessions = {
+            "test_recip_key": async_mock.MagicMock(closed=False),
+            "test_closed_recip_key": async_mock.MagicMock(closed=True),
+        }
+        mock_pipeline = async_mock.MagicMock(
+            execute=async_mock.CoroutineMock(side_effect=[test_module.RedisError, None])
+        )
+        service.redis = async_mock.MagicMock(
+            pipeline=async_mock.MagicMock(return_value=mock_pipeline),
+            get=async_mock.CoroutineMock(
+                return_value=service.ws_session_outbound_topic.encode()
+            ),
+            delete=async_mock.CoroutineMock(),
+        )
+        await service.refresh_ws_sessions()
+        assert mock_pipeline.execute.call_count == 2
+        assert mock_pipeline.set.call_count == 2
+        mock_pipeline.set.assert_called_with(
+            "acapy_ws_session_test_recip_key",
+            service.ws_session_outbound_topic,
+            ex=service.ws_session_ttl_s,
+        )
+        assert list(service.ws_sessions) == ["test_recip_key"]
+        service.redis.delete.assert_called_once_with(
+            "acapy_ws_session_test_closed_recip_key"
+        )
+
+    async def test_process_ws_session_messages(self):
+        outbound = str.encode(
+            json.dumps(
+                {
+                    "service": {"url": "ws://localhost:9001"},
+                    "payload": base64.urlsafe_b64encode(test_packed_msg).decode(),
+                }
             )
-            service.redis = mock_redis
-            await service.message_handler(mock_request)
+        )
+        compressed_outbound = pack_envelope(
+            {
+                "service": {"url": "ws://localhost:9001"},
+                "metadata": {"content-encoding": "zlib"},
+            },
+            zlib.compress(test_packed_msg),
+        )
+        corrupt_outbound = pack_envelope(
+            {
+                "service": {"url": "ws://localhost:9001"},
+                "metadata": {"content-encoding": "zlib"},
+            },
+            b"not zlib",
+        )
+        WSRelay.running = PropertyMock(
+            side_effect=[True, True, True, True, True, True, True, False]
+        )
+        service = WSRelay(
+            "test",
+            "test",
+            "8080",
+            "direct_resp_topic",
+            "inbound_msg_topic",
+            outbound_topic="acapy_outbound",
+            ws_session_topic="acapy_ws_session",
+        )
+        mock_ws = async_mock.MagicMock(
+            closed=False,
+            send_bytes=async_mock.CoroutineMock(side_effect=[None, ConnectionError]),
+        )
+        service.ws_sessions = {"test_recip_key": mock_ws}
+        service.redis = async_mock.MagicMock(
+            blpop=async_mock.CoroutineMock(
+                side_effect=[
+                    test_module.RedisError,
+                    None,
+                    (None, b"invalid"),
+                    (None, corrupt_outbound),
+                    (None, compressed_outbound),
+                    (None, outbound),
+                    (None, outbound),
+                ]
+            ),
+            rpush=async_mock.CoroutineMock(),
+            get=async_mock.CoroutineMock(return_value=None),
+        )
+        with async_mock.patch.object(
+            test_module.asyncio, "sleep", async_mock.CoroutineMock()
+        ):
+            await service.process_ws_session_messages()
+        mock_ws.send_bytes.assert_called_with(test_packed_msg)
+        assert mock_ws.send_bytes.call_count == 2
+        assert service.ws_sessions == {}
+        assert service.redis.rpush.call_count == 2
+        service.redis.rpush.assert_called_with("acapy_outbound", outbound)
+
+    async def test_process_ws_session_messages_closed(self):
+        outbound = pack_envelope({"service": {"url": "ws://test"}}, test_packed_msg)
+        WSRelay.running = PropertyMock(side_effect=[True, False])
+        service = WSRelay(
+            "test",
+            "test",
+            "8080",
+            "direct_resp_topic",
+            "inbound_msg_topic",
+            outbound_topic="acapy_outbound",
+            ws_session_topic="acapy_ws_session",
+        )
+        mock_ws = async_mock.MagicMock(
+            closed=True, send_bytes=async_mock.CoroutineMock()
+        )
+        service.ws_sessions = {"test_recip_key": mock_ws}
+        service.redis = async_mock.MagicMock(
+            blpop=async_mock.CoroutineMock(return_value=(None, outbound)),
+            rpush=async_mock.CoroutineMock(),
+            get=async_mock.CoroutineMock(
+                return_value=service.ws_session_outbound_topic.encode()
+            ),
+            delete=async_mock.CoroutineMock(),
+        )
+        await service.process_ws_session_messages()
+        mock_ws.send_bytes.assert_not_called()
+        assert service.ws_sessions == {}
+        service.redis.delete.assert_called_once_with("acapy_ws_session_test_recip_key")
+        service.redis.rpush.assert_called_once_with("acapy_outbound", outbound)
+
+    async def test_process_ws_session_messages_no_session(self):
+        outbound = pack_envelope({"service": {"url": "ws://test"}}, test_packed_msg)
+        WSRelay.running = PropertyMock(side_effect=[True, True, False])
+        service = WSRelay(
+            "test",
+            "test",
+            "8080",
+            "direct_resp_topic",
+            "inbound_msg_topic",
+            outbound_topic="acapy_outbound",
+            ws_session_topic="acapy_ws_session",
+        )
+        service.redis = async_mock.MagicMock(
+            blpop=async_mock.CoroutineMock(return_value=(None, outbound)),
+            rpush=async_mock.CoroutineMock(),
+            get=async_mock.CoroutineMock(
+                side_effect=[service.ws_session_outbound_topic.encode(), b"other"]
+            ),
+            delete=async_mock.CoroutineMock(),
+        )
+        await service.process_ws_session_messages()
+        # Only the entry naming this relay is removed
+        service.redis.delete.assert_called_once_with("acapy_ws_session_test_recip_key")
+        assert service.redis.rpush.call_count == 2
+        service.redis.rpush.assert_called_with("acapy_outbound", outbound)
 
     async def test_is_running(self):
         with async_mock.patch.object(
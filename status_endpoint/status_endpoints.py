@@ -44,3 +44,13 @@ async def status_live(api_key: str = Depends(get_api_key)):
         if not await (handler.is_running()):
             return {"alive": False}
     return {"alive": True}
+
+
+@router.get("/status/metrics")
+async def status_metrics(api_key: str = Depends(get_api_key)):
+    """Request handler for the metrics of handlers that keep them."""
+    return {
+        type(handler).__name__: handler.get_metrics()
+        for handler in handler_list
+        if hasattr(handler, "get_metrics")
+    }